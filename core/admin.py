@@ -1,15 +1,14 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Genre, Track, Album, Playlist, Recommendation, TrainingJob, AuditLog, LikeDislike, AnnoyIndexStatus
+from .models import User, Genre, Track, Album, Playlist, Recommendation, CoLikeSimilarity, TrainingJob, AuditLog, LikeDislike, AnnoyIndexStatus, EmbeddingJob, EmbeddingCacheEntry, TrackEmbedding, TrackTombstone, TextQueryEmbedding, UserTasteVector
 from django.utils.translation import gettext_lazy as _
 from django.urls import path
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from .forms import BulkTrackUploadForm
-import librosa
+from .audio_io import probe_uploaded_file
 import math
 import os
-from django.core.files.uploadedfile import TemporaryUploadedFile
 
 # Расширяем стандартный админ-класс для User
 class UserAdmin(BaseUserAdmin):
@@ -43,11 +42,17 @@ class GenreAdmin(admin.ModelAdmin):
 
 @admin.register(Track)
 class TrackAdmin(admin.ModelAdmin):
-    list_display = ('title', 'artist', 'genre', 'duration')
-    list_filter = ('genre',)
+    list_display = ('title', 'artist', 'genre', 'duration', 'embedding_status')
+    list_filter = ('genre', 'embedding_job__status')
+    list_select_related = ('genre', 'embedding_job')
     search_fields = ('title', 'artist')
     change_list_template = "admin/core/track/change_list.html"
 
+    @admin.display(description='Эмбеддинг')
+    def embedding_status(self, obj):
+        job = getattr(obj, 'embedding_job', None)
+        return job.get_status_display() if job else '—'
+
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
@@ -70,18 +75,8 @@ class TrackAdmin(admin.ModelAdmin):
                         file_name, _ = os.path.splitext(audio_file.name)
                         title = file_name.replace('_', ' ') # Заменяем подчеркивания на пробелы
 
-                        # Определяем длительность
-                        duration_seconds = 0
-                        audio_path_for_librosa = None
-                        if isinstance(audio_file, TemporaryUploadedFile):
-                            audio_path_for_librosa = audio_file.temporary_file_path()
-                        else:
-                            # Попробуем передать сам объект, если не временный файл
-                            audio_path_for_librosa = audio_file
-
-                        if audio_path_for_librosa:
-                             duration_seconds = math.ceil(librosa.get_duration(path=audio_path_for_librosa))
-                        audio_file.seek(0) # Возвращаем указатель
+                        # Определяем длительность по заголовку файла
+                        duration_seconds = math.ceil(probe_uploaded_file(audio_file).duration)
 
                         # Создаем и сохраняем трек
                         track = Track(
@@ -90,7 +85,7 @@ class TrackAdmin(admin.ModelAdmin):
                             duration=duration_seconds,
                             filepath=audio_file # Передаем UploadedFile
                         )
-                        track.save() # Вызовет генерацию эмбеддинга в модели
+                        track.save() # Поставит задачу генерации эмбеддинга в очередь
                         success_count += 1
 
                     except Exception as e:
@@ -99,7 +94,7 @@ class TrackAdmin(admin.ModelAdmin):
                         admin.ModelAdmin.message_user(request, f"Ошибка обработки файла {audio_file.name}: {e}", messages.ERROR)
 
                 if success_count > 0:
-                    self.message_user(request, f"Успешно загружено и обработано {success_count} треков.", messages.SUCCESS)
+                    self.message_user(request, f"Успешно загружено {success_count} треков. Эмбеддинги поставлены в очередь.", messages.SUCCESS)
                 if error_files:
                     self.message_user(request, f"Не удалось обработать следующие файлы: {', '.join(error_files)}", messages.WARNING)
 
@@ -131,12 +126,38 @@ class PlaylistAdmin(admin.ModelAdmin):
 
 @admin.register(Recommendation)
 class RecommendationAdmin(admin.ModelAdmin):
-    list_display = ('source_track', 'recommended_track', 'score', 'created_at')
+    list_display = ('source_track', 'rank', 'recommended_track', 'score', 'build_id', 'created_at')
+    list_select_related = ('source_track', 'recommended_track')
     search_fields = ('source_track__title', 'recommended_track__title')
 
+    def changelist_view(self, request, extra_context=None):
+        from .recommendations import recommendation_cache
+        total = recommendation_cache.stats()['total']
+        self.message_user(
+            request,
+            f"Кеш рекомендаций: попаданий в памяти процесса: {total['local_hits']}, в общем кеше: {total['shared_hits']}, "
+            f"ожиданий чужого расчета: {total['coalesced']}, промахов: {total['misses']}, доля попаданий: {total['hit_rate']}",
+            messages.INFO,
+        )
+        from .candidate_filter import filter_stats
+        stats = filter_stats()
+        self.message_user(
+            request,
+            f"Фильтр кандидатов: вызовов: {stats['calls']}, раундов (раунды: вызовы): {stats['rounds']}, "
+            f"в среднем: {stats['mean_rounds']}, остановок по бюджету времени: {stats['budget_stops']}",
+            messages.INFO,
+        )
+        return super().changelist_view(request, extra_context)
+
+@admin.register(CoLikeSimilarity)
+class CoLikeSimilarityAdmin(admin.ModelAdmin):
+    list_display = ('source_track', 'rank', 'similar_track', 'score', 'co_likes', 'updated_at')
+    list_select_related = ('source_track', 'similar_track')
+    search_fields = ('source_track__title', 'similar_track__title')
+
 @admin.register(TrainingJob)
 class TrainingJobAdmin(admin.ModelAdmin):
-    list_display = ('id', 'status', 'started_at', 'finished_at', 'created_at')
+    list_display = ('id', 'status', 'parameters', 'started_at', 'finished_at', 'created_at')
     list_filter = ('status',)
     readonly_fields = ('started_at', 'finished_at', 'logs', 'created_at') # Эти поля обычно изменяются программно
 
@@ -159,12 +180,83 @@ class LikeDislikeAdmin(admin.ModelAdmin):
 
 @admin.register(AnnoyIndexStatus)
 class AnnoyIndexStatusAdmin(admin.ModelAdmin):
-    list_display = ('needs_rebuild', 'last_build_time')
+    list_display = ('needs_rebuild', 'last_build_time', 'active_model_name', 'active_preprocessing_version')
+    readonly_fields = ('active_model_name', 'active_preprocessing_version')
     # Запрещаем добавление/удаление, т.к. запись должна быть одна
     def has_add_permission(self, request):
         return AnnoyIndexStatus.objects.count() == 0
     def has_delete_permission(self, request, obj=None):
         return False
 
+@admin.register(EmbeddingJob)
+class EmbeddingJobAdmin(admin.ModelAdmin):
+    list_display = ('track', 'status', 'attempts', 'locked_by', 'locked_until', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('track__title', 'track__artist', 'last_error')
+    readonly_fields = ('track', 'attempts', 'last_error', 'locked_by', 'locked_until', 'created_at', 'updated_at')
+    actions = ['requeue_jobs']
+
+    @admin.action(description='Поставить повторно в очередь')
+    def requeue_jobs(self, request, queryset):
+        from .embedding_queue import enqueue_embedding
+        for job in queryset.select_related('track'):
+            enqueue_embedding(job.track)
+        self.message_user(request, f"Повторно поставлено в очередь: {queryset.count()}", messages.SUCCESS)
+
+@admin.register(TrackEmbedding)
+class TrackEmbeddingAdmin(admin.ModelAdmin):
+    list_display = ('track', 'model_name', 'preprocessing_version', 'updated_at')
+    list_filter = ('model_name', 'preprocessing_version')
+    list_select_related = ('track',)
+    search_fields = ('track__title', 'track__artist')
+    readonly_fields = ('track', 'model_name', 'preprocessing_version', 'embedding', 'created_at', 'updated_at')
+
+@admin.register(TrackTombstone)
+class TrackTombstoneAdmin(admin.ModelAdmin):
+    list_display = ('track_id', 'deleted_at')
+    search_fields = ('track_id',)
+    readonly_fields = ('track_id', 'deleted_at')
+
+@admin.register(EmbeddingCacheEntry)
+class EmbeddingCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'model_name', 'preprocessing_version', 'hit_count', 'last_used_at', 'created_at')
+    list_filter = ('model_name', 'preprocessing_version')
+    search_fields = ('content_hash',)
+    readonly_fields = ('content_hash', 'model_name', 'preprocessing_version', 'embedding', 'hit_count', 'created_at', 'last_used_at')
+
+    def changelist_view(self, request, extra_context=None):
+        from .embedding_cache import embedding_cache_stats
+        stats = embedding_cache_stats()
+        self.message_user(request, f"Кеш эмбеддингов: {stats['entries']} записей, попаданий: {stats['hits']}, промахов: {stats['misses']}", messages.INFO)
+        return super().changelist_view(request, extra_context)
+
+@admin.register(TextQueryEmbedding)
+class TextQueryEmbeddingAdmin(admin.ModelAdmin):
+    list_display = ('query', 'model_name', 'hit_count', 'last_used_at', 'created_at')
+    list_filter = ('model_name',)
+    search_fields = ('query',)
+    ordering = ('-hit_count',)
+    readonly_fields = ('query', 'model_name', 'embedding', 'hit_count', 'created_at', 'last_used_at')
+
+    def changelist_view(self, request, extra_context=None):
+        from .text_search import embedding_latency
+        latency = embedding_latency.stats()
+        self.message_user(
+            request,
+            "Эмбеддинг запроса (этот процесс): " + ", ".join(
+                f"{source}: {stats['count']} запросов, p50 {stats['p50_ms']} мс, p95 {stats['p95_ms']} мс"
+                for source, stats in latency.items()
+            ),
+            messages.INFO,
+        )
+        return super().changelist_view(request, extra_context)
+
 # Регистрируем кастомную модель User с кастомным админ-классом
 admin.site.register(User, UserAdmin)
+
+@admin.register(UserTasteVector)
+class UserTasteVectorAdmin(admin.ModelAdmin):
+    list_display = ('user', 'like_count', 'dislike_count', 'model_name', 'version', 'updated_at')
+    list_select_related = ('user',)
+    search_fields = ('user__email', 'user__username')
+    readonly_fields = ('user', 'model_name', 'preprocessing_version', 'like_sum', 'dislike_sum', 'like_count', 'dislike_count', 'version', 'updated_at')
@@ -0,0 +1,374 @@
+# core/als.py
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .item_map import (
+    ItemMap, cleanup_builds, live_holder_builds, manifest_mtime, new_build_id, read_manifest, register_holder,
+    write_manifest,
+)
+from .models import LikeDislike, TrainingJob
+
+logger = logging.getLogger(__name__)
+
+# --- Латентные факторы пользователей и треков (implicit ALS) ---
+# Голоса - неявная обратная связь (Hu, Koren, Volinsky): предпочтение p = 1 для лайка и 0 для дизлайка,
+# уверенность c = 1 + ALS_ALPHA * вес (ALS_DISLIKE_CONFIDENCE для дизлайка). Шаг ALS для строки u:
+#   (Y^T Y + sum_i (c_ui - 1) y_i y_i^T + reg * I) x_u = sum_i c_ui p_ui y_i
+# Y^T Y считается один раз за шаг (BLAS), остальное - пачками строк с суммарно не больше
+# ALS_BLOCK_MEMORY_MB памяти под произведения y_i y_i^T; системы пачки решаются одним вызовом np.linalg.solve.
+# Строка с большим числом голосов (популярный трек) считается отдельно одним матричным умножением.
+#
+# Обучение запускается через TrainingJob (parameters['job'] == 'als'): задача в статусе pending
+# выполняется планировщиком (в отдельном процессе train_als --pending, см. core/jobs.py) или командой train_als,
+# время этапов пишется в logs. Задача, которая выполняется дольше ALS_JOB_TIMEOUT_MINUTES (процесс упал или был
+# перезапущен), помечается как failed (recover_stale_jobs), иначе плановое переобучение не ставилось бы никогда.
+# Факторы сохраняются сборкой в ALS_MODEL_DIR (как сборки индекса, см. core/item_map.py):
+#   <build_id>.users.npy, <build_id>.tracks.npy - матрицы факторов float32 (np.load с mmap)
+#   <build_id>.users.imap, <build_id>.tracks.imap - строка матрицы <-> ID пользователя / трека
+# и публикуются атомарной заменой манифеста current.json; процессы подхватывают новую сборку без перезапуска.
+
+JOB_NAME = 'als'
+
+
+def _job_parameters(overrides=None):
+    parameters = {
+        'job': JOB_NAME,
+        'factors': settings.ALS_FACTORS,
+        'iterations': settings.ALS_ITERATIONS,
+        'regularization': settings.ALS_REGULARIZATION,
+        'alpha': settings.ALS_ALPHA,
+        'dislike_confidence': settings.ALS_DISLIKE_CONFIDENCE,
+    }
+    parameters.update(overrides or {})
+    return parameters
+
+
+def load_vote_matrix(alpha, dislike_confidence):
+    """
+    Голоса как csr-матрица пользователь x трек: |значение| = c - 1, знак - предпочтение (+ лайк, - дизлайк).
+    :return: (матрица, ID пользователей по строкам, ID треков по столбцам)
+    """
+    from scipy import sparse # scipy импортируется только задачей, не веб-процессом
+    votes = np.array(list(LikeDislike.objects.values_list('user_id', 'track_id', 'vote')), dtype=np.int64).reshape(-1, 3)
+    user_ids, rows = np.unique(votes[:, 0], return_inverse=True)
+    track_ids, cols = np.unique(votes[:, 1], return_inverse=True)
+    values = np.where(votes[:, 2] == LikeDislike.LIKE, alpha, -alpha * dislike_confidence).astype(np.float32)
+    matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(user_ids), len(track_ids)))
+    matrix.sort_indices()
+    return matrix, user_ids, track_ids
+
+
+def _block_rows(indptr, start, max_nnz):
+    """Конец пачки строк от start: суммарно не больше max_nnz голосов (минимум одна строка)."""
+    end = int(np.searchsorted(indptr, indptr[start] + max_nnz, side='right')) - 1
+    return min(max(end, start + 1), len(indptr) - 1)
+
+
+def solve_factors(matrix, other, regularization, block_memory_mb=None):
+    """
+    Один шаг ALS: факторы строк matrix при фиксированных факторах столбцов other.
+    :param matrix: csr (строки x столбцы), значения как в load_vote_matrix
+    :return: np.ndarray float32 (строки x факторы)
+    """
+    block_memory_mb = block_memory_mb or settings.ALS_BLOCK_MEMORY_MB
+    n_rows, factors = matrix.shape[0], other.shape[1]
+    gram = (other.T @ other).astype(np.float64) + regularization * np.eye(factors)
+    # Память пачки: произведения y_i y_i^T float32 по одному на голос
+    max_nnz = max(int(block_memory_mb * 1024 * 1024 // (factors * factors * 4)), 1)
+    indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+    result = np.zeros((n_rows, factors), dtype=np.float32)
+    start = 0
+    while start < n_rows:
+        end = _block_rows(indptr, start, max_nnz)
+        lo, hi = indptr[start], indptr[end]
+        vectors = other[indices[lo:hi]]
+        confidence = np.abs(data[lo:hi]) # c - 1
+        target = np.where(data[lo:hi] > 0, confidence + 1, 0).astype(np.float32) # c * p
+        counts = np.diff(indptr[start:end + 1])
+        filled = counts > 0
+        if hi - lo > max_nnz:
+            # Одна строка больше пачки: без тензора произведений, одним матричным умножением
+            a = gram + (vectors * confidence[:, None]).T @ vectors
+            result[start] = np.linalg.solve(a, vectors.T @ target)
+        elif filled.any():
+            offsets = (indptr[start:end] - lo)[filled]
+            outer = (vectors * confidence[:, None])[:, :, None] * vectors[:, None, :]
+            a = np.broadcast_to(gram, (int(filled.sum()), factors, factors)).copy()
+            a += np.add.reduceat(outer, offsets, axis=0)
+            b = np.add.reduceat(vectors * target[:, None], offsets, axis=0)
+            rows = np.arange(start, end)[filled]
+            result[rows] = np.linalg.solve(a, b[..., None])[..., 0]
+        start = end
+    return result
+
+
+def train_als(matrix, factors, iterations, regularization, log=None, seed=0):
+    """
+    Обучает факторы пользователей и треков попеременными шагами ALS.
+    :return: (факторы пользователей, факторы треков), float32
+    """
+    from threadpoolctl import threadpool_limits
+    rng = np.random.default_rng(seed)
+    item_factors = (rng.standard_normal((matrix.shape[1], factors)) * 0.01).astype(np.float32)
+    transposed = matrix.T.tocsr()
+    transposed.sort_indices()
+    user_factors = np.zeros((matrix.shape[0], factors), dtype=np.float32)
+    # Y^T Y, матричные умножения и решения систем идут через многопоточный BLAS/LAPACK (None - все ядра)
+    with threadpool_limits(limits=settings.ALS_BLAS_THREADS, user_api='blas'):
+        for iteration in range(1, iterations + 1):
+            started = time.perf_counter()
+            user_factors = solve_factors(matrix, item_factors, regularization)
+            item_factors = solve_factors(transposed, user_factors, regularization)
+            if log:
+                log(f"Iteration {iteration}/{iterations}", started)
+    return user_factors, item_factors
+
+
+# --- Сборки факторов ---
+
+def factor_paths(model_dir, build_id):
+    """Пути к файлам сборки: (факторы пользователей, факторы треков, карта пользователей, карта треков)."""
+    return tuple(
+        os.path.join(model_dir, f"{build_id}.{name}")
+        for name in ('users.npy', 'tracks.npy', 'users.imap', 'tracks.imap')
+    )
+
+
+def publish_factors(user_factors, item_factors, user_ids, track_ids, job_id=None, model_dir=None):
+    """Сохраняет факторы новой сборкой и делает ее текущей (атомарная замена манифеста)."""
+    model_dir = str(model_dir or settings.ALS_MODEL_DIR)
+    os.makedirs(model_dir, exist_ok=True)
+    build_id = new_build_id()
+    users_path, tracks_path, users_map_path, tracks_map_path = factor_paths(model_dir, build_id)
+    np.save(users_path, np.ascontiguousarray(user_factors, dtype=np.float32))
+    np.save(tracks_path, np.ascontiguousarray(item_factors, dtype=np.float32))
+    ItemMap.from_track_ids(user_ids, build_id).save(users_map_path)
+    ItemMap.from_track_ids(track_ids, build_id).save(tracks_map_path)
+    previous = read_manifest(model_dir)
+    manifest = {
+        'build_id': build_id,
+        'factors': int(user_factors.shape[1]),
+        'users': len(user_ids),
+        'tracks': len(track_ids),
+        'job_id': job_id,
+        'built_at': timezone.now().isoformat(),
+    }
+    write_manifest(model_dir, manifest)
+    # Предыдущую сборку оставляем: процесс мог прочитать старый манифест и еще не открыть файлы
+    keep = {build_id, previous['build_id'] if previous else None} | live_holder_builds(model_dir)
+    cleanup_builds(model_dir, keep - {None})
+    return manifest
+
+
+# --- Задачи обучения ---
+
+def create_training_job(**overrides):
+    """Ставит обучение в очередь: TrainingJob в статусе pending с параметрами из настроек (и overrides)."""
+    return TrainingJob.objects.create(parameters=_job_parameters(overrides), status='pending')
+
+
+def run_training_job(job):
+    """Выполняет задачу обучения ALS: статус, время начала и окончания и время этапов записываются в job."""
+    parameters = _job_parameters(job.parameters)
+    job.parameters = parameters
+    job.status = 'running'
+    job.started_at = timezone.now()
+    job.save(update_fields=['parameters', 'status', 'started_at'])
+    log_lines = []
+
+    def log(message, started):
+        line = f"{message} ({time.perf_counter() - started:.3f}s)"
+        log_lines.append(line)
+        logger.info(f"ALS job {job.pk}: {line}")
+
+    try:
+        started = time.perf_counter()
+        matrix, user_ids, track_ids = load_vote_matrix(parameters['alpha'], parameters['dislike_confidence'])
+        log(f"Loaded {matrix.nnz} votes: {len(user_ids)} users x {len(track_ids)} tracks", started)
+        if not matrix.nnz:
+            raise ValueError("No votes to train on")
+
+        started = time.perf_counter()
+        user_factors, item_factors = train_als(
+            matrix, int(parameters['factors']), int(parameters['iterations']), float(parameters['regularization']), log=log,
+        )
+        log(f"Trained {parameters['factors']} factors", started)
+
+        started = time.perf_counter()
+        manifest = publish_factors(user_factors, item_factors, user_ids, track_ids, job_id=job.pk)
+        log(f"Published build {manifest['build_id']}", started)
+        job.status = 'completed'
+    except Exception as e:
+        logger.error(f"ALS job {job.pk} failed: {e}", exc_info=True)
+        log_lines.append(f"Error: {e}")
+        job.status = 'failed'
+    job.finished_at = timezone.now()
+    job.logs = '\n'.join(log_lines)
+    job.save(update_fields=['status', 'finished_at', 'logs'])
+    return job
+
+
+def has_pending_jobs():
+    return TrainingJob.objects.filter(status='pending', parameters__job=JOB_NAME).exists()
+
+
+def recover_stale_jobs(timeout_minutes=None):
+    """
+    Помечает как failed задачи ALS, которые выполняются дольше timeout_minutes (процесс обучения упал,
+    был перезапущен или убит по таймауту): без этого schedule_training больше не ставил бы обучение.
+    :return: количество помеченных задач
+    """
+    timeout_minutes = timeout_minutes or settings.ALS_JOB_TIMEOUT_MINUTES
+    now = timezone.now()
+    cutoff = now - timedelta(minutes=timeout_minutes)
+    stale = TrainingJob.objects.filter(status='running', parameters__job=JOB_NAME).filter(
+        Q(started_at__lt=cutoff) | Q(started_at__isnull=True, created_at__lt=cutoff)
+    )
+    count = stale.update(
+        status='failed', finished_at=now,
+        logs=f"Error: no result after {timeout_minutes} minutes (training process died, was restarted or timed out)",
+    )
+    if count:
+        logger.warning(f"Marked {count} stale ALS training jobs as failed.")
+    return count
+
+
+def claim_pending_job():
+    """Забирает самую старую задачу ALS в статусе pending (другой процесс ее уже не возьмет) или None."""
+    with transaction.atomic():
+        job = (
+            TrainingJob.objects.select_for_update()
+            .filter(status='pending', parameters__job=JOB_NAME)
+            .order_by('created_at').first()
+        )
+        if job is None:
+            return None
+        job.status = 'running'
+        job.started_at = timezone.now() # С этого момента идет срок ALS_JOB_TIMEOUT_MINUTES
+        job.save(update_fields=['status', 'started_at'])
+    return job
+
+
+def run_pending_training_jobs():
+    """Задача планировщика: выполняет задачи обучения ALS из очереди. :return: количество выполненных"""
+    recover_stale_jobs()
+    processed = 0
+    while (job := claim_pending_job()) is not None:
+        run_training_job(job)
+        processed += 1
+    return processed
+
+
+def schedule_training():
+    """Задача планировщика: ставит плановое переобучение, если в очереди его еще нет."""
+    recover_stale_jobs()
+    if not TrainingJob.objects.filter(status__in=['pending', 'running'], parameters__job=JOB_NAME).exists():
+        create_training_job()
+
+
+# --- Выдача по факторам ---
+
+class FactorSnapshot:
+    """Факторы и карты одной сборки (после создания не меняются)."""
+
+    def __init__(self, user_factors=None, item_factors=None, user_map=None, track_map=None, build_id=None):
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.user_map = user_map or ItemMap.empty()
+        self.track_map = track_map or ItemMap.empty()
+        self.build_id = build_id
+
+    @classmethod
+    def load(cls, model_dir, build_id):
+        """Открывает файлы сборки через mmap и проверяет, что факторы и карты согласованы."""
+        users_path, tracks_path, users_map_path, tracks_map_path = factor_paths(model_dir, build_id)
+        user_factors = np.load(users_path, mmap_mode='r')
+        item_factors = np.load(tracks_path, mmap_mode='r')
+        user_map, track_map = ItemMap.load(users_map_path), ItemMap.load(tracks_map_path)
+        if len(user_map) != len(user_factors) or len(track_map) != len(item_factors):
+            raise ValueError(f"Factor/map size mismatch in ALS build {build_id}")
+        return cls(user_factors, item_factors, user_map, track_map, build_id)
+
+
+class FactorService:
+    """Текущая сборка факторов ALS с горячей заменой (как у индекса похожих треков) и выдача top-K по скалярному произведению."""
+
+    def __init__(self, model_dir=settings.ALS_MODEL_DIR, reload_interval=settings.ANNOY_RELOAD_CHECK_INTERVAL):
+        self.model_dir = str(model_dir)
+        self.reload_interval = reload_interval
+        self._snapshot = FactorSnapshot()
+        self._reload_lock = threading.Lock()
+        self._manifest_mtime = None
+        self._next_check = 0.0
+
+    build_id = property(lambda self: self._snapshot.build_id)
+
+    def _load(self):
+        """
+        Загружает сборку из манифеста. mtime манифеста запоминается только после успешной загрузки
+        (или если публиковать еще нечего): при ошибке refresh повторит попытку.
+        """
+        mtime = manifest_mtime(self.model_dir)
+        try:
+            manifest = read_manifest(self.model_dir)
+            if not manifest or not manifest.get('build_id'):
+                self._manifest_mtime = mtime
+                return False
+            snapshot = FactorSnapshot.load(self.model_dir, manifest['build_id'])
+        except Exception as e:
+            logger.error(f"Failed to load ALS factors from {self.model_dir}: {e}", exc_info=True)
+            return False
+        self._snapshot = snapshot
+        self._manifest_mtime = mtime
+        register_holder(self.model_dir, snapshot.build_id)
+        return True
+
+    def refresh(self):
+        """
+        Переключается на новую опубликованную сборку (stat манифеста не чаще reload_interval).
+        :return: build_id текущей сборки или None
+        """
+        now = time.monotonic()
+        if now >= self._next_check and self._reload_lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.reload_interval
+                if manifest_mtime(self.model_dir) != self._manifest_mtime:
+                    previous_build = self.build_id
+                    if self._load() and self.build_id != previous_build:
+                        logger.info(f"ALS factors hot-swapped: {previous_build} -> {self.build_id}")
+            finally:
+                self._reload_lock.release()
+        return self.build_id
+
+    def top_tracks(self, user_id, k):
+        """
+        k треков с наибольшим скалярным произведением факторов пользователя и трека.
+        :return: список (ID трека, оценка) по убыванию оценки; пустой, если пользователя нет в сборке
+        """
+        self.refresh()
+        snapshot = self._snapshot
+        row = snapshot.user_map.slot_for_track(user_id)
+        if row is None or not len(snapshot.track_map):
+            return []
+        scores = np.asarray(snapshot.item_factors @ snapshot.user_factors[row])
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return list(zip(snapshot.track_map.track_ids(top), scores[top].tolist()))
+
+    def recommend(self, user_id, n=10, exclusions=None):
+        """До n ID треков по факторам пользователя без треков из exclusions (по умолчанию - его голоса)."""
+        from .candidate_filter import filter_candidates, user_vote_exclusions
+        exclusions = exclusions if exclusions is not None else user_vote_exclusions(user_id, 'all')
+        result = filter_candidates(lambda k: [track_id for track_id, _ in self.top_tracks(user_id, k)], n, exclusions)
+        return result.ids
+
+
+factor_service = FactorService()
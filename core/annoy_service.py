@@ -1,194 +1,568 @@
 # core/annoy_service.py
 import logging
 import os
-import json
-from annoy import AnnoyIndex
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
 from django.conf import settings
-from .models import Track
+from django.utils import timezone
+from .item_map import (
+    ItemMap, build_paths, cleanup_builds, new_build_id, read_manifest, write_manifest, manifest_mtime,
+    register_holder, live_holder_builds,
+)
+from .embedding_codec import as_float32
+from .embedding_store import EmbeddingSpace, active_space, embeddings_in_space, get_track_embedding
+from .models import AnnoyIndexStatus
+from .delta_index import DeltaIndex
+from .genre_partitions import GenrePartitions, build_genre_partitions
+from .tombstones import TombstoneSet, prune_tombstones
+from .vector_backends import ExactBackend, get_backend_class, select_backend
+from .vector_matrix import VectorMatrixWriter, load_vector_matrix, vectors_path
 
 logger = logging.getLogger(__name__)
 
+# Результат пакетного поиска: соседи каждого исходного трека и общий объединенный список
+NeighborsBatch = namedtuple('NeighborsBatch', ['per_seed', 'fused'])
+
+# Константа reciprocal rank fusion: вклад позиции r в общий список равен 1 / (FUSION_RANK_CONSTANT + r)
+FUSION_RANK_CONSTANT = 60
+
+
+def fuse_rankings(rankings, n, exclude=()):
+    """
+    Объединяет несколько ранжированных списков ID в один (reciprocal rank fusion):
+    трек, который близок к нескольким исходным трекам, поднимается выше.
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, track_id in enumerate(ranking, start=1):
+            if track_id not in exclude:
+                scores[track_id] += 1.0 / (FUSION_RANK_CONSTANT + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:n]
+
+
+class IndexSnapshot:
+    """
+    Индекс (бэкенд поиска, см. core/vector_backends.py) и карта слотов одной сборки. После создания не меняется:
+    запрос, который уже взял снимок, дорабатывает на нем, даже если сервис переключился на новую сборку.
+    """
+
+    def __init__(self, index, item_map, build_id=None, index_path=None, map_path=None, backend_name=None, partitions=None,
+                 vectors=None):
+        self.index = index
+        self.item_map = item_map
+        self.build_id = build_id
+        self.backend_name = backend_name
+        self.index_path = index_path
+        self.map_path = map_path
+        self.partitions = partitions or GenrePartitions() # Разделы сборки по жанрам
+        self.vectors = vectors # Матрица векторов по слотам (mmap) или None, см. core/vector_matrix.py
+
+    @property
+    def is_loaded(self):
+        return self.build_id is not None
+
+    @classmethod
+    def empty(cls, dimension, metric):
+        return cls(ExactBackend(dimension, metric), ItemMap.empty())
+
+    @classmethod
+    def load(cls, index_dir, build_id, dimension, metric, backend_name='annoy', genres=None):
+        """Открывает файлы сборки (mmap) и проверяет, что индекс и карта из одной сборки."""
+        backend_class = get_backend_class(backend_name)
+        index_path, map_path = build_paths(index_dir, build_id, backend_class.file_extension)
+        index = backend_class.load(index_path, dimension, metric) # mmap, страницы общие для всех процессов
+        item_map = ItemMap.load(map_path)
+        if item_map.build_id != build_id or len(item_map) != index.get_n_items():
+            raise ValueError(
+                f"Index/map mismatch: map build {item_map.build_id} ({len(item_map)} items), "
+                f"manifest build {build_id} ({index.get_n_items()} items)"
+            )
+        partitions = GenrePartitions(index_dir, build_id, dimension, metric, genres)
+        vectors = index.vector_matrix()
+        if vectors is None:
+            vectors = load_vector_matrix(index_dir, build_id, len(item_map))
+        return cls(index, item_map, build_id, index_path, map_path, backend_name, partitions, vectors)
+
+
 class AnnoyService:
+    """
+    Сборки индекса похожих треков и поиск по ним. Сам поиск выполняет бэкенд из core/vector_backends.py
+    (Annoy - один из них); имя сервиса сохранено, потому что его используют представления и задачи.
+    """
+
     def __init__(self, dimension=settings.ANNOY_EMBEDDING_DIM, metric=settings.ANNOY_METRIC,
-                 index_path=settings.ANNOY_INDEX_PATH, map_path=settings.ANNOY_ITEM_MAP_PATH):
+                 index_dir=settings.ANNOY_INDEX_DIR, reload_interval=settings.ANNOY_RELOAD_CHECK_INTERVAL):
         self.dimension = dimension
         self.metric = metric
-        self.index_path = str(index_path)
-        self.map_path = str(map_path) # Путь к файлу карты
-        self.index = AnnoyIndex(self.dimension, self.metric)
-        self.is_loaded = False
-        self.item_map = {} # Annoy index -> Track PK
+        self.index_dir = str(index_dir) # Каталог со сборками индекса и манифестом current.json
+        self.reload_interval = reload_interval # Как часто (сек) проверять, не опубликована ли новая сборка
+        self._snapshot = IndexSnapshot.empty(dimension, metric)
+        self._reload_lock = threading.Lock()
+        self._manifest_mtime = None
+        self._space = None # Пространство эмбеддингов обслуживаемой сборки (из манифеста)
+        self._next_check = 0.0
+        self._executor = None # Пул потоков для пакетных запросов (создается при первом использовании)
+        self._executor_lock = threading.Lock()
+        self.delta = DeltaIndex(dimension) # Эмбеддинги, посчитанные после начала построения текущей сборки
+        self.tombstones = TombstoneSet() # Удаленные треки, которые еще есть в сборке или дельте
         self._load_index()
 
+    # Текущий снимок; чтение атрибута атомарно, поэтому замена снимка не блокирует запросы
+    index = property(lambda self: self._snapshot.index)
+    item_map = property(lambda self: self._snapshot.item_map) # Слот Annoy <-> Track PK
+    build_id = property(lambda self: self._snapshot.build_id)
+    backend_name = property(lambda self: self._snapshot.backend_name) # Бэкенд поиска текущей сборки
+    index_path = property(lambda self: self._snapshot.index_path) # Файл .ann текущей сборки
+    map_path = property(lambda self: self._snapshot.map_path) # Файл .imap текущей сборки
+    is_loaded = property(lambda self: self._snapshot.is_loaded)
+
+    def _swap(self, snapshot):
+        """Подменяет снимок (старый освободится, когда его отпустят запросы в полете)."""
+        self._snapshot = snapshot
+        if snapshot.build_id:
+            register_holder(self.index_dir, snapshot.build_id)
+
+    def _reset_delta(self, manifest):
+        """Сбрасывает дельту под сборку из манифеста: в ней останутся только эмбеддинги новее начала построения."""
+        self.tombstones.reset() # Надгробия треков, не попавших в сборку, могли быть удалены
+        if not manifest:
+            # Сборок еще не было: дельта берет последние эмбеддинги активного пространства
+            self._space = None
+            self.delta.reset(None, None)
+            return
+        since = manifest.get('embeddings_since') or manifest.get('built_at')
+        self._space = EmbeddingSpace(manifest['model_name'], manifest['preprocessing_version'])
+        self.delta.reset(self._space, datetime.fromisoformat(since) if since else None)
+
+    @property
+    def space(self):
+        """Пространство эмбеддингов, по которому идет поиск (до первой сборки - активное)."""
+        return self._space or active_space()
+
     def _load_index(self):
-        """Пытается загрузить индекс и карту item_map из файлов."""
-        if os.path.exists(self.index_path) and os.path.exists(self.map_path):
-            try:
-                self.index.load(self.index_path)
-                # Загружаем карту из JSON
-                with open(self.map_path, 'r') as f:
-                    # Ключи в JSON - строки, конвертируем обратно в int
-                    loaded_map_str_keys = json.load(f)
-                    self.item_map = {int(k): v for k, v in loaded_map_str_keys.items()}
-                self.is_loaded = True
-                logger.info(f"Annoy index ({self.index.get_n_items()} items) and item map ({len(self.item_map)} items) loaded successfully.")
-            except Exception as e:
-                logger.error(f"Failed to load Annoy index/map: {e}", exc_info=True)
-                self.index = AnnoyIndex(self.dimension, self.metric)
-                self.item_map = {}
-                self.is_loaded = False
-        else:
-            logger.warning(f"Annoy index file ({self.index_path}) or map file ({self.map_path}) not found. Starting empty.")
-            self.is_loaded = False
-
-    def build_index_from_db(self, num_trees=settings.ANNOY_NUM_TREES):
-        """Строит индекс Annoy и сохраняет его вместе с картой item_map."""
-        logger.info("Starting to build Annoy index from database...")
-        self.index = AnnoyIndex(self.dimension, self.metric)
-        self.item_map = {}
-        annoy_idx_counter = 0
-
-        # Получаем все треки с непустыми эмбеддингами
-        tracks_with_embeddings = Track.objects.exclude(embedding__isnull=True).exclude(embedding__exact='null') # JSON 'null'
-
-        if not tracks_with_embeddings.exists():
-            logger.warning("No tracks with embeddings found in the database. Annoy index will be empty.")
-            # Очищаем старые файлы, если они есть
-            if os.path.exists(self.index_path): os.remove(self.index_path)
-            if os.path.exists(self.map_path): os.remove(self.map_path)
+        """
+        Пытается загрузить индекс и карту item_map текущей сборки (по манифесту).
+        mtime манифеста запоминается только после успешной загрузки: при ошибке refresh_if_stale повторит попытку.
+        """
+        mtime = manifest_mtime(self.index_dir)
+        try:
+            manifest = read_manifest(self.index_dir)
+        except Exception as e:
+            logger.error(f"Failed to read Annoy manifest in {self.index_dir}: {e}", exc_info=True)
+            return False
+        if not manifest or not manifest.get('build_id'):
+            logger.warning(f"No Annoy index build published in {self.index_dir}. Starting empty.")
+            self._swap(IndexSnapshot.empty(self.dimension, self.metric))
+            self._reset_delta(manifest)
+            self._manifest_mtime = mtime
+            return False
+
+        try:
+            snapshot = IndexSnapshot.load(
+                self.index_dir, manifest['build_id'], self.dimension, self.metric,
+                backend_name=manifest.get('backend', 'annoy'), # Манифесты до появления бэкендов - Annoy
+                genres=manifest.get('genres'),
+            )
+        except Exception as e:
+            logger.error(f"Failed to load Annoy index/map build {manifest['build_id']}: {e}", exc_info=True)
+            return False
+        self._swap(snapshot)
+        self._reset_delta(manifest)
+        self._manifest_mtime = mtime
+        logger.info(f"Index build {snapshot.build_id} ({snapshot.backend_name}, {snapshot.index.get_n_items()} items) and item map loaded successfully.")
+        return True
+
+    def refresh_if_stale(self, force=False):
+        """
+        Переключается на новую опубликованную сборку, если она появилась.
+        Проверка дешевая (stat манифеста, не чаще reload_interval); загрузку выполняет один поток,
+        остальные в это время продолжают искать по текущему снимку.
+        :return: True, если сборка сменилась.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = now + self.reload_interval
+            mtime = manifest_mtime(self.index_dir)
+            if mtime == self._manifest_mtime:
+                return False
+            previous_build = self.build_id
+            changed = self._load_index() and self.build_id != previous_build
+            if changed:
+                logger.info(f"Annoy index hot-swapped: {previous_build} -> {self.build_id}")
+            return changed
+        finally:
+            self._reload_lock.release()
+
+    def refresh(self):
+        """
+        Дешевые проверки перед поиском: новая сборка, свежие эмбеддинги (дельта), удаленные треки.
+        :return: версия данных, по которым будет идти поиск (для ключей кеша результатов)
+        """
+        self.refresh_if_stale()
+        self.delta.refresh()
+        self.tombstones.refresh()
+        return self.data_version
+
+    @property
+    def data_version(self):
+        """Версия данных поиска: сборка + дельта + удаленные треки. Новая сборка меняет ее всегда."""
+        return f"{self.build_id or 'none'}-{self.delta.version}-{self.tombstones.version}"
+
+    def _publish_build(self, build_id, item_count, space, started_at, backend_name=None, genres=None):
+        """
+        Делает сборку текущей (атомарная замена манифеста) и удаляет сборки, которые никто не держит.
+        :return: записанный манифест
+        """
+        previous = read_manifest(self.index_dir)
+        manifest = {
+            'build_id': build_id,
+            'items': item_count,
+            'backend': backend_name,
+            'genres': genres or {}, # Разделы по жанрам: {genre_id: {'backend': ..., 'items': ...}}
+            'model_name': space.model_name,
+            'preprocessing_version': space.preprocessing_version,
+            # Эмбеддинги, записанные после этого момента, могли не попасть в сборку: их отдает дельта
+            'embeddings_since': started_at.isoformat(),
+            'built_at': timezone.now().isoformat(),
+        }
+        write_manifest(self.index_dir, manifest)
+        # Предыдущую сборку оставляем: процесс мог прочитать старый манифест и еще не открыть файлы
+        keep = {build_id, previous['build_id'] if previous else None} | live_holder_builds(self.index_dir)
+        cleanup_builds(self.index_dir, keep - {None})
+        return manifest
+
+    def build_index_from_db(self, num_trees=settings.ANNOY_NUM_TREES, space=None, backend=None):
+        """
+        Строит индекс и сохраняет его вместе с картой item_map (новая сборка со своим build_id).
+        :param space: Пространство эмбеддингов (модель + препроцессинг); по умолчанию активное.
+        :param backend: Имя бэкенда поиска (по умолчанию settings.VECTOR_BACKEND; 'auto' - по размеру каталога).
+        """
+        space = space or active_space()
+        started_at = timezone.now() # До чтения БД: все, что записано позже, дочитает дельта
+        # Набор сборки фиксируется моментом started_at: эмбеддинги, записанные во время построения,
+        # не меняют число строк между count() и чтением (по нему заранее размечены файлы сборки)
+        tracks_with_embeddings = embeddings_in_space(space).filter(updated_at__lt=started_at).order_by('track_id')
+        total = tracks_with_embeddings.count()
+        backend_name, backend_class = select_backend(total, backend)
+        logger.info(f"Starting to build {backend_name} index from database (embedding space: {space})...")
+        os.makedirs(self.index_dir, exist_ok=True)
+        build_id = new_build_id()
+        index_path, map_path = build_paths(self.index_dir, build_id, backend_class.file_extension)
+
+        # Новый индекс строится отдельно от текущего снимка, который продолжает обслуживать запросы.
+        # Annoy и exact строятся сразу в файле новой сборки (on-disk build): индекс не держится в памяти процесса.
+        index = backend_class(self.dimension, self.metric)
+        built_on_disk = index.build_on_disk(index_path, max_items=total)
+        # Бэкенду без собственной матрицы векторов сборка пишет ее отдельным файлом (для выборки векторов пачкой)
+        vector_writer = None
+        if index.vector_matrix() is None:
+            vector_writer = VectorMatrixWriter(vectors_path(self.index_dir, build_id), total, self.dimension, self.metric)
+        track_ids = [] # track_ids[slot] = Track PK
+        slot_genres = [] # slot_genres[slot] = ID жанра трека (для разделов по жанрам)
+
+        # Из БД читаются только (track_id, embedding, жанр) пачками по 2000 строк;
+        # векторы приходят как np.ndarray (blob -> frombuffer), без разбора JSON
+        rows = tracks_with_embeddings.values_list('track_id', 'embedding', 'track__genre_id')
+        for track_pk, embedding, genre_id in rows.iterator(chunk_size=2000):
+            if len(track_ids) >= total:
+                # Строк больше, чем при подсчете (транзакция с более ранним updated_at закоммитилась позже):
+                # остальные векторы попадут в следующую сборку
+                logger.warning(f"More embeddings than counted ({total}) while building the index. Stopping at {total}.")
+                AnnoyIndexStatus.request_rebuild("embeddings committed during build")
+                break
+            if embedding is not None and len(embedding) == self.dimension:
+                index.add_item(len(track_ids), embedding)
+                if vector_writer is not None:
+                    vector_writer.add_item(len(track_ids), embedding)
+                track_ids.append(track_pk) # Сохраняем ID трека
+                slot_genres.append(genre_id)
+            else:
+                logger.warning(f"Track ID {track_pk} has invalid or missing embedding. Skipping.")
+
+        if not track_ids:
+            # Публикуем пустой манифест, чтобы процессы не продолжали отдавать устаревший индекс
+            logger.warning("No valid embeddings found to build the index. Publishing an empty index.")
+            if built_on_disk and os.path.exists(index_path):
+                os.remove(index_path)
+            if vector_writer is not None:
+                vector_writer.discard()
+            manifest = self._publish_build(None, 0, space, started_at, backend_name)
+            self._swap(IndexSnapshot.empty(self.dimension, self.metric))
+            self._reset_delta(manifest)
+            prune_tombstones(ItemMap.empty(), started_at)
             return
 
-        # Пересоздаем индекс и карту
-        self.index = AnnoyIndex(self.dimension, self.metric)
-        self.item_map = {}
-        annoy_idx_counter = 0
-        
-        for track in tracks_with_embeddings:
-            embedding = track.embedding
-            if isinstance(embedding, list) and len(embedding) == self.dimension:
-                self.index.add_item(annoy_idx_counter, embedding)
-                self.item_map[annoy_idx_counter] = track.pk # Сохраняем ID трека
-                annoy_idx_counter += 1
+        logger.info(f"Added {len(track_ids)} items to the {backend_name} index. Building (num_trees={num_trees})...")
+        index.build(num_trees=num_trees)
+        logger.info("Index building complete.")
+        try:
+            item_map = ItemMap.from_track_ids(track_ids, build_id=build_id)
+            if not built_on_disk:
+                index.save(index_path) # Файл новой сборки: читатели старой сборки не затрагиваются
+            item_map.save(map_path)
+            vectors = index.vector_matrix()
+            if vector_writer is not None:
+                vector_writer.close()
+                vectors = load_vector_matrix(self.index_dir, build_id, len(track_ids))
+            genres = build_genre_partitions(
+                self.index_dir, build_id, index, track_ids, slot_genres, self.dimension, self.metric,
+                num_trees=num_trees, backend=backend,
+            )
+            manifest = self._publish_build(build_id, len(track_ids), space, started_at, backend_name, genres)
+            partitions = GenrePartitions(self.index_dir, build_id, self.dimension, self.metric, genres)
+            self._swap(IndexSnapshot(index, item_map, build_id, index_path, map_path, backend_name, partitions, vectors))
+            self._reset_delta(manifest)
+            prune_tombstones(item_map, started_at)
+            self._manifest_mtime = manifest_mtime(self.index_dir)
+            logger.info(f"Index build {build_id} ({backend_name}) saved to {index_path} (item map: {map_path})")
+        except Exception as e:
+            logger.error(f"Failed to save index or map: {e}", exc_info=True)
+            raise
+
+    def _resolve_seed_vectors(self, snapshot, track_ids):
+        """
+        Векторы запросов для всех треков за один проход: из дельты (самые свежие), из сборки
+        и одним запросом к БД для остальных.
+        :return: dict track_id -> вектор (треков без валидного эмбеддинга в нем нет)
+        """
+        vectors = {}
+        missing = []
+        for track_id in track_ids:
+            # Вектор из дельты свежее индекса (трек мог быть перепосчитан после сборки)
+            vector = self.delta.vector_for(track_id)
+            if vector is None and snapshot.is_loaded:
+                slot = snapshot.item_map.slot_for_track(track_id) # O(log n) по отсортированной карте
+                if slot is not None:
+                    vector = snapshot.index.get_item_vector(slot)
+            if vector is None:
+                missing.append(track_id)
             else:
-                logger.warning(f"Track ID {track.pk} has invalid or missing embedding. Skipping.")
-
-        if annoy_idx_counter > 0:
-            logger.info(f"Added {annoy_idx_counter} items to the index. Building {num_trees} trees...")
-            self.index.build(num_trees)
-            logger.info("Annoy index building complete.")
-            try:
-                # Сохраняем индекс
-                self.index.save(self.index_path)
-                logger.info(f"Annoy index saved successfully to {self.index_path}")
-                # Сохраняем карту в JSON
-                with open(self.map_path, 'w') as f:
-                    json.dump(self.item_map, f)
-                logger.info(f"Annoy item map saved successfully to {self.map_path}")
-                self.is_loaded = True # Считаем загруженным после успешного построения
-            except Exception as e:
-                logger.error(f"Failed to save Annoy index or map: {e}", exc_info=True)
+                vectors[track_id] = vector
+        if missing:
+            rows = embeddings_in_space(active_space()).filter(track_id__in=missing).values_list('track_id', 'embedding')
+            for track_id, embedding in rows:
+                if embedding is not None and len(embedding) == self.dimension:
+                    vectors[track_id] = as_float32(embedding)
+        return vectors
+
+    def _query_executor(self):
+        """Общий пул потоков для пакетных запросов (Annoy отпускает GIL во время поиска)."""
+        if self._executor is None and settings.ANNOY_QUERY_THREADS > 1:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(settings.ANNOY_QUERY_THREADS, thread_name_prefix='ann-query')
+        return self._executor
+
+    def _search_candidates(self, snapshot, vectors, k, genre_id=None):
+        """
+        Кандидаты из основного индекса и дельты для каждого вектора, слитые по расстоянию.
+        :param genre_id: искать только в разделе этого жанра (и среди треков дельты этого жанра)
+        :return: список (по одному на вектор) списков (track_id, distance) по возрастанию расстояния
+        """
+        delta, index, item_map = self.delta, snapshot.index, snapshot.item_map
+        searchable = snapshot.is_loaded
+        if searchable and genre_id is not None:
+            partition = snapshot.partitions.get(genre_id)
+            searchable = partition is not None # Треков жанра в сборке нет - только дельта
+            if searchable:
+                index, item_map = partition.index, partition.item_map
+        if searchable:
+            executor = self._query_executor() if len(vectors) > 1 else None
+            main_results = index.query_batch(vectors, k, executor=executor)
         else:
-            logger.warning("No valid embeddings found to build the index.")
-            # Очищаем старые файлы, если они есть
-            if os.path.exists(self.index_path): os.remove(self.index_path)
-            if os.path.exists(self.map_path): os.remove(self.map_path)
+            main_results = [([], []) for _ in vectors]
+        delta_results = delta.search_batch(vectors, k, genre_id=genre_id) if len(delta) else [[] for _ in vectors]
 
-    def find_nearest_neighbors(self, track_id, n=10, threshold=settings.ANNOY_DISTANCE_THRESHOLD, min_results=1):
+        results = []
+        for (slots, distances), fresh in zip(main_results, delta_results):
+            # Треки, у которых в дельте более новый вектор, берем из дельты
+            candidates = [
+                (neighbor_id, distance)
+                for neighbor_id, distance in zip(item_map.track_ids(slots), distances)
+                if neighbor_id not in delta
+            ]
+            if fresh:
+                candidates = sorted(candidates + fresh, key=lambda item: item[1])
+            results.append(candidates)
+        return results
+
+    def _rank_neighbors(self, track_id, candidates, n, threshold, min_results, log=True):
         """
-        Находит ближайших соседей для заданного ID трека.
-        Сначала пытается найти до n соседей с расстоянием < threshold.
-        Если найдено меньше min_results, возвращает просто n ближайших соседей без порога.
-        Возвращает список ID треков.
+        Отбирает соседей одного трека из кандидатов (по возрастанию расстояния).
+        Сначала до n соседей с расстоянием < threshold; если их меньше min_results - просто n ближайших.
+        :return: список (track_id, distance)
+        """
+        filtered_neighbors = []
+        for neighbor_track_id, distance in candidates:
+            if distance < threshold:
+                filtered_neighbors.append((neighbor_track_id, distance))
+                logger.debug(f"  [Thresh] Found neighbor: ID {neighbor_track_id}, Dist: {distance:.4f}")
+                if len(filtered_neighbors) >= n:
+                    break
+
+        if log:
+            logger.info(f"Found {len(filtered_neighbors)} neighbors for Track ID {track_id} within threshold {threshold}.")
+
+        # Fallback без порога (если найдено < min_results)
+        if len(filtered_neighbors) < min_results:
+            # Кандидаты уже отсортированы по расстоянию: повторный поиск не нужен
+            if log:
+                logger.warning(f"Found less than {min_results} neighbors within threshold. Returning top {n} nearest.")
+                logger.info(f"Fallback search returning {len(candidates[:n])} nearest neighbors.")
+            return candidates[:n]
+        return filtered_neighbors
+
+    def ranked_neighbors(self, track_ids, n=10, threshold=settings.ANNOY_DISTANCE_THRESHOLD, min_results=1, refresh=True, log=True,
+                         genre_id=None):
         """
-        if not self.is_loaded:
+        Соседи для нескольких треков по правилам find_nearest_neighbors (порог, затем fallback), с расстояниями.
+        Все треки разрешаются за один проход по одному снимку индекса, запросы выполняются пачкой
+        (exact - одно матричное умножение, Annoy - в пуле потоков), дельта - одним умножением.
+        :param refresh: проверить новую сборку, дельту и удаленные треки перед поиском
+        :param genre_id: только соседи этого жанра (поиск по разделу жанра, см. core/genre_partitions.py)
+        :return: {track_id: [(ID соседа, расстояние), ...]}; треков без эмбеддинга в словаре нет
+        """
+        seeds = list(dict.fromkeys(track_ids)) # Без повторов, порядок сохраняется
+        if not seeds:
+            return {}
+        if refresh:
+            self.refresh()
+        # Весь запрос работает с одним снимком: горячая замена индекса его не затронет
+        snapshot = self._snapshot
+        if not snapshot.is_loaded and not len(self.delta):
             logger.warning("Annoy index is not loaded. Cannot find neighbors.")
-            return []
+            return {}
 
-        neighbor_indices = []
-        neighbor_distances = []
-
-        # Определяем, как искать: по индексу или по вектору
-        annoy_idx = None
-        search_vector = None
-        # TODO: Загрузка item_map
-        for idx, pk in self.item_map.items():
-             if pk == track_id:
-                 annoy_idx = idx
-                 break
-
-        if annoy_idx is None:
-            try:
-                track = Track.objects.get(pk=track_id)
-                if track.embedding and isinstance(track.embedding, list) and len(track.embedding) == self.dimension:
-                    search_vector = track.embedding
-                else:
-                    logger.warning(f"Track ID {track_id} not in item_map/DB or no valid embedding.")
-                    return []
-            except Track.DoesNotExist:
-                logger.warning(f"Track ID {track_id} not found in database.")
-                return []
-            except Exception as e:
-                 logger.error(f"Error getting vector for track ID {track_id}: {e}")
-                 return []
-
-        # --- Попытка 1: Поиск с порогом --- 
-        logger.debug(f"Attempting search for Track ID {track_id} with threshold {threshold}")
         num_candidates = n * 5 + 1 # Ищем больше кандидатов для фильтрации
+        # Запас на удаленные треки, которые будут отброшены (не больше удвоения)
+        num_candidates += min(len(self.tombstones), num_candidates)
         try:
-            if annoy_idx is not None:
-                neighbor_indices, neighbor_distances = self.index.get_nns_by_item(annoy_idx, num_candidates, include_distances=True, search_k=-1)
-            elif search_vector is not None:
-                neighbor_indices, neighbor_distances = self.index.get_nns_by_vector(search_vector, num_candidates, include_distances=True, search_k=-1)
-            else: # Не должно случиться, но на всякий случай
-                return []
+            vectors = self._resolve_seed_vectors(snapshot, seeds)
+            resolved = [track_id for track_id in seeds if track_id in vectors]
+            for track_id in seeds:
+                if track_id not in vectors:
+                    logger.warning(f"Track ID {track_id} not in item_map/delta/DB or no valid embedding.")
+            if not resolved:
+                return {}
+            logger.debug(f"Searching neighbors for {len(resolved)} tracks with threshold {threshold}")
+            all_candidates = self._search_candidates(
+                snapshot, [vectors[track_id] for track_id in resolved], num_candidates, genre_id=genre_id,
+            )
         except Exception as e:
-            logger.error(f"Error during Annoy search (attempt 1) for track {track_id}: {e}")
-            return [] # Возвращаем пустой список при ошибке поиска
-
-        filtered_neighbor_ids = []
-        for i, idx in enumerate(neighbor_indices):
-            distance = neighbor_distances[i]
-            neighbor_track_id = self.item_map.get(idx)
-            if neighbor_track_id is not None and neighbor_track_id != track_id and distance < threshold:
-                filtered_neighbor_ids.append(neighbor_track_id)
-                logger.debug(f"  [Thresh] Found neighbor: ID {neighbor_track_id}, Dist: {distance:.4f}")
-                if len(filtered_neighbor_ids) >= n:
-                    break
+            logger.error(f"Error during Annoy search for tracks {seeds}: {e}", exc_info=True)
+            return {} # Пустые результаты при ошибке поиска
+
+        # Удаленные треки могут оставаться в сборке до перестройки
+        tombstones = self.tombstones
+        results = {}
+        for track_id, candidates in zip(resolved, all_candidates):
+            candidates = [
+                (neighbor_id, distance) for neighbor_id, distance in candidates
+                if neighbor_id != track_id and neighbor_id not in tombstones
+            ]
+            results[track_id] = self._rank_neighbors(track_id, candidates, n, threshold, min_results, log=log)
+        return results
+
+    def find_nearest_neighbors_many(self, track_ids, n=10, threshold=settings.ANNOY_DISTANCE_THRESHOLD, min_results=1, genre_id=None):
+        """
+        Ближайшие соседи сразу для нескольких треков (плейлист, радио, профиль вкуса), см. ranked_neighbors.
+        :return: NeighborsBatch: per_seed - {track_id: [ID соседей]} (как find_nearest_neighbors),
+                 fused - до n треков, объединенных по всем трекам (reciprocal rank fusion), без самих исходных треков.
+        """
+        seeds = list(dict.fromkeys(track_ids))
+        # Место под исходные треки, которые уберутся из общего списка
+        per_seed_n = n + max(len(seeds) - 1, 0)
+        ranked = self.ranked_neighbors(seeds, per_seed_n, threshold, min_results, genre_id=genre_id)
+        rankings = [[neighbor_id for neighbor_id, _ in ranked[track_id]] for track_id in seeds if track_id in ranked]
+        per_seed = {track_id: [neighbor_id for neighbor_id, _ in ranked.get(track_id, [])[:n]] for track_id in seeds}
+        return NeighborsBatch(per_seed, fuse_rankings(rankings, n, exclude=set(seeds)))
 
-        logger.info(f"Found {len(filtered_neighbor_ids)} neighbors for Track ID {track_id} within threshold {threshold}.")
-
-        # --- Попытка 2: Fallback без порога (если найдено < min_results) --- 
-        if len(filtered_neighbor_ids) < min_results:
-            logger.warning(f"Found less than {min_results} neighbors within threshold. Performing fallback search (top {n}).")
-            neighbor_indices_fb = [] # Инициализируем на случай ошибок
-            try:
-                # Запрашиваем просто n+1 ближайших
-                if annoy_idx is not None:
-                    # Исправлено: присваиваем результат одной переменной
-                    neighbor_indices_fb = self.index.get_nns_by_item(annoy_idx, n + 1, include_distances=False, search_k=-1)
-                elif search_vector is not None:
-                    # Исправлено: присваиваем результат одной переменной
-                    neighbor_indices_fb = self.index.get_nns_by_vector(search_vector, n + 1, include_distances=False, search_k=-1)
-                # else: случай обработан ранее, search_vector/annoy_idx должен быть
-
-            except Exception as e:
-                logger.error(f"Error during Annoy search (fallback) for track {track_id}: {e}", exc_info=True) # Добавлено exc_info
-                # Возвращаем пустой список при ошибке поиска
-                return []
-
-            fallback_neighbor_ids = []
-            for idx in neighbor_indices_fb:
-                neighbor_track_id = self.item_map.get(idx)
-                if neighbor_track_id is not None and neighbor_track_id != track_id:
-                     fallback_neighbor_ids.append(neighbor_track_id)
-                     logger.debug(f"  [Fallback] Found neighbor: ID {neighbor_track_id}")
-                     if len(fallback_neighbor_ids) >= n:
-                         break
-            logger.info(f"Fallback search returning {len(fallback_neighbor_ids)} nearest neighbors.")
-            return fallback_neighbor_ids
+    def find_nearest_neighbors(self, track_id, n=10, threshold=settings.ANNOY_DISTANCE_THRESHOLD, min_results=1, genre_id=None):
+        """
+        Находит ближайших соседей для заданного ID трека (в основном индексе и в дельте недавних эмбеддингов).
+        Сначала пытается найти до n соседей с расстоянием < threshold.
+        Если найдено меньше min_results, возвращает просто n ближайших соседей без порога.
+        genre_id ограничивает поиск треками одного жанра (раздел индекса по жанру).
+        Возвращает список ID треков.
+        """
+        return self.find_nearest_neighbors_many([track_id], n, threshold, min_results, genre_id=genre_id).per_seed[track_id]
+
+    def find_nearest_to_vector(self, vector, n=10, genre_id=None):
+        """
+        Ближайшие треки к произвольному вектору из пространства индекса (например, эмбеддингу текстового запроса).
+        Без порога: запрос не является треком каталога, поэтому возвращаются просто n ближайших.
+        :return: список (ID трека, расстояние) по возрастанию расстояния
+        """
+        self.refresh()
+        snapshot = self._snapshot
+        if not snapshot.is_loaded and not len(self.delta):
+            logger.warning("Annoy index is not loaded. Cannot search by vector.")
+            return []
+        tombstones = self.tombstones
+        num_candidates = n + min(len(tombstones), n) # Запас на удаленные треки
+        candidates = self._search_candidates(snapshot, [as_float32(vector)], num_candidates, genre_id=genre_id)[0]
+        return [(track_id, distance) for track_id, distance in candidates if track_id not in tombstones][:n]
+
+    def vectors_for(self, track_ids):
+        """
+        Векторы треков одной матрицей: из дельты (самые свежие), строками общей матрицы сборки
+        (одна индексация mmap, без обращения к БД) и, для остальных, как для запросов (_resolve_seed_vectors).
+        :return: (float32 [len(track_ids), dim] с нормализованными строками, bool-маска найденных треков)
+        """
+        snapshot = self._snapshot
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        matrix = np.zeros((len(track_ids), self.dimension), dtype=np.float32)
+        found = np.zeros(len(track_ids), dtype=bool)
+        for row, track_id in enumerate(track_ids.tolist()):
+            vector = self.delta.vector_for(track_id)
+            if vector is not None:
+                matrix[row], found[row] = vector, True
+        if snapshot.vectors is not None:
+            slots = snapshot.item_map.slots_for_tracks(track_ids)
+            rows = np.flatnonzero((slots >= 0) & ~found)
+            if len(rows):
+                matrix[rows] = snapshot.vectors[slots[rows]]
+                found[rows] = True
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            vectors = self._resolve_seed_vectors(snapshot, track_ids[missing].tolist())
+            for row in missing.tolist():
+                vector = vectors.get(int(track_ids[row]))
+                if vector is not None:
+                    matrix[row], found[row] = as_float32(vector), True
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1.0), found
+
+    def distances(self, track_id, other_ids):
+        """
+        Расстояния (в метрике индекса) от трека до заданных треков без поиска по индексу:
+        векторы берутся так же, как для запросов (дельта, сборка, БД), расстояния считаются одним умножением.
+        :return: dict ID трека -> расстояние (треков без эмбеддинга в нем нет)
+        """
+        vectors = self._resolve_seed_vectors(self._snapshot, [track_id, *other_ids])
+        if track_id not in vectors:
+            return {}
+        found = [other_id for other_id in dict.fromkeys(other_ids) if other_id in vectors and other_id != track_id]
+        if not found:
+            return {}
+        query = as_float32(vectors[track_id])
+        matrix = np.stack([as_float32(vectors[other_id]) for other_id in found])
+        if self.metric == 'angular':
+            # Как у Annoy: sqrt(2 - 2cos) между нормализованными векторами
+            query = query / (np.linalg.norm(query) or 1.0)
+            matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            values = np.sqrt(np.maximum(2.0 - 2.0 * (matrix @ query), 0.0))
         else:
-            # Возвращаем результаты, отфильтрованные по порогу
-            return filtered_neighbor_ids
+            values = np.linalg.norm(matrix - query, axis=1)
+        return dict(zip(found, values.tolist()))
 
 # Создаем один экземпляр сервиса для использования в приложении
 # Он будет инициализирован и попытается загрузить индекс при старте Django
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 import logging
 import os # Для проверки запуска основного процесса
 
@@ -38,6 +39,64 @@ class CoreConfig(AppConfig):
                 )
                 logger.info("Added job 'rebuild_annoy_index_job' to APScheduler.")
 
+                # Раз в сутки чистим кеш эмбеддингов от записей, на которые не ссылается ни один трек
+                from .embedding_cache import evict_unreferenced
+                scheduler.add_job(
+                    evict_unreferenced,
+                    trigger='interval',
+                    hours=24,
+                    id='prune_embedding_cache_job',
+                    max_instances=1,
+                    replace_existing=True,
+                )
+                logger.info("Added job 'prune_embedding_cache_job' to APScheduler.")
+
+                # И таблицу эмбеддингов текстовых запросов - до TEXT_SEARCH_MAX_STORED_QUERIES самых частых
+                from .text_search import evict_query_embeddings
+                scheduler.add_job(
+                    evict_query_embeddings,
+                    trigger='interval',
+                    hours=24,
+                    id='prune_text_query_embeddings_job',
+                    max_instances=1,
+                    replace_existing=True,
+                )
+                logger.info("Added job 'prune_text_query_embeddings_job' to APScheduler.")
+
+                # Схожесть треков по совместным лайкам (инкрементно, по голосам с прошлого запуска)
+                from .colike import update_colike_similarities
+                scheduler.add_job(
+                    update_colike_similarities,
+                    trigger='interval',
+                    minutes=settings.COLIKE_JOB_INTERVAL_MINUTES,
+                    id='update_colike_similarities_job',
+                    max_instances=1,
+                    replace_existing=True,
+                )
+                logger.info("Added job 'update_colike_similarities_job' to APScheduler.")
+
+                # Обучение ALS: очередь TrainingJob проверяется каждые 5 минут (обучение - в отдельном процессе),
+                # плановое переобучение - раз в интервал
+                from .als import schedule_training
+                from .jobs import run_als_training_if_pending
+                scheduler.add_job(
+                    run_als_training_if_pending,
+                    trigger='interval',
+                    minutes=5,
+                    id='run_training_jobs_job',
+                    max_instances=1,
+                    replace_existing=True,
+                )
+                scheduler.add_job(
+                    schedule_training,
+                    trigger='interval',
+                    hours=settings.ALS_TRAIN_INTERVAL_HOURS,
+                    id='schedule_als_training_job',
+                    max_instances=1,
+                    replace_existing=True,
+                )
+                logger.info("Added jobs 'run_training_jobs_job' and 'schedule_als_training_job' to APScheduler.")
+
                 # Запускаем планировщик
                 scheduler.start()
                 logger.info("APScheduler started...")
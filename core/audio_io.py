@@ -0,0 +1,151 @@
+# core/audio_io.py
+import logging
+import os
+from collections import namedtuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- Чтение аудио ---
+# probe_audio читает только заголовки (mutagen / soundfile), без декодирования сигнала:
+# длительность часового микса определяется за миллисекунды и без выделения памяти под waveform.
+# load_audio_windows декодирует только нужные окна и сразу приводит их к частоте модели,
+# поэтому пиковая память ограничена длиной окон, а не длиной файла.
+# librosa используется только как запасной путь для форматов, которые не читает libsndfile, и только
+# вне веб-процесса: при загрузке (probe_uploaded_file) такой файл не декодируется, длительность
+# определяет воркер эмбеддингов (core/embedding_queue.py).
+
+AudioInfo = namedtuple('AudioInfo', ['duration', 'sample_rate', 'channels', 'codec'])
+
+
+def _rewind(source, position):
+    if position is not None:
+        try:
+            source.seek(position)
+        except Exception:
+            pass
+
+
+def probe_audio(source, allow_decode=True):
+    """
+    Метаданные аудио по заголовкам файла (без полного декодирования).
+    :param source: Путь к файлу или file-like объект (позиция чтения восстанавливается).
+    :param allow_decode: Разрешить запасной путь через librosa (тяжелый импорт, возможно полное декодирование).
+    :return: AudioInfo(duration, sample_rate, channels, codec).
+    :raises ValueError: заголовки не прочитаны, а allow_decode=False.
+    """
+    position = source.tell() if hasattr(source, 'tell') else None
+    try:
+        import mutagen
+        audio = mutagen.File(source)
+        if audio is not None and getattr(audio.info, 'length', 0):
+            info = audio.info
+            return AudioInfo(
+                duration=float(info.length),
+                sample_rate=getattr(info, 'sample_rate', None),
+                channels=getattr(info, 'channels', None),
+                codec=getattr(info, 'codec', None) or type(audio).__name__.lower(),
+            )
+    except Exception as e:
+        logger.debug(f"mutagen could not probe {source}: {e}")
+    finally:
+        _rewind(source, position)
+
+    try:
+        import soundfile
+        info = soundfile.info(source)
+        return AudioInfo(
+            duration=float(info.duration),
+            sample_rate=info.samplerate,
+            channels=info.channels,
+            codec=info.subtype.lower() if info.subtype else info.format.lower(),
+        )
+    except Exception as e:
+        logger.debug(f"soundfile could not probe {source}: {e}")
+    finally:
+        _rewind(source, position)
+
+    if not allow_decode:
+        raise ValueError(f"Could not read audio headers of {getattr(source, 'name', source)}")
+
+    # Последний вариант: librosa (для некоторых форматов декодирует файл целиком)
+    logger.warning(f"Falling back to librosa duration detection for {getattr(source, 'name', source)}")
+    try:
+        import librosa
+        return AudioInfo(duration=float(librosa.get_duration(path=source)), sample_rate=None, channels=None, codec=None)
+    finally:
+        _rewind(source, position)
+
+
+def probe_uploaded_file(uploaded_file):
+    """
+    Метаданные загруженного файла Django: временный файл читаем по пути, файл в памяти - как объект.
+    Только по заголовкам: librosa в веб-процессе не импортируется (ValueError, если заголовки не прочитаны).
+    """
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        return probe_audio(uploaded_file.temporary_file_path(), allow_decode=False)
+    return probe_audio(uploaded_file, allow_decode=False)
+
+
+def window_offsets(duration, window_seconds, num_windows):
+    """
+    Смещения (сек) окон, равномерно распределенных по треку.
+    Если трек короче суммы окон, возвращает [(0, None)] - читать файл целиком.
+    :return: список (offset, length)
+    """
+    if not duration or duration <= window_seconds * num_windows:
+        return [(0.0, None)]
+    offsets = []
+    for i in range(num_windows):
+        center = duration * (i + 1) / (num_windows + 1)
+        offset = min(max(center - window_seconds / 2, 0.0), duration - window_seconds)
+        offsets.append((offset, window_seconds))
+    return offsets
+
+
+def _read_window_soundfile(path, offset, length, target_sr):
+    import soundfile
+    with soundfile.SoundFile(path) as f:
+        source_sr = f.samplerate
+        f.seek(int(offset * source_sr))
+        frames = -1 if length is None else int(length * source_sr)
+        data = f.read(frames, dtype='float32', always_2d=True)
+    waveform = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+    if source_sr != target_sr:
+        import soxr
+        waveform = soxr.resample(waveform, source_sr, target_sr, quality='HQ')
+    return waveform
+
+
+def _read_window_librosa(path, offset, length, target_sr):
+    import librosa
+    # librosa сама читает только [offset, offset + length) и ресемплирует при загрузке
+    waveform, _ = librosa.load(path, sr=target_sr, mono=True, offset=offset, duration=length, res_type='soxr_hq')
+    return waveform
+
+
+def load_audio_windows(path, target_sr, window_seconds, num_windows=1, duration=None):
+    """
+    Декодирует окна трека сразу в моно float32 с частотой target_sr.
+    :param duration: Длительность трека, если уже известна (иначе берется из заголовка).
+    :return: Список np.ndarray (по одному на окно).
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    if duration is None:
+        try:
+            duration = probe_audio(path).duration
+        except Exception as e:
+            logger.warning(f"Could not probe {path}, decoding it whole: {e}")
+            duration = None
+
+    windows = []
+    for offset, length in window_offsets(duration, window_seconds, num_windows):
+        try:
+            waveform = _read_window_soundfile(path, offset, length, target_sr)
+        except Exception as e:
+            # libsndfile не умеет формат (например, m4a) - декодируем через librosa/audioread
+            logger.debug(f"soundfile could not read {path} ({e}), using librosa")
+            waveform = _read_window_librosa(path, offset, length, target_sr)
+        windows.append(np.ascontiguousarray(waveform, dtype=np.float32))
+    return windows
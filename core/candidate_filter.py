@@ -0,0 +1,146 @@
+# core/candidate_filter.py
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import Counter, namedtuple
+import numpy as np
+from django.conf import settings
+from .result_cache import VersionedResultCache
+
+logger = logging.getLogger(__name__)
+
+# --- Фильтрация кандидатов между поиском соседей и загрузкой треков ---
+# Исключения (треки, за которые пользователь уже голосовал, треки того же исполнителя) хранятся
+# отсортированными массивами int64 ID треков: проверка пачки кандидатов - один searchsorted.
+# Если после фильтра осталось меньше n треков, поиск повторяется с большим k (раунд). Следующее k
+# оценивается по доле выживших в прошлом раунде; раунды прекращаются, когда набралось n треков,
+# кандидаты кончились (поиск вернул меньше k) или исчерпан бюджет времени CANDIDATE_FILTER_BUDGET_MS.
+
+FilterResult = namedtuple('FilterResult', ['ids', 'rounds', 'fetched', 'exhausted', 'elapsed'])
+
+MAX_GROWTH = 8 # Во сколько раз k может вырасти за один раунд
+OVERFETCH_MARGIN = 1.25 # Запас к оценке k по доле выживших
+
+# Версия ключа: версия голосов пользователя (UserTasteVector.version) или данных индекса
+exclusion_cache = VersionedResultCache(
+    'excl',
+    local_size=settings.RECOMMENDATION_CACHE_LOCAL_SIZE,
+    timeout=settings.RECOMMENDATION_CACHE_TIMEOUT,
+)
+
+
+class ExclusionSet:
+    """Неизменяемое множество ID треков поверх отсортированного массива int64."""
+
+    def __init__(self, ids=()):
+        if not isinstance(ids, np.ndarray):
+            ids = np.fromiter(ids, dtype=np.int64)
+        self.ids = np.unique(ids.astype(np.int64, copy=False))
+
+    def __len__(self):
+        return int(self.ids.shape[0])
+
+    def __contains__(self, track_id):
+        pos = int(np.searchsorted(self.ids, track_id))
+        return pos < len(self) and self.ids[pos] == track_id
+
+    def mask(self, track_ids):
+        """Булев массив: какие из track_ids исключены (векторно)."""
+        candidates = np.asarray(track_ids, dtype=np.int64)
+        if not len(self) or not len(candidates):
+            return np.zeros(len(candidates), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.ids, candidates), len(self) - 1)
+        return self.ids[pos] == candidates
+
+    def union(self, *others):
+        return ExclusionSet(np.concatenate([self.ids, *(other.ids for other in others)]))
+
+
+def user_vote_exclusions(user_id, votes='all'):
+    """
+    ID треков, за которые голосовал пользователь.
+    :param votes: 'all' - все голоса, 'dislikes' - только дизлайки
+    Кешируется до следующего голоса (версия вектора вкуса меняется при каждом голосе).
+    """
+    from .models import LikeDislike, UserTasteVector
+    version = UserTasteVector.objects.filter(user_id=user_id).values_list('version', flat=True).first()
+
+    def load():
+        rows = LikeDislike.objects.filter(user_id=user_id)
+        if votes == 'dislikes':
+            rows = rows.filter(vote=LikeDislike.DISLIKE)
+        return ExclusionSet(np.fromiter(rows.values_list('track_id', flat=True), dtype=np.int64))
+
+    return exclusion_cache.get_or_compute(f"u{version}", ('votes', user_id, votes), load)
+
+
+def artist_exclusions(artist, data_version):
+    """ID треков исполнителя (кешируется до смены данных индекса: новые треки меняют дельту)."""
+    from .models import Track
+
+    def load():
+        return ExclusionSet(np.fromiter(Track.objects.filter(artist=artist).values_list('pk', flat=True), dtype=np.int64))
+
+    # Хеш вместо имени: пробелы и юникод в ключах недопустимы для memcached
+    return exclusion_cache.get_or_compute(data_version, ('artist', hashlib.sha1(artist.encode('utf-8')).hexdigest()), load)
+
+
+_stats_lock = threading.Lock()
+_round_counts = Counter() # раундов -> вызовов
+_budget_stops = 0
+
+
+def filter_stats():
+    """Сколько раундов понадобилось фильтру (в этом процессе) и сколько раз кончился бюджет времени."""
+    with _stats_lock:
+        calls = sum(_round_counts.values())
+        return {
+            'calls': calls,
+            'rounds': dict(sorted(_round_counts.items())),
+            'mean_rounds': round(sum(r * c for r, c in _round_counts.items()) / calls, 2) if calls else None,
+            'budget_stops': _budget_stops,
+        }
+
+
+def filter_candidates(search, n, exclusions, initial_k=None, budget_ms=None, max_candidates=None):
+    """
+    Ищет n треков, не попавших в exclusions, раундами с растущим k.
+    :param search: search(k) -> до k ID треков по возрастанию расстояния (меньше k - кандидаты кончились)
+    :param initial_k: k первого раунда (по умолчанию n + запас по размеру исключений, не больше 2n)
+    :return: FilterResult(ids, rounds, fetched, exhausted, elapsed)
+    """
+    global _budget_stops
+    budget = (settings.CANDIDATE_FILTER_BUDGET_MS if budget_ms is None else budget_ms) / 1000
+    max_candidates = max_candidates or settings.CANDIDATE_FILTER_MAX_CANDIDATES
+    k = min(initial_k or n + min(len(exclusions), n), max_candidates)
+    started = time.perf_counter()
+    rounds = 0
+    survivors, candidates = [], []
+    exhausted = budget_stop = False
+    while True:
+        rounds += 1
+        candidates = list(search(k))
+        excluded = exclusions.mask(candidates)
+        survivors = [track_id for track_id, drop in zip(candidates, excluded) if not drop]
+        exhausted = len(candidates) < k or k >= max_candidates
+        if len(survivors) >= n or exhausted:
+            break
+        if time.perf_counter() - started >= budget:
+            budget_stop = True
+            break
+        # Следующее k - по доле выживших (не меньше удвоения и не больше MAX_GROWTH раз)
+        survival = max(len(survivors) / max(len(candidates), 1), 1 / MAX_GROWTH)
+        k = min(max(2 * k, math.ceil(n / survival * OVERFETCH_MARGIN)), k * MAX_GROWTH, max_candidates)
+
+    elapsed = time.perf_counter() - started
+    with _stats_lock:
+        _round_counts[rounds] += 1
+        _budget_stops += budget_stop
+    if rounds > 1:
+        logger.info(
+            f"Candidate filter: {len(survivors[:n])}/{n} tracks after {rounds} rounds "
+            f"({len(candidates)} fetched, {elapsed * 1000:.1f} ms{', budget exhausted' if budget_stop else ''})"
+        )
+    return FilterResult(survivors[:n], rounds, len(candidates), exhausted, elapsed)
@@ -0,0 +1,250 @@
+# core/colike.py
+import logging
+import math
+import os
+import time
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import CoLikeSimilarity, LikeDislike, Track, TrainingJob
+
+logger = logging.getLogger(__name__)
+
+# --- Item-item коллаборативная фильтрация по лайкам ---
+# Лайки - разреженная бинарная матрица пользователь x трек (scipy.sparse, индексы = ID пользователя и трека).
+# Совместные лайки двух треков - элемент A^T A; схожесть - косинус co / sqrt(лайков_i * лайков_j).
+# Произведение считается пачками по COLIKE_BATCH_SIZE треков (A[:, пачка]^T @ A), из каждой строки
+# остаются COLIKE_TOP_K лучших пар с не меньше чем COLIKE_MIN_CO_LIKES совместными лайками (CoLikeSimilarity).
+#
+# Инкрементное обновление: матрица лайков прошлого запуска хранится в COLIKE_STATE_PATH. Разность с текущей
+# дает измененные треки (новые, отмененные и смененные голоса, удаленные треки). Пересчитываются строки
+# измененных треков и всех треков, которые лайкали вместе с ними (у них изменились совместные лайки
+# или нормировка). Если затронута большая часть каталога, выполняется полный пересчет.
+# Каждый запуск - строка TrainingJob со временем этапов в logs.
+
+JOB_NAME = 'colike_similarity'
+
+
+def load_like_matrix():
+    """Матрица лайков (csr, float32, строки - ID пользователей, столбцы - ID треков)."""
+    from scipy import sparse # scipy импортируется только задачей, не веб-процессом
+    pairs = np.array(
+        list(LikeDislike.objects.filter(vote=LikeDislike.LIKE).values_list('user_id', 'track_id')), dtype=np.int64,
+    ).reshape(-1, 2)
+    shape = (int(pairs[:, 0].max()) + 1, int(pairs[:, 1].max()) + 1) if len(pairs) else (0, 0)
+    data = np.ones(len(pairs), dtype=np.float32)
+    return sparse.csr_matrix((data, (pairs[:, 0], pairs[:, 1])), shape=shape)
+
+
+def _resized(matrix, shape):
+    matrix = matrix.tocsr(copy=True)
+    matrix.resize(shape)
+    return matrix
+
+
+def load_state(path=None):
+    """Матрица лайков прошлого запуска или None (первый запуск, файл поврежден)."""
+    path = str(path or settings.COLIKE_STATE_PATH)
+    if not os.path.exists(path):
+        return None
+    try:
+        from scipy import sparse
+        return sparse.load_npz(path).tocsr()
+    except Exception as e:
+        logger.warning(f"Could not read co-like state {path}, falling back to a full recompute: {e}")
+        return None
+
+
+def save_state(likes, path=None):
+    """Сохраняет матрицу лайков (через временный файл + rename)."""
+    path = str(path or settings.COLIKE_STATE_PATH)
+    from scipy import sparse
+    tmp_path = f"{path}.tmp.npz" # save_npz добавляет .npz к имени без этого расширения
+    sparse.save_npz(tmp_path, likes)
+    os.replace(tmp_path, path)
+
+
+def changed_tracks(old, new):
+    """ID треков, у которых изменился набор лайкнувших пользователей."""
+    shape = (max(old.shape[0], new.shape[0]), max(old.shape[1], new.shape[1]))
+    diff = _resized(new, shape) - _resized(old, shape)
+    diff.eliminate_zeros()
+    return np.unique(diff.indices)
+
+
+def co_liked_tracks(likes, track_ids, likes_csc=None):
+    """
+    Треки, которые лайкал хотя бы один пользователь, лайкнувший что-то из track_ids.
+    :param likes_csc: та же матрица в csc (если уже есть), чтобы не конвертировать заново
+    """
+    track_ids = track_ids[track_ids < likes.shape[1]]
+    likes_csc = likes.tocsc() if likes_csc is None else likes_csc
+    users = np.unique(likes_csc[:, track_ids].indices)
+    return np.unique(likes[users].indices)
+
+
+def like_counts(likes):
+    """Лайков у каждого трека (float64 по столбцам)."""
+    return np.asarray(likes.sum(axis=0), dtype=np.float64).ravel()
+
+
+def top_similarities(likes, track_ids, top_k=None, min_co_likes=None, likes_csc=None, counts=None):
+    """
+    Лучшие пары по косинусу совместных лайков для треков track_ids (одно разреженное произведение).
+    :param likes_csc: та же матрица в csc; counts - лайков у каждого трека (при расчете пачками - посчитаны один раз)
+    :return: массивы (source, similar, score, co_likes, rank), отсортированные по source и rank
+    """
+    top_k = top_k or settings.COLIKE_TOP_K
+    min_co_likes = min_co_likes or settings.COLIKE_MIN_CO_LIKES
+    track_ids = np.asarray(track_ids, dtype=np.int64)
+    track_ids = track_ids[track_ids < likes.shape[1]]
+    counts = like_counts(likes) if counts is None else counts
+    likes_csc = likes.tocsc() if likes_csc is None else likes_csc
+    co = (likes_csc[:, track_ids].T.tocsr() @ likes).tocoo() # len(track_ids) x треки
+    sources, similar, co_likes = track_ids[co.row], co.col.astype(np.int64), co.data.astype(np.float64)
+    keep = (similar != sources) & (co_likes >= min_co_likes)
+    sources, similar, co_likes = sources[keep], similar[keep], co_likes[keep]
+    scores = co_likes / np.sqrt(counts[sources] * counts[similar])
+
+    # По трекам, внутри - по убыванию схожести (при равенстве - по ID для воспроизводимости)
+    order = np.lexsort((similar, -scores, sources))
+    sources, similar, scores, co_likes = sources[order], similar[order], scores[order], co_likes[order]
+    starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]]) if len(sources) else np.empty(0, dtype=np.int64)
+    ranks = np.arange(len(sources)) - np.repeat(starts, np.diff(np.r_[starts, len(sources)]))
+    keep = ranks < top_k
+    return sources[keep], similar[keep], scores[keep], co_likes[keep].astype(np.int64), ranks[keep]
+
+
+def _write_batch(track_ids, result, existing_tracks):
+    """Заменяет строки CoLikeSimilarity пачки треков (треки, удаленные во время расчета, пропускаются)."""
+    sources, similar, scores, co_likes, ranks = result
+    valid = np.isin(sources, existing_tracks) & np.isin(similar, existing_tracks)
+    rows = [
+        CoLikeSimilarity(source_track_id=source, similar_track_id=other, score=score, co_likes=count, rank=rank)
+        for source, other, score, count, rank in zip(
+            sources[valid].tolist(), similar[valid].tolist(), scores[valid].tolist(),
+            co_likes[valid].tolist(), ranks[valid].tolist(),
+        )
+    ]
+    with transaction.atomic():
+        CoLikeSimilarity.objects.filter(source_track_id__in=track_ids.tolist()).delete()
+        CoLikeSimilarity.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def update_colike_similarities(full=False):
+    """
+    Обновляет CoLikeSimilarity по изменениям лайков с прошлого запуска (или полностью) и записывает запуск в TrainingJob.
+    :return: TrainingJob
+    """
+    job = TrainingJob.objects.create(
+        parameters={
+            'job': JOB_NAME, 'mode': 'full' if full else 'incremental',
+            'top_k': settings.COLIKE_TOP_K, 'min_co_likes': settings.COLIKE_MIN_CO_LIKES,
+        },
+        status='running', started_at=timezone.now(),
+    )
+    log_lines = []
+
+    def log(message, started):
+        line = f"{message} ({time.perf_counter() - started:.3f}s)"
+        log_lines.append(line)
+        logger.info(f"Co-like job {job.pk}: {line}")
+
+    try:
+        started = time.perf_counter()
+        likes = load_like_matrix()
+        log(f"Loaded {likes.nnz} likes: {likes.shape[0]} user rows x {likes.shape[1]} track columns", started)
+
+        started = time.perf_counter()
+        previous = None if full else load_state()
+        liked_tracks = np.unique(likes.indices)
+        likes_csc = likes.tocsc() # Столбцы треков: один раз на запуск, а не на каждую пачку
+        if previous is None:
+            affected = liked_tracks
+            mode = 'full'
+        else:
+            changed = changed_tracks(previous, likes)
+            affected = np.union1d(
+                changed, np.union1d(co_liked_tracks(likes, changed, likes_csc), co_liked_tracks(previous, changed)),
+            )
+            mode = 'incremental'
+            if len(liked_tracks) and len(affected) > settings.COLIKE_FULL_RECOMPUTE_RATIO * len(liked_tracks):
+                # Затронута большая часть каталога: пересчет только затронутых строк уже не дешевле
+                affected = np.union1d(liked_tracks, changed)
+                mode = 'full'
+        if mode == 'full':
+            # Строки треков, которые больше никто не лайкает
+            stored = np.fromiter(
+                CoLikeSimilarity.objects.values_list('source_track_id', flat=True).distinct(), dtype=np.int64,
+            )
+            affected = np.union1d(affected, stored)
+        log(f"Mode {mode}: {len(affected)} of {len(liked_tracks)} liked tracks to recompute", started)
+
+        started = time.perf_counter()
+        existing_tracks = np.fromiter(Track.objects.values_list('pk', flat=True), dtype=np.int64)
+        written = 0
+        batch_size = settings.COLIKE_BATCH_SIZE
+        counts = like_counts(likes)
+        for start in range(0, len(affected), batch_size):
+            batch = affected[start:start + batch_size]
+            result = top_similarities(likes, batch, likes_csc=likes_csc, counts=counts)
+            written += _write_batch(batch, result, existing_tracks)
+        log(f"Computed and stored {written} similarities for {len(affected)} tracks", started)
+
+        save_state(likes)
+        job.parameters['mode'] = mode
+        job.status = 'completed'
+    except Exception as e:
+        logger.error(f"Co-like job {job.pk} failed: {e}", exc_info=True)
+        log_lines.append(f"Error: {e}")
+        job.status = 'failed'
+    job.finished_at = timezone.now()
+    job.logs = '\n'.join(log_lines)
+    job.save(update_fields=['parameters', 'status', 'finished_at', 'logs'])
+    return job
+
+
+# --- Гибридная оценка ---
+
+def colike_neighbors(track_id, genre_id=None, limit=None):
+    """Похожие по лайкам треки: список (ID трека, схожесть) по убыванию схожести."""
+    rows = CoLikeSimilarity.objects.filter(source_track_id=track_id)
+    if genre_id is not None:
+        rows = rows.filter(similar_track__genre_id=genre_id)
+    return list(rows.order_by('rank').values_list('similar_track_id', 'score')[:limit or settings.COLIKE_TOP_K])
+
+
+def _audio_similarity(distance):
+    if settings.ANNOY_METRIC == 'angular':
+        return 1.0 - distance * distance / 2.0 # Косинус: расстояние Annoy = sqrt(2 - 2cos)
+    return 1.0 / (1.0 + distance)
+
+
+def hybrid_rank(audio_ids, colike_scores, distances, n, threshold=math.inf, weight=None):
+    """
+    Смешивает аудио-соседей трека с похожими по лайкам:
+    оценка = (1 - COLIKE_WEIGHT) * аудио-схожесть + COLIKE_WEIGHT * схожесть по лайкам.
+    Запросов не делает: похожие по лайкам (colike_scores, {ID трека: схожесть}) и расстояния до всех кандидатов
+    (distances, {ID трека: расстояние}) вызывающий код получает один раз на запрос.
+    Похожий по лайкам трек, которого нет среди аудио-соседей, добавляется, только если его расстояние
+    не больше threshold (тот же порог, что у аудио-поиска).
+    Без данных о лайках порядок audio_ids не меняется.
+    :return: до n ID треков по убыванию оценки
+    """
+    weight = settings.COLIKE_WEIGHT if weight is None else weight
+    if not colike_scores or weight <= 0:
+        return list(audio_ids[:n])
+    audio_set = set(audio_ids)
+    extra = [
+        candidate for candidate in colike_scores
+        if candidate not in audio_set and distances.get(candidate, math.inf) <= threshold
+    ]
+    candidates = [*audio_ids, *extra]
+    scores = {
+        candidate: (1 - weight) * (_audio_similarity(distances[candidate]) if candidate in distances else 0.0)
+        + weight * colike_scores.get(candidate, 0.0)
+        for candidate in candidates
+    }
+    return sorted(candidates, key=scores.get, reverse=True)[:n]
@@ -0,0 +1,170 @@
+# core/delta_index.py
+import logging
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from .embedding_codec import as_float32
+
+logger = logging.getLogger(__name__)
+
+# --- Дельта-сегмент индекса ---
+# Векторы, записанные в TrackEmbedding после начала построения текущей сборки Annoy.
+# Каждый веб-процесс держит их в памяти (обычно это десятки-сотни векторов) и ищет по ним точно,
+# одним матричным умножением; результаты сливаются с результатами Annoy по расстоянию.
+# При следующей перестройке эти векторы попадают в основной индекс, а дельта сбрасывается.
+
+
+def angular_distance(cosine):
+    """Угловое расстояние Annoy: sqrt(2 * (1 - cos))."""
+    return np.sqrt(np.maximum(2.0 - 2.0 * cosine, 0.0))
+
+
+def normalize(vector):
+    vector = as_float32(vector)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+NO_GENRE = -1 # Значение в genre_ids для треков без жанра
+
+
+class _DeltaState:
+    """Неизменяемое состояние дельты: поиск идет без блокировок, обновление подменяет объект целиком."""
+
+    def __init__(self, track_ids, vectors, genre_ids=None):
+        self.track_ids = track_ids # np.int64[n]
+        self.vectors = vectors # float32[n, dim], строки нормализованы
+        self.genre_ids = np.full(len(track_ids), NO_GENRE, dtype=np.int64) if genre_ids is None else genre_ids # np.int64[n]
+        self.rows = {int(track_id): row for row, track_id in enumerate(track_ids)}
+
+
+class DeltaIndex:
+    """Точный поиск по недавно посчитанным эмбеддингам активного пространства."""
+
+    def __init__(self, dimension, max_items=None, refresh_interval=None):
+        self.dimension = dimension
+        self.max_items = max_items or settings.ANNOY_DELTA_MAX_ITEMS
+        self.refresh_interval = settings.ANNOY_DELTA_REFRESH_INTERVAL if refresh_interval is None else refresh_interval
+        self._state = _DeltaState(np.empty(0, dtype=np.int64), np.empty((0, dimension), dtype=np.float32))
+        self._lock = threading.Lock()
+        self._space = None
+        self._cursor = None # updated_at последней прочитанной записи
+        self._cursor_track_id = 0 # track_id последней прочитанной записи (записи пачки имеют общий updated_at)
+        self._next_refresh = 0.0
+
+    def __len__(self):
+        return len(self._state.track_ids)
+
+    def __contains__(self, track_id):
+        return track_id in self._state.rows
+
+    @property
+    def version(self):
+        """Версия содержимого (одинаковая во всех процессах, дочитавших те же записи)."""
+        return f"{self._cursor.timestamp() if self._cursor else 0:.6f}-{self._cursor_track_id}x{len(self)}"
+
+    def reset(self, space, since):
+        """
+        Начинает дельту заново для новой сборки.
+        :param space: пространство сборки (None - активное, определится при первом обновлении)
+        :param since: момент начала построения сборки (None - сборки нет)
+        """
+        with self._lock:
+            self._state = _DeltaState(np.empty(0, dtype=np.int64), np.empty((0, self.dimension), dtype=np.float32))
+            self._space = space
+            self._cursor = since
+            self._cursor_track_id = 0
+            self._next_refresh = 0.0
+
+    def refresh(self, force=False):
+        """Дочитывает из БД эмбеддинги, записанные после курсора (не чаще refresh_interval)."""
+        now = time.monotonic()
+        if not force and now < self._next_refresh:
+            return 0
+        if not self._lock.acquire(blocking=False):
+            return 0 # Обновляет другой поток
+        try:
+            self._next_refresh = now + self.refresh_interval
+            from .embedding_store import active_space, embeddings_in_space
+            if self._space is None:
+                # Сборок еще не было: берем активное пространство (последние max_items эмбеддингов)
+                self._space = active_space()
+            rows = embeddings_in_space(self._space).values_list('track_id', 'embedding', 'updated_at', 'track__genre_id')
+            if self._cursor is not None:
+                # Страница вперед от курсора (updated_at, track_id), от старых к новым: то, что не поместилось,
+                # дочитает следующий вызов. Второй ключ нужен, потому что записи пачки (bulk_save_track_embeddings)
+                # могут иметь одинаковый updated_at: по одному времени курсор не сдвинулся бы с такой пачки
+                after_cursor = Q(updated_at__gt=self._cursor) | Q(updated_at=self._cursor, track_id__gt=self._cursor_track_id)
+                rows = list(rows.filter(after_cursor).order_by('updated_at', 'track_id')[:self.max_items + 1])
+            else:
+                # Сборок еще не было: только последние max_items (остальные попадут в первую сборку)
+                rows = list(rows.order_by('-updated_at', '-track_id')[:self.max_items + 1])[::-1]
+            truncated = len(rows) > self.max_items
+            if truncated:
+                rows = rows[-self.max_items:] if self._cursor is None else rows[:self.max_items]
+            if not rows:
+                return 0 # Новых записей нет: состояние не пересобираем
+            state = self._state
+            vectors = {int(track_id): state.vectors[row] for track_id, row in state.rows.items()}
+            genres = {int(track_id): int(state.genre_ids[row]) for track_id, row in state.rows.items()}
+            for track_id, embedding, _, genre_id in rows: # От старых к новым: новый вектор трека перекрывает старый
+                if embedding is not None and len(embedding) == self.dimension:
+                    vectors[track_id] = normalize(embedding)
+                    genres[track_id] = NO_GENRE if genre_id is None else genre_id
+            self._cursor, self._cursor_track_id = rows[-1][2], rows[-1][0]
+            if truncated and self._cursor is not None:
+                self._next_refresh = 0.0 # Не ждать refresh_interval: следующий запрос дочитает следующую страницу
+            if truncated or len(vectors) > self.max_items:
+                logger.warning(f"Delta segment is full ({len(vectors)} items, more pending: {truncated}). Requesting an Annoy rebuild.")
+                from .models import AnnoyIndexStatus
+                AnnoyIndexStatus.request_rebuild("delta segment full")
+            track_ids = np.fromiter(vectors.keys(), dtype=np.int64, count=len(vectors))
+            matrix = np.stack(list(vectors.values())) if vectors else np.empty((0, self.dimension), dtype=np.float32)
+            genre_ids = np.fromiter((genres[track_id] for track_id in vectors), dtype=np.int64, count=len(vectors))
+            self._state = _DeltaState(track_ids, matrix, genre_ids)
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Failed to refresh delta segment: {e}", exc_info=True)
+            return 0
+        finally:
+            self._lock.release()
+
+    def vector_for(self, track_id):
+        """Нормализованный вектор трека из дельты или None."""
+        state = self._state
+        row = state.rows.get(track_id)
+        return None if row is None else state.vectors[row]
+
+    def search(self, vector, k):
+        """
+        Точный поиск k ближайших в дельте.
+        :return: список (track_id, angular_distance), по возрастанию расстояния.
+        """
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors, k, genre_id=None):
+        """
+        Точный поиск для нескольких векторов одним матричным умножением (списки как у search).
+        :param genre_id: искать только среди треков этого жанра
+        """
+        state = self._state
+        track_ids, matrix = state.track_ids, state.vectors
+        if genre_id is not None:
+            rows = np.flatnonzero(state.genre_ids == genre_id)
+            track_ids, matrix = track_ids[rows], matrix[rows]
+        if not len(track_ids) or k <= 0:
+            return [[] for _ in vectors]
+        queries = np.stack([normalize(vector) for vector in vectors])
+        cosine = queries @ matrix.T
+        k = min(k, cosine.shape[1])
+        top = np.argpartition(-cosine, k - 1, axis=1)[:, :k] if k < cosine.shape[1] else np.broadcast_to(np.arange(cosine.shape[1]), cosine.shape)
+        top_cosine = np.take_along_axis(cosine, top, axis=1)
+        order = np.argsort(-top_cosine, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        distances = angular_distance(np.take_along_axis(top_cosine, order, axis=1))
+        return [
+            [(int(track_ids[i]), float(d)) for i, d in zip(row_top, row_distances)]
+            for row_top, row_distances in zip(top, distances)
+        ]
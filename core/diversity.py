@@ -0,0 +1,71 @@
+# core/diversity.py
+import logging
+import time
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Разнообразие выдачи (maximal marginal relevance) ---
+# Ближайшие соседи часто почти дубликаты друг друга (ремиксы, один альбом). MMR жадно выбирает n треков
+# из расширенного пула кандидатов: на каждом шаге - кандидат с наибольшим
+#   lambda * релевантность - (1 - lambda) * max(схожесть с уже выбранными).
+# Все попарные схожести пула - одно матричное умножение нормализованных векторов из общей матрицы сборки
+# (AnnoyService.vectors_for); дальше n шагов по массивам длины пула, без обращений к БД.
+# lambda = 1 - чистая релевантность (порядок пула не меняется), меньше - разнообразнее.
+
+
+def mmr_select(relevance, vectors, n, diversity_lambda):
+    """
+    Индексы n элементов пула в порядке выбора MMR.
+    :param relevance: float [m] - релевантность кандидатов (больше - лучше)
+    :param vectors: float32 [m, dim] - нормализованные векторы кандидатов (схожесть = скалярное произведение)
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    m = len(relevance)
+    n = min(n, m)
+    if n <= 0:
+        return []
+    similarity = vectors @ vectors.T # [m, m], одно матричное умножение
+    weighted = diversity_lambda * relevance
+    penalty = np.full(m, -np.inf, dtype=np.float32) # max схожести с выбранными
+    available = np.ones(m, dtype=bool)
+    selected = [int(np.argmax(relevance))] # Первым - самый релевантный
+    for _ in range(n - 1):
+        last = selected[-1]
+        available[last] = False
+        np.maximum(penalty, similarity[last], out=penalty)
+        scores = weighted - (1 - diversity_lambda) * penalty
+        scores[~available] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return selected
+
+
+def diversify(track_id, candidate_ids, n, diversity_lambda=None, boosts=None, boost_weight=0.0):
+    """
+    Разнообразные n треков из пула candidate_ids, похожих на трек track_id.
+    Релевантность - косинус с исходным треком; boosts ({ID трека: оценка}) подмешиваются
+    с весом boost_weight, как в гибридной оценке (core/colike.py).
+    Кандидаты без вектора остаются в конце в исходном порядке.
+    :return: список ID треков
+    """
+    diversity_lambda = settings.DIVERSITY_LAMBDA if diversity_lambda is None else diversity_lambda
+    candidate_ids = list(candidate_ids)
+    if diversity_lambda >= 1 or len(candidate_ids) <= 1:
+        return candidate_ids[:n]
+    from .annoy_service import annoy_service
+    started = time.perf_counter()
+    vectors, found = annoy_service.vectors_for([track_id, *candidate_ids])
+    if not found[0]:
+        return candidate_ids[:n]
+    pool = np.flatnonzero(found[1:])
+    pool_vectors = vectors[1:][pool]
+    relevance = pool_vectors @ vectors[0]
+    if boosts:
+        extra = np.array([boosts.get(candidate_ids[i], 0.0) for i in pool.tolist()], dtype=np.float32)
+        relevance = (1 - boost_weight) * relevance + boost_weight * extra
+    chosen = [candidate_ids[pool[i]] for i in mmr_select(relevance, pool_vectors, n, diversity_lambda)]
+    chosen_set = set(chosen)
+    result = chosen + [candidate_id for candidate_id in candidate_ids if candidate_id not in chosen_set][:n - len(chosen)]
+    logger.debug(f"MMR re-ranked {len(candidate_ids)} candidates for track {track_id} in {(time.perf_counter() - started) * 1000:.2f} ms")
+    return result
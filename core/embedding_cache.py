@@ -0,0 +1,122 @@
+# core/embedding_cache.py
+import hashlib
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Track, EmbeddingCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# --- Кеш эмбеддингов по содержимому файла ---
+# Ключ: (SHA-256 байтов файла, модель, версия препроцессинга). Один и тот же файл,
+# загруженный повторно (перезаливка, дубль альбома, трек на нескольких релизах),
+# получает эмбеддинг без CLAP-инференса.
+
+# Увеличивать при изменении декодирования аудио, которое влияет на вектор
+PREPROCESSING_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Счетчики живут в Django cache: общие для всех процессов при memcached/redis, локальные при LocMemCache.
+# Суммарные попадания по записям также хранятся в БД (EmbeddingCacheEntry.hit_count).
+HITS_KEY = 'embedding_cache:hits'
+MISSES_KEY = 'embedding_cache:misses'
+
+
+def preprocessing_version():
+    """Версия препроцессинга: номер алгоритма + параметры окон аудио."""
+    return f"v{PREPROCESSING_VERSION}:w{settings.EMBEDDING_AUDIO_WINDOW_SECONDS}x{settings.EMBEDDING_AUDIO_NUM_WINDOWS}"
+
+
+def current_model_name():
+    from .embedding_providers import get_embedding_provider
+    return get_embedding_provider().model_name
+
+
+def compute_content_hash(file):
+    """
+    Потоковый SHA-256 содержимого файла.
+    :param file: FieldFile / UploadedFile / File (читается чанками, позиция возвращается в начало).
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks(chunk_size=HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def _incr(key):
+    # add не перезапишет существующий счетчик; incr атомарен в memcached/redis
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def get_cached_embedding(content_hash, model_name=None):
+    """Возвращает эмбеддинг из кеша или None (учитывается в счетчиках попаданий/промахов)."""
+    if not content_hash:
+        return None
+    entry = EmbeddingCacheEntry.objects.filter(
+        content_hash=content_hash,
+        model_name=model_name or current_model_name(),
+        preprocessing_version=preprocessing_version(),
+    ).only('pk', 'embedding').first()
+    if entry is None:
+        _incr(MISSES_KEY)
+        return None
+    EmbeddingCacheEntry.objects.filter(pk=entry.pk).update(hit_count=F('hit_count') + 1, last_used_at=timezone.now())
+    _incr(HITS_KEY)
+    logger.info(f"Embedding cache hit for content hash {content_hash[:12]}")
+    return entry.embedding
+
+
+def store_cached_embedding(content_hash, embedding, model_name=None):
+    """Сохраняет эмбеддинг в кеш (повторная запись для того же ключа игнорируется)."""
+    if not content_hash or embedding is None or not len(embedding):
+        return
+    EmbeddingCacheEntry.objects.get_or_create(
+        content_hash=content_hash,
+        model_name=model_name or current_model_name(),
+        preprocessing_version=preprocessing_version(),
+        defaults={'embedding': embedding},
+    )
+
+
+def evict_unreferenced(grace_days=None, dry_run=False):
+    """
+    Удаляет записи кеша, которые не использовались дольше grace_days и при этом
+    не нужны ни одному треку: на их содержимое никто не ссылается или они посчитаны
+    другой моделью / старой версией препроцессинга.
+    Период ожидания нужен, чтобы пережить удаление и повторную загрузку того же файла.
+    :return: количество удаленных (или подлежащих удалению при dry_run) записей
+    """
+    grace_days = settings.EMBEDDING_CACHE_UNREFERENCED_GRACE_DAYS if grace_days is None else grace_days
+    cutoff = timezone.now() - timedelta(days=grace_days)
+    referenced = Track.objects.exclude(content_hash='').values('content_hash')
+    current = Q(model_name=current_model_name(), preprocessing_version=preprocessing_version())
+    to_delete = EmbeddingCacheEntry.objects.filter(last_used_at__lt=cutoff).filter(
+        ~Q(content_hash__in=referenced) | ~current
+    )
+    if dry_run:
+        return to_delete.count()
+    deleted, _ = to_delete.delete()
+    if deleted:
+        logger.info(f"Evicted {deleted} embedding cache entries.")
+    return deleted
+
+
+def embedding_cache_stats():
+    """Счетчики попаданий/промахов и размер кеша."""
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    return {
+        'entries': EmbeddingCacheEntry.objects.count(),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+    }
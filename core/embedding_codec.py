@@ -0,0 +1,96 @@
+# core/embedding_codec.py
+import base64
+import struct
+import numpy as np
+from django.conf import settings
+from django.db import models
+
+# --- Бинарное хранение эмбеддингов ---
+# Вектор хранится как little-endian blob с заголовком:
+#   2 байта  magic b'EV'
+#   1 байт   версия формата
+#   1 байт   тип (1 = float32, 2 = float16)
+#   4 байта  размерность (uint32)
+# 512 float32 = 2 KB вместо ~10 KB JSON, и чтение - это np.frombuffer без парсинга и копирования.
+
+MAGIC = b'EV'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<2sBBI')
+
+DTYPE_CODES = {'float32': 1, 'float16': 2}
+_NUMPY_DTYPES = {1: np.dtype('<f4'), 2: np.dtype('<f2')}
+
+
+def encode_embedding(vector, dtype=None):
+    """
+    Кодирует вектор (список / np.ndarray) в blob.
+    :param dtype: 'float32' или 'float16' (по умолчанию settings.EMBEDDING_STORAGE_DTYPE).
+    """
+    dtype = dtype or settings.EMBEDDING_STORAGE_DTYPE
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    code = DTYPE_CODES[dtype]
+    array = np.asarray(vector, dtype=_NUMPY_DTYPES[code])
+    if array.ndim != 1:
+        raise ValueError(f"Embedding must be one-dimensional, got shape {array.shape}")
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, code, array.shape[0]) + array.tobytes()
+
+
+def decode_embedding(blob):
+    """
+    Декодирует blob в np.ndarray без копирования (массив только для чтения, ссылается на blob).
+    float16 возвращается как есть; для вычислений используйте as_float32.
+    """
+    magic, version, code, dimension = _HEADER.unpack_from(blob, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or code not in _NUMPY_DTYPES:
+        raise ValueError(f"Not an embedding blob (magic={magic!r}, version={version}, dtype code={code})")
+    return np.frombuffer(blob, dtype=_NUMPY_DTYPES[code], count=dimension, offset=_HEADER.size)
+
+
+def as_float32(vector):
+    """Вектор как float32 (без копии, если он уже float32)."""
+    return np.asarray(vector, dtype=np.float32)
+
+
+class EmbeddingField(models.BinaryField):
+    """
+    BinaryField, который принимает список/np.ndarray и возвращает np.ndarray (см. decode_embedding).
+    Запись через .update(embedding=[...]) и bulk_update кодирует вектор автоматически.
+    dtype задает формат хранения поля (по умолчанию settings.EMBEDDING_STORAGE_DTYPE).
+    """
+
+    def __init__(self, *args, dtype=None, **kwargs):
+        self.dtype = dtype
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.dtype is not None:
+            kwargs['dtype'] = self.dtype
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return decode_embedding(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return decode_embedding(value)
+        if isinstance(value, str):
+            return decode_embedding(base64.b64decode(value.encode('ascii')))
+        return np.asarray(value, dtype=np.float32)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        return encode_embedding(value, self.dtype)
+
+    def value_to_string(self, obj):
+        # Сериализация (dumpdata): base64 от blob, как у BinaryField
+        value = self.value_from_object(obj)
+        if value is None:
+            return None
+        return base64.b64encode(self.get_prep_value(value)).decode('ascii')
@@ -0,0 +1,184 @@
+# core/embedding_providers.py
+import logging
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# --- Провайдеры эмбеддингов ---
+# Тяжелые зависимости (torch, transformers, librosa) импортируются только при первом
+# реальном вызове эмбеддинга. Процессы, которые ничего не эмбеддят (gunicorn-воркеры,
+# migrate и прочие manage.py команды), их не загружают вовсе.
+
+
+class EmbeddingProvider:
+    """
+    Базовый интерфейс провайдера эмбеддингов.
+    Наследники реализуют load_audio / embed_waveforms / embed_texts.
+    """
+    model_name = None # Идентификатор модели (например, имя чекпоинта HF)
+    dimension = settings.ANNOY_EMBEDDING_DIM # Размерность эмбеддинга
+    sampling_rate = None # Частота дискретизации, которую ожидает модель
+
+    def load_audio(self, audio_path):
+        """Загружает аудиофайл и готовит waveform (np.ndarray float32, моно) для модели."""
+        raise NotImplementedError
+
+    def embed_waveforms(self, waveforms):
+        """Эмбеддинги для списка waveform. :return: список списков float (нормализованные векторы)."""
+        raise NotImplementedError
+
+    def embed_texts(self, texts):
+        """Эмбеддинги для списка текстовых запросов в том же пространстве, что и аудио."""
+        raise NotImplementedError
+
+    def embed_audio(self, audio_path):
+        """Эмбеддинг одного аудиофайла."""
+        return self.embed_waveforms([self.load_audio(audio_path)])[0]
+
+
+class ClapEmbeddingProvider(EmbeddingProvider):
+    """Провайдер на базе CLAP (transformers). Модель загружается лениво, один раз на процесс."""
+    model_name = "laion/clap-htsat-unfused"
+    sampling_rate = 48000 # Совпадает с feature_extractor.sampling_rate у CLAP, проверяется после загрузки
+
+    def __init__(self, model_name=None):
+        if model_name:
+            self.model_name = model_name
+        self._model = None
+        self._processor = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def _ensure_loaded(self):
+        """Загружает модель и процессор CLAP при первом обращении."""
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+            from transformers import ClapModel, ClapProcessor
+            logger.info(f"Loading CLAP model: {self.model_name}...")
+            model = ClapModel.from_pretrained(self.model_name)
+            model.eval()
+            self._processor = ClapProcessor.from_pretrained(self.model_name)
+            processor_sr = self._processor.feature_extractor.sampling_rate
+            if processor_sr != self.sampling_rate:
+                logger.warning(f"CLAP processor sampling rate {processor_sr} differs from default {self.sampling_rate}. Using {processor_sr}.")
+                self.sampling_rate = processor_sr
+            self._model = model
+            logger.info("CLAP model loaded successfully.")
+
+    def load_audio(self, audio_path):
+        from .audio_io import load_audio_windows
+        # Декодируем только окна, которые реально увидит модель, сразу в частоте процессора
+        windows = load_audio_windows(
+            audio_path, self.sampling_rate,
+            window_seconds=settings.EMBEDDING_AUDIO_WINDOW_SECONDS,
+            num_windows=settings.EMBEDDING_AUDIO_NUM_WINDOWS,
+        )
+        return windows[0] if len(windows) == 1 else np.concatenate(windows)
+
+    def embed_waveforms(self, waveforms):
+        import torch
+        self._ensure_loaded()
+        inputs = self._processor(audios=list(waveforms), sampling_rate=self.sampling_rate, return_tensors="pt", padding=True)
+        with torch.no_grad():
+            features = self._model.get_audio_features(**inputs)
+        # Нормализация эмбеддингов
+        features = features / torch.linalg.norm(features, dim=-1, keepdim=True)
+        return features.tolist()
+
+    def embed_texts(self, texts):
+        import torch
+        self._ensure_loaded()
+        inputs = self._processor(text=list(texts), return_tensors="pt", padding=True)
+        with torch.no_grad():
+            features = self._model.get_text_features(**inputs)
+        features = features / torch.linalg.norm(features, dim=-1, keepdim=True)
+        return features.tolist()
+
+
+class SidecarEmbeddingProvider(EmbeddingProvider):
+    """
+    Провайдер, который отправляет запросы на локальный сервер инференса
+    (`manage.py run_inference_server`, см. core/inference_server.py).
+    Если сервер недоступен или не ответил вовремя, эмбеддинг считается в процессе
+    (fallback-провайдер грузит свою копию модели только при первой такой ошибке).
+    """
+    model_name = ClapEmbeddingProvider.model_name
+
+    def __init__(self, client=None, fallback_provider_class=None):
+        from .inference_server import InferenceClient
+        self.client = client or InferenceClient()
+        self._fallback_provider_class = fallback_provider_class or ClapEmbeddingProvider
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        # После ошибки подключения не стучимся в сервер до этого момента (monotonic)
+        self._server_down_until = 0.0
+
+    def _get_fallback(self, error):
+        if not settings.EMBEDDING_CLIENT_FALLBACK:
+            raise error
+        if self._fallback is None:
+            with self._fallback_lock:
+                if self._fallback is None:
+                    self._fallback = self._fallback_provider_class()
+        return self._fallback
+
+    def _call_server(self, method, *args):
+        """Вызывает метод клиента. :return: (результат, None) или (None, ошибка), если сервер недоступен и нужен fallback."""
+        from .inference_server import InferenceServerError
+        if time.monotonic() < self._server_down_until:
+            return None, ConnectionError("Inference server marked as unavailable")
+        try:
+            return getattr(self.client, method)(*args), None
+        except InferenceServerError:
+            # Сервер жив, но не смог обработать запрос (битый файл и т.п.): в процессе будет то же самое
+            raise
+        except (OSError, ValueError) as e:
+            # Сокета нет, соединение сброшено или таймаут (socket.timeout - подкласс OSError)
+            self._server_down_until = time.monotonic() + settings.EMBEDDING_CLIENT_RETRY_AFTER_SECONDS
+            logger.warning(f"Inference server unavailable ({e}). Falling back to in-process inference.")
+            return None, e
+
+    def load_audio(self, audio_path):
+        return self._get_fallback(RuntimeError("load_audio requires in-process inference")).load_audio(audio_path)
+
+    def embed_waveforms(self, waveforms):
+        # Сырые waveform по сокету не передаем: это только путь для in-process инференса
+        return self._get_fallback(RuntimeError("embed_waveforms requires in-process inference")).embed_waveforms(waveforms)
+
+    def embed_audio(self, audio_path):
+        embedding, error = self._call_server('embed_audio', audio_path)
+        if error is None:
+            return embedding
+        return self._get_fallback(error).embed_audio(audio_path)
+
+    def embed_texts(self, texts):
+        embeddings, error = self._call_server('embed_texts', texts)
+        if error is None:
+            return embeddings
+        return self._get_fallback(error).embed_texts(texts)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_embedding_provider():
+    """Возвращает провайдер эмбеддингов процесса (класс задается settings.EMBEDDING_PROVIDER)."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                provider_class = import_string(settings.EMBEDDING_PROVIDER)
+                _provider = provider_class()
+                logger.info(f"Embedding provider initialized: {settings.EMBEDDING_PROVIDER} ({_provider.model_name})")
+    return _provider
@@ -0,0 +1,240 @@
+# core/embedding_queue.py
+import logging
+import math
+import os
+import socket
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+from .models import Track, EmbeddingJob, AnnoyIndexStatus
+from .embedding_cache import get_cached_embedding, store_cached_embedding
+from .embedding_store import save_track_embedding
+
+logger = logging.getLogger(__name__)
+
+# --- Очередь задач генерации эмбеддингов (в БД) ---
+# Загрузка трека только ставит задачу (enqueue_embedding), а сам CLAP-инференс
+# выполняют отдельные процессы `manage.py run_embedding_worker`.
+# Воркеры забирают задачи с арендой (lease): задача закрепляется за воркером до locked_until,
+# и если воркер умер, после истечения аренды задачу подберет другой.
+
+
+def default_worker_id():
+    """Идентификатор воркера: хост + PID (уникален в пределах кластера)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_embedding(track):
+    """
+    Ставит (или перезапускает) задачу генерации эмбеддинга для трека.
+    Если эмбеддинг для такого же содержимого файла уже есть в кеше, вектор записывается сразу,
+    а задача закрывается без инференса.
+    """
+    cached = get_cached_embedding(track.content_hash)
+    if cached is not None:
+        save_track_embedding(track.pk, cached)
+        # Сбрасываем аренду: результат воркера, который еще считает старый файл, будет отброшен
+        EmbeddingJob.objects.update_or_create(
+            track=track,
+            defaults={'status': EmbeddingJob.STATUS_DONE, 'attempts': 0, 'last_error': '', 'locked_by': '', 'locked_until': None},
+        )
+        AnnoyIndexStatus.request_rebuild(f"cached embedding for Track ID {track.pk}")
+        logger.info(f"Embedding for Track ID: {track.pk} taken from cache, no inference needed.")
+        return None
+
+    job, created = EmbeddingJob.objects.update_or_create(
+        track=track,
+        defaults={
+            'status': EmbeddingJob.STATUS_PENDING,
+            'attempts': 0,
+            'last_error': '',
+            'available_at': timezone.now(),
+            # Сбрасываем аренду: если старая задача еще выполняется, ее результат будет отброшен
+            'locked_by': '',
+            'locked_until': None,
+        },
+    )
+    logger.info(f"Embedding job {'created' if created else 're-queued'} for Track ID: {track.pk}")
+    return job
+
+
+def recover_expired_jobs(max_attempts=None):
+    """
+    Возвращает в очередь задачи, аренда которых истекла (воркер упал или завис).
+    Задачи, исчерпавшие попытки, помечаются как failed.
+    :return: (количество возвращенных, количество проваленных)
+    """
+    max_attempts = max_attempts or settings.EMBEDDING_JOB_MAX_ATTEMPTS
+    now = timezone.now()
+    expired = EmbeddingJob.objects.filter(status=EmbeddingJob.STATUS_RUNNING, locked_until__lt=now)
+
+    failed = expired.filter(attempts__gte=max_attempts).update(
+        status=EmbeddingJob.STATUS_FAILED,
+        last_error='Lease expired (worker died or timed out)',
+        locked_by='',
+        locked_until=None,
+    )
+    requeued = expired.filter(attempts__lt=max_attempts).update(
+        status=EmbeddingJob.STATUS_PENDING,
+        available_at=now,
+        locked_by='',
+        locked_until=None,
+    )
+    if requeued or failed:
+        logger.warning(f"Recovered expired embedding jobs: {requeued} re-queued, {failed} marked as failed.")
+    return requeued, failed
+
+
+def claim_embedding_jobs(worker_id, limit=1, lease_seconds=None):
+    """
+    Забирает до `limit` готовых к выполнению задач и закрепляет их за воркером.
+    Захват делается условным UPDATE (compare-and-set по статусу), поэтому несколько
+    воркеров на разных машинах могут безопасно разбирать одну очередь.
+    """
+    lease_seconds = lease_seconds or settings.EMBEDDING_JOB_LEASE_SECONDS
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=lease_seconds)
+
+    # Берем кандидатов с запасом: часть из них могут перехватить другие воркеры
+    candidate_ids = list(
+        EmbeddingJob.objects
+        .filter(status=EmbeddingJob.STATUS_PENDING, available_at__lte=now)
+        .order_by('available_at', 'pk')
+        .values_list('pk', flat=True)[:limit * 4]
+    )
+
+    claimed_ids = []
+    for job_id in candidate_ids:
+        updated = EmbeddingJob.objects.filter(pk=job_id, status=EmbeddingJob.STATUS_PENDING).update(
+            status=EmbeddingJob.STATUS_RUNNING,
+            attempts=F('attempts') + 1,
+            locked_by=worker_id,
+            locked_until=lease_until,
+        )
+        if updated:
+            claimed_ids.append(job_id)
+            if len(claimed_ids) >= limit:
+                break
+
+    return list(EmbeddingJob.objects.select_related('track').filter(pk__in=claimed_ids).order_by('available_at', 'pk'))
+
+
+def complete_embedding_job(job, worker_id, embedding):
+    """
+    Сохраняет эмбеддинг и закрывает задачу.
+    Если аренду успел забрать другой воркер (или трек перезалили), результат отбрасывается.
+    :return: True, если результат записан.
+    """
+    with transaction.atomic():
+        updated = EmbeddingJob.objects.filter(
+            pk=job.pk, status=EmbeddingJob.STATUS_RUNNING, locked_by=worker_id,
+        ).update(
+            status=EmbeddingJob.STATUS_DONE,
+            last_error='',
+            locked_by='',
+            locked_until=None,
+        )
+        if not updated:
+            logger.warning(f"Embedding job {job.pk} (Track ID: {job.track_id}) lost its lease. Result discarded.")
+            return False
+        save_track_embedding(job.track_id, embedding)
+
+    store_cached_embedding(job.track.content_hash, embedding)
+    AnnoyIndexStatus.request_rebuild(f"new embedding for Track ID {job.track_id}")
+    logger.info(f"Embedding saved successfully for Track ID: {job.track_id}")
+    return True
+
+
+def fail_embedding_job(job, worker_id, error, max_attempts=None, retry=True):
+    """
+    Фиксирует ошибку задачи. Пока попытки не исчерпаны, задача возвращается в очередь
+    с экспоненциальной задержкой, иначе помечается как failed.
+    """
+    max_attempts = max_attempts or settings.EMBEDDING_JOB_MAX_ATTEMPTS
+    # attempts в объекте мог устареть (инкремент делался через F()), перечитываем
+    attempts = EmbeddingJob.objects.filter(pk=job.pk).values_list('attempts', flat=True).first() or 0
+
+    if retry and attempts < max_attempts:
+        delay = settings.EMBEDDING_JOB_RETRY_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0))
+        fields = {'status': EmbeddingJob.STATUS_PENDING, 'available_at': timezone.now() + timedelta(seconds=delay)}
+        logger.warning(f"Embedding job {job.pk} (Track ID: {job.track_id}) failed (attempt {attempts}/{max_attempts}), retry in {delay}s: {error}")
+    else:
+        fields = {'status': EmbeddingJob.STATUS_FAILED}
+        logger.error(f"Embedding job {job.pk} (Track ID: {job.track_id}) failed permanently after {attempts} attempts: {error}")
+
+    EmbeddingJob.objects.filter(pk=job.pk, status=EmbeddingJob.STATUS_RUNNING, locked_by=worker_id).update(
+        last_error=str(error)[:2000],
+        locked_by='',
+        locked_until=None,
+        **fields,
+    )
+
+
+def release_embedding_job(job, worker_id):
+    """Возвращает взятую, но не начатую задачу в очередь (например, при остановке воркера)."""
+    EmbeddingJob.objects.filter(pk=job.pk, status=EmbeddingJob.STATUS_RUNNING, locked_by=worker_id).update(
+        status=EmbeddingJob.STATUS_PENDING,
+        attempts=F('attempts') - 1,
+        locked_by='',
+        locked_until=None,
+    )
+
+
+def _probe_duration(track, audio_path):
+    """Длительность файлов, заголовки которых не прочитались при загрузке (веб-процесс не декодирует аудио)."""
+    from .audio_io import probe_audio
+    try:
+        duration = math.ceil(probe_audio(audio_path).duration)
+    except Exception as e:
+        logger.warning(f"Could not determine duration for Track ID {track.pk}: {e}")
+        return
+    Track.objects.filter(pk=track.pk).update(duration=duration)
+    logger.info(f"Duration for Track ID {track.pk} determined by the worker: {duration}s")
+
+
+def process_embedding_job(job, worker_id):
+    """Выполняет одну задачу: генерирует эмбеддинг для файла трека и сохраняет результат."""
+    track = job.track
+    if not track.filepath:
+        fail_embedding_job(job, worker_id, "Track has no audio file", retry=False)
+        return False
+
+    full_audio_path = os.path.join(settings.MEDIA_ROOT, track.filepath.name)
+    if not os.path.exists(full_audio_path):
+        fail_embedding_job(job, worker_id, f"Audio file not found: {full_audio_path}", retry=False)
+        return False
+
+    if not track.duration:
+        _probe_duration(track, full_audio_path)
+
+    # Такой же файл мог быть посчитан, пока задача ждала в очереди
+    cached = get_cached_embedding(track.content_hash)
+    if cached is not None:
+        return complete_embedding_job(job, worker_id, cached)
+
+    try:
+        # Импорт здесь: модель CLAP нужна только процессам-воркерам
+        from .utils import generate_clap_embedding
+        logger.info(f"Generating embedding for Track ID: {track.pk}, file: {full_audio_path}")
+        embedding = generate_clap_embedding(full_audio_path)
+    except Exception as e:
+        logger.error(f"Error during embedding generation for Track ID {track.pk}: {e}", exc_info=True)
+        fail_embedding_job(job, worker_id, e)
+        return False
+
+    if not embedding:
+        fail_embedding_job(job, worker_id, "Embedding generation returned no result (see worker logs)")
+        return False
+
+    return complete_embedding_job(job, worker_id, embedding)
+
+
+def embedding_queue_stats():
+    """Количество задач по статусам (для админки и логов воркера)."""
+    counts = {status: 0 for status, _ in EmbeddingJob.STATUS_CHOICES}
+    for row in EmbeddingJob.objects.values('status').annotate(count=Count('pk')):
+        counts[row['status']] = row['count']
+    return counts
+
@@ -0,0 +1,164 @@
+# core/embedding_store.py
+import logging
+from collections import namedtuple
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Track, TrackEmbedding, AnnoyIndexStatus
+from .embedding_cache import current_model_name, preprocessing_version
+
+logger = logging.getLogger(__name__)
+
+# --- Хранилище эмбеддингов по пространствам ---
+# Пространство = (модель, версия препроцессинга). Есть два пространства:
+#   целевое (target) - то, что считает текущий провайдер; в него пишут воркеры и backfill_embeddings;
+#   активное (active) - то, по которому построен обслуживаемый индекс Annoy (хранится в AnnoyIndexStatus).
+# При смене модели целевое пространство досчитывается в фоне (shadow re-embedding), а индекс
+# продолжает строиться по активному. Когда покрытие целевого пространства достигает
+# EMBEDDING_SPACE_SWITCH_COVERAGE, индекс перестраивается по нему и активное пространство переключается.
+# Пока переключение не произошло, новые загрузки (save_track_embedding) дублируются в активное пространство,
+# если оно отличается только версией препроцессинга (модель та же - векторы сравнимы): иначе свежие треки
+# не попали бы ни в индекс, ни в его дельту до конца досчета. При смене самой модели векторы несравнимы,
+# и новые треки появляются в рекомендациях только после переключения.
+# Запись в активное пространство согласует векторы вкуса голосовавших за трек (после коммита, см. core/taste.py).
+
+EmbeddingSpace = namedtuple('EmbeddingSpace', ['model_name', 'preprocessing_version'])
+
+
+def target_space():
+    """Пространство, в котором считает эмбеддинги текущий провайдер."""
+    return EmbeddingSpace(current_model_name(), preprocessing_version())
+
+
+def active_space(status=None):
+    """Пространство обслуживаемого индекса (при первом запуске совпадает с целевым)."""
+    status = status or AnnoyIndexStatus.objects.get_or_create(singleton_instance_id=1)[0]
+    if not status.active_model_name:
+        return target_space()
+    return EmbeddingSpace(status.active_model_name, status.active_preprocessing_version)
+
+
+def embeddings_in_space(space):
+    return TrackEmbedding.objects.filter(model_name=space.model_name, preprocessing_version=space.preprocessing_version)
+
+
+def mirror_space():
+    """
+    Активное пространство, в которое нужно дублировать векторы целевого, или None:
+    только пока переключение не произошло и модель у пространств одна.
+    """
+    if not settings.EMBEDDING_MIRROR_TO_ACTIVE_SPACE:
+        return None
+    active, target = active_space(), target_space()
+    if active == target or active.model_name != target.model_name:
+        return None
+    return active
+
+
+def _reconcile_tastes(track_ids, replaced_ids):
+    """После коммита: голоса за треки с новым вектором активного пространства учитываются во вкусе."""
+    if not track_ids:
+        return
+
+    def reconcile():
+        from .taste import reconcile_track_tastes
+        try:
+            reconcile_track_tastes(track_ids, replaced_ids)
+        except Exception as e:
+            logger.error(f"Failed to reconcile taste vectors for tracks {track_ids[:10]}: {e}", exc_info=True)
+
+    transaction.on_commit(reconcile)
+
+
+def save_track_embedding(track_id, embedding, space=None):
+    """
+    Записывает (или заменяет) эмбеддинг трека в пространстве (по умолчанию целевом).
+    Вектор целевого пространства дублируется в активное (см. mirror_space), чтобы трек сразу попал в дельту индекса.
+    """
+    spaces = [space] if space else [target_space(), mirror_space()]
+    active = active_space()
+    for space in filter(None, spaces):
+        _, created = TrackEmbedding.objects.update_or_create(
+            track_id=track_id,
+            model_name=space.model_name,
+            preprocessing_version=space.preprocessing_version,
+            defaults={'embedding': embedding},
+        )
+        if space == active:
+            _reconcile_tastes([track_id], [] if created else [track_id])
+
+
+def bulk_save_track_embeddings(pairs, space=None):
+    """
+    Пакетная запись эмбеддингов одним запросом (upsert).
+    :param pairs: список (track_id, embedding)
+    """
+    space = space or target_space()
+    now = timezone.now()
+    in_active = space == active_space()
+    replaced_ids = []
+    if in_active:
+        # Векторы, которые заменяются: их старые значения уже учтены во вкусах
+        replaced_ids = list(embeddings_in_space(space).filter(
+            track_id__in=[track_id for track_id, _ in pairs],
+        ).values_list('track_id', flat=True))
+    TrackEmbedding.objects.bulk_create(
+        [
+            TrackEmbedding(
+                track_id=track_id, model_name=space.model_name, preprocessing_version=space.preprocessing_version,
+                embedding=embedding, updated_at=now,
+            )
+            for track_id, embedding in pairs
+        ],
+        update_conflicts=True,
+        unique_fields=['track', 'model_name', 'preprocessing_version'],
+        update_fields=['embedding', 'updated_at'],
+    )
+    if in_active:
+        _reconcile_tastes([track_id for track_id, _ in pairs], replaced_ids)
+
+
+def get_track_embedding(track_id, space=None):
+    """Эмбеддинг трека (np.ndarray) в пространстве (по умолчанию активном) или None."""
+    space = space or active_space()
+    return embeddings_in_space(space).filter(track_id=track_id).values_list('embedding', flat=True).first()
+
+
+def tracks_missing_embedding(space=None):
+    """Треки с аудиофайлом, у которых нет эмбеддинга в пространстве (по умолчанию целевом)."""
+    space = space or target_space()
+    return Track.objects.exclude(filepath='').exclude(
+        pk__in=embeddings_in_space(space).values('track_id'),
+    )
+
+
+def space_coverage(space):
+    """Доля треков с аудиофайлом, у которых есть эмбеддинг в пространстве (0..1)."""
+    total = Track.objects.exclude(filepath='').count()
+    if not total:
+        return 1.0
+    covered = embeddings_in_space(space).filter(track__in=Track.objects.exclude(filepath='')).count()
+    return covered / total
+
+
+def pending_space_switch(status=None):
+    """
+    Возвращает целевое пространство, если на него пора переключить индекс, иначе None.
+    """
+    active = active_space(status)
+    target = target_space()
+    if target == active:
+        return None
+    coverage = space_coverage(target)
+    if coverage < settings.EMBEDDING_SPACE_SWITCH_COVERAGE:
+        logger.info(f"Shadow re-embedding for {target} in progress: coverage {coverage:.1%} (switch at {settings.EMBEDDING_SPACE_SWITCH_COVERAGE:.0%}).")
+        return None
+    return target
+
+
+def activate_space(status, space):
+    """Делает пространство активным (вызывается после того, как индекс по нему построен и сохранен)."""
+    status.active_model_name = space.model_name
+    status.active_preprocessing_version = space.preprocessing_version
+    status.save(update_fields=['active_model_name', 'active_preprocessing_version'])
+    logger.info(f"Active embedding space switched to {space}.")
@@ -6,7 +6,7 @@ from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 class TrackForm(forms.ModelForm):
     class Meta:
         model = Track
-        exclude = ('embedding', 'duration')
+        exclude = ('duration',)
         widgets = {
             'title': forms.TextInput(attrs={'class': 'form-control'}),
             'artist': forms.TextInput(attrs={'class': 'form-control'}),
@@ -0,0 +1,91 @@
+# core/genre_partitions.py
+import logging
+import threading
+from collections import defaultdict, namedtuple
+from django.conf import settings
+from .item_map import ItemMap, build_paths
+from .vector_backends import ExactBackend, get_backend_class, select_backend
+
+logger = logging.getLogger(__name__)
+
+# --- Разделы индекса по жанрам ---
+# Вместе с основным индексом сборка строит раздел для каждого жанра: жанры от GENRE_PARTITION_MIN_ITEMS
+# треков получают собственный индекс (бэкенд выбирается по размеру жанра, как для всего каталога),
+# меньшие - точный перебор (exact). Поиск "похожие в этом жанре" идет только по разделу жанра,
+# поэтому стоит столько же, сколько обычный, и не требует запрашивать лишних кандидатов для фильтрации.
+# Файлы раздела: <build_id>.genre-<genre_id><расширение бэкенда> и <build_id>.genre-<genre_id>.imap;
+# список разделов (жанр -> бэкенд, число треков) записывается в манифест сборки.
+
+Partition = namedtuple('Partition', ['index', 'item_map', 'backend_name'])
+
+
+def partition_paths(index_dir, build_id, genre_id, index_extension):
+    return build_paths(index_dir, f"{build_id}.genre-{genre_id}", index_extension)
+
+
+def build_genre_partitions(index_dir, build_id, source_index, track_ids, slot_genres, dimension, metric,
+                           num_trees=None, backend=None):
+    """
+    Строит разделы по жанрам из векторов уже построенного основного индекса (БД повторно не читается).
+    :param slot_genres: slot_genres[slot] = ID жанра трека (None - без жанра, в разделы не попадает)
+    :return: описание разделов для манифеста {str(genre_id): {'backend': ..., 'items': ...}}
+    """
+    slots_by_genre = defaultdict(list)
+    for slot, genre_id in enumerate(slot_genres):
+        if genre_id is not None:
+            slots_by_genre[genre_id].append(slot)
+
+    partitions = {}
+    for genre_id, slots in sorted(slots_by_genre.items()):
+        if len(slots) >= settings.GENRE_PARTITION_MIN_ITEMS:
+            backend_name, backend_class = select_backend(len(slots), backend)
+        else:
+            backend_name, backend_class = 'exact', ExactBackend
+        index_path, map_path = partition_paths(index_dir, build_id, genre_id, backend_class.file_extension)
+        index = backend_class(dimension, metric)
+        built_on_disk = index.build_on_disk(index_path, max_items=len(slots))
+        for partition_slot, slot in enumerate(slots):
+            index.add_item(partition_slot, source_index.get_item_vector(slot))
+        index.build(num_trees=num_trees)
+        if not built_on_disk:
+            index.save(index_path)
+        ItemMap.from_track_ids([track_ids[slot] for slot in slots], build_id=build_id).save(map_path)
+        partitions[str(genre_id)] = {'backend': backend_name, 'items': len(slots)}
+    logger.info(f"Built {len(partitions)} genre partitions for build {build_id}.")
+    return partitions
+
+
+class GenrePartitions:
+    """Разделы одной сборки; файлы раздела открываются (mmap) при первом запросе по жанру."""
+
+    def __init__(self, index_dir=None, build_id=None, dimension=None, metric=None, partitions=None):
+        self.index_dir = index_dir
+        self.build_id = build_id
+        self.dimension = dimension
+        self.metric = metric
+        self.spec = {int(genre_id): info for genre_id, info in (partitions or {}).items()}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.spec)
+
+    def __contains__(self, genre_id):
+        return genre_id in self.spec
+
+    def get(self, genre_id):
+        """Раздел жанра или None, если в сборке нет треков этого жанра."""
+        partition = self._loaded.get(genre_id)
+        if partition is not None or genre_id not in self.spec:
+            return partition
+        with self._lock:
+            partition = self._loaded.get(genre_id)
+            if partition is None:
+                backend_name = self.spec[genre_id]['backend']
+                backend_class = get_backend_class(backend_name)
+                index_path, map_path = partition_paths(self.index_dir, self.build_id, genre_id, backend_class.file_extension)
+                partition = Partition(
+                    backend_class.load(index_path, self.dimension, self.metric), ItemMap.load(map_path), backend_name,
+                )
+                self._loaded[genre_id] = partition
+        return partition
@@ -0,0 +1,263 @@
+# core/inference_server.py
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Локальный сервер инференса CLAP (sidecar) ---
+# Один долгоживущий процесс (`manage.py run_inference_server`) держит единственный экземпляр модели
+# и принимает запросы по Unix-сокету. Одновременные запросы склеиваются в один forward pass
+# (micro-batching): батч отправляется в модель, когда набралось max_batch_size элементов
+# или прошло max_wait_ms с момента первого запроса в батче.
+# Модуль не импортирует torch: клиент (SidecarEmbeddingProvider) использует только протокол.
+
+# Протокол: сообщение = 4 байта длины (big-endian) + JSON
+_HEADER = struct.Struct('>I')
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+
+class InferenceServerError(Exception):
+    """Ошибка, которую вернул сервер инференса (запрос дошел, но обработать его не удалось)."""
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_message(sock, payload):
+    """Отправляет JSON-сообщение с префиксом длины."""
+    data = json.dumps(payload).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    """Читает одно JSON-сообщение с префиксом длины."""
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > MAX_MESSAGE_BYTES:
+        raise ConnectionError(f"Message too large: {size} bytes")
+    return json.loads(_recv_exact(sock, size).decode('utf-8'))
+
+
+class MicroBatcher:
+    """
+    Склеивает одиночные запросы из разных потоков в батчи.
+    :param batch_fn: функция (список входов) -> список результатов той же длины.
+    """
+
+    def __init__(self, batch_fn, max_batch_size, max_wait_ms, name='batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._stopped = False
+        self.batches = 0 # Статистика для логов
+        self.items = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
+
+    def submit(self, item):
+        """Ставит вход в очередь и возвращает Future с результатом."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is None:
+                self._stopped = True
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while not self._stopped:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            # Клиент мог отвалиться по таймауту, пока запрос ждал в очереди
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                logger.error(f"[{self.name}] Batch of {len(batch)} failed: {e}", exc_info=True)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            self.batches += 1
+            self.items += len(batch)
+            logger.debug(f"[{self.name}] Batch of {len(batch)} done in {time.perf_counter() - started:.3f}s")
+
+
+def configure_torch_threads(intra_op_threads, inter_op_threads=1):
+    """
+    Ограничивает число потоков torch, чтобы сервер не конкурировал за ядра с веб-воркерами.
+    Должно вызываться до первого инференса (inter-op пул torch фиксируется при первом использовании).
+    """
+    os.environ.setdefault('OMP_NUM_THREADS', str(intra_op_threads))
+    os.environ.setdefault('MKL_NUM_THREADS', str(intra_op_threads))
+    import torch
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError as e:
+        # Пул уже создан (torch успел что-то посчитать в этом процессе)
+        logger.warning(f"Could not set torch inter-op threads: {e}")
+    logger.info(f"Torch threads pinned: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """Обрабатывает запросы одного клиента (соединение может нести несколько запросов подряд)."""
+
+    def handle(self):
+        server = self.server.inference_server
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            except ValueError as e:
+                send_message(self.request, {'ok': False, 'error': f"Malformed request: {e}"})
+                return
+            try:
+                response = {'ok': True, **server.handle_request(request)}
+            except Exception as e:
+                logger.warning(f"Inference request failed: {e}")
+                response = {'ok': False, 'error': str(e)}
+            try:
+                send_message(self.request, response)
+            except OSError:
+                return
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+    """
+    Сервер инференса поверх провайдера эмбеддингов процесса.
+    Декодирование аудио выполняется в потоках соединений (параллельно),
+    а forward pass - в двух батчерах (аудио и текст) на одном экземпляре модели.
+    """
+
+    def __init__(self, provider, socket_path=None, max_batch_size=None, max_wait_ms=None):
+        self.provider = provider
+        self.socket_path = str(socket_path or settings.EMBEDDING_SERVER_SOCKET)
+        max_batch_size = max_batch_size or settings.EMBEDDING_SERVER_MAX_BATCH_SIZE
+        max_wait_ms = settings.EMBEDDING_SERVER_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms
+        self.audio_batcher = MicroBatcher(provider.embed_waveforms, max_batch_size, max_wait_ms, name='audio-batcher')
+        self.text_batcher = MicroBatcher(provider.embed_texts, max_batch_size, max_wait_ms, name='text-batcher')
+        self._server = None
+
+    def handle_request(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'model_name': self.provider.model_name, 'dimension': self.provider.dimension}
+        if op == 'embed_audio':
+            waveform = self.provider.load_audio(request['path'])
+            return {'embedding': self.audio_batcher.submit(waveform).result()}
+        if op == 'embed_texts':
+            futures = [self.text_batcher.submit(text) for text in request['texts']]
+            # Модель в ответе: клиент проверяет, что текст попал в пространство индекса (core/text_search.py)
+            return {'embeddings': [future.result() for future in futures], 'model_name': self.provider.model_name}
+        raise ValueError(f"Unknown op: {op!r}")
+
+    def serve_forever(self):
+        # Старый сокет мог остаться после некорректного завершения
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.audio_batcher.start()
+        self.text_batcher.start()
+        self._server = _ThreadingUnixServer(self.socket_path, _RequestHandler)
+        self._server.inference_server = self
+        os.chmod(self.socket_path, 0o660)
+        logger.info(f"Inference server listening on {self.socket_path}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self.audio_batcher.stop()
+            self.text_batcher.stop()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            logger.info(
+                f"Inference server stopped. Audio: {self.audio_batcher.items} items in {self.audio_batcher.batches} batches, "
+                f"text: {self.text_batcher.items} items in {self.text_batcher.batches} batches."
+            )
+
+    def shutdown(self):
+        """Останавливает serve_forever (вызывать из другого потока)."""
+        if self._server is not None:
+            self._server.shutdown()
+
+
+class InferenceClient:
+    """Клиент сервера инференса. Одно соединение на запрос, с таймаутами на подключение и ответ."""
+
+    def __init__(self, socket_path=None, connect_timeout=None, timeout=None):
+        self.socket_path = str(socket_path or settings.EMBEDDING_SERVER_SOCKET)
+        self.connect_timeout = connect_timeout or settings.EMBEDDING_CLIENT_CONNECT_TIMEOUT
+        self.timeout = timeout or settings.EMBEDDING_CLIENT_TIMEOUT
+
+    def request(self, payload):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.connect_timeout)
+            sock.connect(self.socket_path)
+            sock.settimeout(self.timeout)
+            send_message(sock, payload)
+            response = recv_message(sock)
+        if not response.get('ok'):
+            raise InferenceServerError(response.get('error') or 'Unknown inference server error')
+        return response
+
+    def ping(self):
+        return self.request({'op': 'ping'})
+
+    def embed_audio(self, audio_path):
+        # Передаем путь, а не waveform: сервер и воркеры работают на одной машине с общим MEDIA_ROOT
+        return self.request({'op': 'embed_audio', 'path': os.path.abspath(audio_path)})['embedding']
+
+    def embed_texts(self, texts):
+        return self.request({'op': 'embed_texts', 'texts': list(texts)})['embeddings']
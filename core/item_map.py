@@ -0,0 +1,215 @@
+# core/item_map.py
+import json
+import logging
+import os
+import socket
+import struct
+import uuid
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- Карта слотов Annoy <-> ID треков ---
+# Бинарный файл (.imap), который открывается через mmap: страницы общие для всех
+# веб-воркеров на машине и не парсятся при загрузке.
+#   заголовок: magic b'IMAP', версия формата (uint16), число элементов (uint64), build_id (32 байта, hex)
+#   int64[count]  slot -> track_id (индекс массива = слот Annoy), O(1)
+#   int64[count]  track_id, отсортированные по возрастанию
+#   int64[count]  слоты в порядке отсортированных track_id (поиск track -> slot бинарным поиском, O(log n))
+#
+# Индекс и карта одной сборки имеют общий build_id в имени файла, а текущая сборка
+# задается манифестом (current.json), который заменяется атомарно (os.replace).
+# Поэтому процесс всегда открывает пару файлов одной сборки, а файлы сборки никогда не перезаписываются.
+
+MAGIC = b'IMAP'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sH2xQ32s')
+MANIFEST_NAME = 'current.json'
+
+
+def new_build_id():
+    return uuid.uuid4().hex
+
+
+class ItemMap:
+    """Двунаправленная карта слот Annoy <-> ID трека поверх массивов int64 (обычно memmap)."""
+
+    def __init__(self, slot_to_track, sorted_track_ids, sorted_slots, build_id=''):
+        self.slot_to_track = slot_to_track
+        self.sorted_track_ids = sorted_track_ids
+        self.sorted_slots = sorted_slots
+        self.build_id = build_id
+
+    @classmethod
+    def empty(cls):
+        empty = np.empty(0, dtype=np.int64)
+        return cls(empty, empty, empty)
+
+    @classmethod
+    def from_track_ids(cls, track_ids, build_id=''):
+        """Строит карту по списку ID треков в порядке слотов (track_ids[slot] = track_id)."""
+        slot_to_track = np.asarray(track_ids, dtype=np.int64)
+        order = np.argsort(slot_to_track, kind='stable')
+        return cls(slot_to_track, slot_to_track[order], order.astype(np.int64), build_id=build_id)
+
+    def __len__(self):
+        return int(self.slot_to_track.shape[0])
+
+    def get(self, slot, default=None):
+        """ID трека по слоту Annoy (O(1))."""
+        if 0 <= slot < len(self):
+            return int(self.slot_to_track[slot])
+        return default
+
+    def slot_for_track(self, track_id):
+        """Слот Annoy по ID трека (бинарный поиск, O(log n)) или None."""
+        pos = int(np.searchsorted(self.sorted_track_ids, track_id))
+        if pos < len(self) and self.sorted_track_ids[pos] == track_id:
+            return int(self.sorted_slots[pos])
+        return None
+
+    def slots_for_tracks(self, track_ids):
+        """Слоты для списка ID треков (векторно, бинарный поиск); -1 для треков, которых нет в карте."""
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        if not len(self):
+            return np.full(len(track_ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_track_ids, track_ids), len(self) - 1)
+        return np.where(self.sorted_track_ids[pos] == track_ids, self.sorted_slots[pos], -1).astype(np.int64)
+
+    def track_ids(self, slots):
+        """ID треков для списка слотов (векторно)."""
+        return self.slot_to_track[np.asarray(slots, dtype=np.int64)].tolist()
+
+    def save(self, path):
+        """Записывает карту в файл (через временный файл + rename)."""
+        build_id = self.build_id.encode('ascii').ljust(32, b'\0')[:32]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(self), build_id))
+            for array in (self.slot_to_track, self.sorted_track_ids, self.sorted_slots):
+                f.write(np.ascontiguousarray(array, dtype='<i8').tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Открывает карту через mmap (данные читаются с диска по мере обращения и делятся между процессами)."""
+        with open(path, 'rb') as f:
+            magic, version, count, build_id = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not an item map file (magic={magic!r}, version={version})")
+        if count == 0:
+            return cls.empty()
+        arrays = np.memmap(path, dtype='<i8', mode='r', offset=_HEADER.size, shape=(3, count))
+        return cls(arrays[0], arrays[1], arrays[2], build_id=build_id.rstrip(b'\0').decode('ascii'))
+
+
+# --- Сборки индекса ---
+
+def build_paths(index_dir, build_id, index_extension='.ann'):
+    """Пути к файлам индекса (расширение зависит от бэкенда поиска) и карты одной сборки."""
+    return os.path.join(index_dir, f"{build_id}{index_extension}"), os.path.join(index_dir, f"{build_id}.imap")
+
+
+def _is_build_id(name):
+    return len(name) == 32 and all(c in '0123456789abcdef' for c in name)
+
+
+def read_manifest(index_dir):
+    """Манифест текущей сборки или None."""
+    path = os.path.join(index_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(index_dir, manifest):
+    """Атомарно делает сборку текущей."""
+    path = os.path.join(index_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def manifest_mtime(index_dir):
+    """Время изменения манифеста (ns) или None: дешевая проверка, не появилась ли новая сборка."""
+    try:
+        return os.stat(os.path.join(index_dir, MANIFEST_NAME)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+# --- Учет процессов, которые держат сборки ---
+# Каждый процесс после загрузки сборки записывает holders/<host>-<pid> с ее build_id.
+# Сборки, на которые ссылается живой процесс, не удаляются при очистке.
+
+HOLDERS_DIR = 'holders'
+
+
+def _holder_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def register_holder(index_dir, build_id):
+    """Отмечает, что текущий процесс использует сборку build_id."""
+    holders_dir = os.path.join(index_dir, HOLDERS_DIR)
+    try:
+        os.makedirs(holders_dir, exist_ok=True)
+        path = os.path.join(holders_dir, _holder_name())
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(build_id)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not register index holder: {e}")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Процесс есть, но принадлежит другому пользователю
+    return True
+
+
+def live_holder_builds(index_dir):
+    """build_id сборок, которые держат живые процессы этой машины (записи умерших процессов удаляются)."""
+    holders_dir = os.path.join(index_dir, HOLDERS_DIR)
+    if not os.path.isdir(holders_dir):
+        return set()
+    hostname = socket.gethostname()
+    builds = set()
+    for name in os.listdir(holders_dir):
+        host, _, pid = name.rpartition('-')
+        if name.endswith('.tmp') or not pid.isdigit():
+            continue
+        path = os.path.join(holders_dir, name)
+        if host == hostname and not _pid_alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, 'r') as f:
+                builds.add(f.read().strip())
+        except OSError:
+            continue
+    return builds
+
+
+def cleanup_builds(index_dir, keep_build_ids):
+    """
+    Удаляет файлы сборок, которых нет в keep_build_ids (текущая, предыдущая и те, что держат живые процессы).
+    Даже если файл удален под читателем, mmap остается валидным до его закрытия (Linux).
+    """
+    for name in os.listdir(index_dir):
+        stem = name.split('.', 1)[0]
+        # Файлы сборок: <build_id>.<расширение бэкенда>, <build_id>.imap, <build_id>.vec.npy и разделы <build_id>.genre-<id>.*
+        if _is_build_id(stem) and stem not in keep_build_ids:
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError as e:
+                logger.warning(f"Could not remove old index file {name}: {e}")
@@ -1,28 +1,141 @@
 # core/jobs.py
+import functools
 import logging
+import os
+import subprocess
+import sys
 from django.utils import timezone
 from .models import AnnoyIndexStatus
+from .embedding_store import active_space, activate_space, pending_space_switch
 from .annoy_service import AnnoyService # Используем новый экземпляр для построения
+from .item_map import read_manifest
+from .recommendations import materialize_recommendations
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# --- Перестройка индекса в отдельном процессе ---
+# Чтение эмбеддингов и построение деревьев на большом каталоге занимают память и все ядра.
+# Планировщик работает в процессе веб-сервера, поэтому при ANNOY_BUILD_IN_SUBPROCESS сборка выполняется
+# командой build_annoy_index в дочернем процессе с ограничением памяти (RLIMIT_DATA) и пониженным приоритетом:
+# при нехватке памяти падает сборка, а не процесс, который обслуживает запросы.
+# Веб-воркеры подхватывают опубликованную сборку по манифесту (как и после ручного запуска команды).
+# Так же (ALS_TRAIN_IN_SUBPROCESS) выполняется обучение ALS: командой train_als --pending.
+
+
+def _limit_build_process(limit_mb):
+    """preexec_fn дочернего процесса сборки: ограничение памяти и пониженный приоритет."""
+    import resource
+    if limit_mb:
+        # RLIMIT_DATA, а не RLIMIT_AS: отображенные в память файлы индекса и арены потоков не должны упираться в лимит
+        limit = int(limit_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    os.nice(10)
+
+
+def run_command_in_subprocess(args, timeout, memory_limit_mb=None):
+    """
+    Выполняет manage.py-команду в дочернем процессе с ограничением памяти и пониженным приоритетом.
+    :raises RuntimeError: если процесс завершился с ошибкой
+    :raises subprocess.TimeoutExpired: если команда не уложилась в timeout
+    """
+    command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'makanhub.settings')
+    # Иначе дочерний процесс запустит собственный планировщик (см. CoreConfig.ready)
+    env.pop('RUN_MAIN', None)
+    env.pop('WERKZEUG_RUN_MAIN', None)
+    preexec_fn = functools.partial(_limit_build_process, memory_limit_mb) if os.name == 'posix' else None
+    proc = subprocess.run(
+        command, capture_output=True, text=True, env=env,
+        timeout=timeout, preexec_fn=preexec_fn,
+    )
+    if proc.stdout.strip():
+        logger.info(f"{args[0]} output:\n{proc.stdout.strip()}")
+    if proc.returncode != 0:
+        error_lines = [line for line in proc.stderr.splitlines() if line.strip()]
+        raise RuntimeError(
+            f"{args[0]} exited with code {proc.returncode}: {error_lines[-1] if error_lines else 'no output'}"
+        )
+
+
+def build_index_in_subprocess(space, num_trees=None):
+    """
+    Строит и публикует сборку индекса по пространству space командой build_annoy_index в отдельном процессе
+    (рекомендации предрасчитывает та же команда).
+    :raises RuntimeError: если процесс завершился с ошибкой
+    :raises subprocess.TimeoutExpired: если сборка не уложилась в ANNOY_BUILD_TIMEOUT
+    """
+    run_command_in_subprocess(
+        [
+            'build_annoy_index',
+            '--num_trees', str(num_trees or settings.ANNOY_NUM_TREES),
+            '--model-name', space.model_name,
+            '--preprocessing-version', space.preprocessing_version,
+        ],
+        timeout=settings.ANNOY_BUILD_TIMEOUT,
+        memory_limit_mb=settings.ANNOY_BUILD_MEMORY_LIMIT_MB,
+    )
+
+
+def run_als_training_if_pending():
+    """
+    Задача планировщика: выполняет задачи обучения ALS из очереди. Зависшие задачи (процесс упал или перезапущен)
+    сначала помечаются как failed; при ALS_TRAIN_IN_SUBPROCESS обучение идет в отдельном процессе.
+    """
+    from .als import has_pending_jobs, recover_stale_jobs, run_pending_training_jobs
+    try:
+        recover_stale_jobs()
+        if not has_pending_jobs():
+            return
+        if settings.ALS_TRAIN_IN_SUBPROCESS:
+            # Лимит времени процесса не больше срока, после которого задача считается зависшей
+            run_command_in_subprocess(
+                ['train_als', '--pending'],
+                timeout=settings.ALS_JOB_TIMEOUT_MINUTES * 60,
+                memory_limit_mb=settings.ALS_TRAIN_MEMORY_LIMIT_MB,
+            )
+        else:
+            run_pending_training_jobs()
+    except Exception as e:
+        logger.error(f"Error running ALS training jobs: {e}", exc_info=True)
+
+
 def rebuild_annoy_if_needed():
     """Проверяет флаг и перестраивает индекс Annoy, если требуется."""
     logger.info("Checking if Annoy index rebuild is needed...")
     try:
         status, created = AnnoyIndexStatus.objects.get_or_create(singleton_instance_id=1)
-        if status.needs_rebuild or created: # Перестраиваем и при первой проверке
-            logger.info("Annoy index rebuild required. Starting build...")
+        # Пространство новой модели, досчитанное в фоне до порога покрытия
+        switch_to = pending_space_switch(status)
+        # Перестраиваем и при первой проверке, и если сборка индекса еще ни разу не публиковалась
+        never_built = read_manifest(settings.ANNOY_INDEX_DIR) is None
+        if status.needs_rebuild or created or switch_to or never_built:
+            space = switch_to or active_space(status)
+            logger.info(f"Annoy index rebuild required (embedding space: {space}{', switching' if switch_to else ''}). Starting build...")
             try:
-                builder_service = AnnoyService() # Создаем новый экземпляр сервиса
-                builder_service.build_index_from_db(num_trees=settings.ANNOY_NUM_TREES)
+                builder_service = None
+                if settings.ANNOY_BUILD_IN_SUBPROCESS:
+                    build_index_in_subprocess(space, num_trees=settings.ANNOY_NUM_TREES)
+                else:
+                    builder_service = AnnoyService() # Создаем новый экземпляр сервиса
+                    builder_service.build_index_from_db(num_trees=settings.ANNOY_NUM_TREES, space=space)
 
                 # Обновляем статус после успешного построения
                 status.needs_rebuild = False
                 status.last_build_time = timezone.now()
                 status.save(update_fields=['needs_rebuild', 'last_build_time'])
-                logger.info(f"Annoy index successfully rebuilt and saved to {builder_service.index_path}. Flag reset.")
+                # Переключаем активное пространство только после того, как индекс по нему сохранен
+                if switch_to or not status.active_model_name:
+                    activate_space(status, space)
+                # Предрасчитанные рекомендации по новой сборке (ошибка здесь не откатывает сборку);
+                # в отдельном процессе их уже записала команда build_annoy_index
+                if builder_service is not None:
+                    try:
+                        materialize_recommendations(builder_service)
+                    except Exception as materialize_error:
+                        logger.error(f"Error materializing recommendations: {materialize_error}", exc_info=True)
+                logger.info(f"Annoy index successfully rebuilt and published to {settings.ANNOY_INDEX_DIR}. Flag reset.")
 
             except Exception as build_error:
                 logger.error(f"Error during scheduled Annoy index rebuild: {build_error}", exc_info=True)
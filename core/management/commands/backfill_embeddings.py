@@ -0,0 +1,252 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from core.models import Track, EmbeddingJob, AnnoyIndexStatus
+from core.embedding_providers import get_embedding_provider
+from core.embedding_store import tracks_missing_embedding, bulk_save_track_embeddings
+from core.embedding_cache import store_cached_embedding
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# --- Функции дочерних процессов декодирования ---
+
+def _init_decode_worker():
+    """Инициализация процесса пула: при spawn-старте Django нужно поднять заново."""
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _decode_track(track_id, audio_path):
+    """
+    Декодирует аудио трека в waveform для модели (выполняется в процессе пула).
+    :return: (track_id, waveform или None, текст ошибки или None)
+    """
+    if not os.path.exists(audio_path):
+        return track_id, None, f"Audio file not found: {audio_path}"
+    try:
+        return track_id, get_embedding_provider().load_audio(audio_path), None
+    except Exception as e:
+        return track_id, None, f"Decode failed: {e}"
+
+
+# --- Чекпоинт ---
+
+def load_checkpoint(path, selection):
+    """Возвращает последний обработанный ID трека, если чекпоинт относится к той же выборке."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable backfill checkpoint {path}: {e}")
+        return None
+    if data.get('selection') != selection:
+        logger.warning(f"Backfill checkpoint {path} is for another selection ({data.get('selection')}). Ignoring it.")
+        return None
+    return data.get('last_track_id')
+
+
+def save_checkpoint(path, selection, last_track_id, stats):
+    """Атомарно записывает прогресс (через временный файл + rename)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'selection': selection,
+            'last_track_id': last_track_id,
+            'stats': stats,
+            'updated_at': timezone.now().isoformat(),
+        }, f)
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = 'Computes CLAP embeddings for existing tracks in batches (parallel decode, resumable via checkpoint).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--select',
+            choices=['missing', 'failed', 'all'],
+            default='missing',
+            help='Which tracks to process: without an embedding for the current model, with a failed embedding job, or all.'
+        )
+        parser.add_argument(
+            '--from-id',
+            type=int,
+            default=None,
+            help='Only tracks with ID >= this value.'
+        )
+        parser.add_argument(
+            '--to-id',
+            type=int,
+            default=None,
+            help='Only tracks with ID <= this value.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.EMBEDDING_BACKFILL_BATCH_SIZE,
+            help='Number of clips per CLAP forward pass (and per bulk_update).'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.EMBEDDING_BACKFILL_DECODE_WORKERS,
+            help='Processes used to decode audio.'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default=str(settings.EMBEDDING_BACKFILL_CHECKPOINT_PATH),
+            help='File where progress is stored to resume an interrupted run.'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and start from the beginning of the selection.'
+        )
+
+    def get_queryset(self, options):
+        tracks = Track.objects.exclude(filepath='').exclude(filepath__isnull=True)
+        if options['select'] == 'missing':
+            # Нет вектора в пространстве текущей модели (так же досчитывается новая модель при ее смене)
+            tracks = tracks_missing_embedding()
+        elif options['select'] == 'failed':
+            tracks = tracks.filter(embedding_job__status=EmbeddingJob.STATUS_FAILED)
+        if options['from_id'] is not None:
+            tracks = tracks.filter(pk__gte=options['from_id'])
+        if options['to_id'] is not None:
+            tracks = tracks.filter(pk__lte=options['to_id'])
+        return tracks.order_by('pk')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        workers = max(1, options['workers'])
+        checkpoint_path = options['checkpoint']
+        selection = f"{options['select']}:{options['from_id']}:{options['to_id']}"
+
+        tracks = self.get_queryset(options)
+        if not options['restart']:
+            last_track_id = load_checkpoint(checkpoint_path, selection)
+            if last_track_id is not None:
+                self.stdout.write(f"Resuming from checkpoint: tracks after ID {last_track_id}.")
+                tracks = tracks.filter(pk__gt=last_track_id)
+
+        total = tracks.count()
+        if not total:
+            self.stdout.write(self.style.SUCCESS("No tracks to backfill."))
+            return
+        self.stdout.write(f"Backfilling embeddings for {total} tracks (batch size: {batch_size}, decode workers: {workers})...")
+
+        provider = get_embedding_provider()
+        self.stats = {'processed': 0, 'saved': 0, 'failed': 0}
+        started = time.perf_counter()
+        pending = deque() # Futures декодирования в порядке ID треков
+        batch = [] # (track_id, waveform)
+        # Ограничиваем число задач в полете, чтобы декодированные waveform не копились в памяти
+        max_in_flight = workers * 2 + batch_size
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker) as executor:
+            track_iter = tracks.values_list('pk', 'filepath').iterator(chunk_size=1000)
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < max_in_flight:
+                    row = next(track_iter, None)
+                    if row is None:
+                        exhausted = True
+                        break
+                    track_id, filepath = row
+                    pending.append(executor.submit(_decode_track, track_id, os.path.join(settings.MEDIA_ROOT, filepath)))
+                if not pending:
+                    break
+
+                # Берем результаты строго по порядку: так чекпоинт - это просто последний записанный ID
+                track_id, waveform, error = pending.popleft().result()
+                if error:
+                    self._record_failure(track_id, error)
+                else:
+                    batch.append((track_id, waveform))
+                if len(batch) >= batch_size:
+                    self._flush(provider, batch)
+                    batch = []
+                    self._report(total, started)
+                    save_checkpoint(checkpoint_path, selection, track_id, self.stats)
+
+            if batch:
+                self._flush(provider, batch)
+            self._report(total, started)
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        # Один флаг перестроения на весь прогон, а не на каждый трек
+        if self.stats['saved']:
+            AnnoyIndexStatus.request_rebuild(f"embedding backfill ({self.stats['saved']} tracks)")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfill finished in {elapsed:.1f}s: {self.stats['saved']} saved, {self.stats['failed']} failed "
+            f"({self.stats['processed'] / elapsed if elapsed else 0:.2f} tracks/sec)."
+        ))
+
+    def _flush(self, provider, batch):
+        """Один forward pass на батч и одна запись в БД."""
+        track_ids = [track_id for track_id, _ in batch]
+        try:
+            embeddings = provider.embed_waveforms([waveform for _, waveform in batch])
+        except Exception as e:
+            logger.error(f"Embedding batch failed for tracks {track_ids[0]}..{track_ids[-1]}: {e}", exc_info=True)
+            for track_id in track_ids:
+                self._record_failure(track_id, f"Inference failed: {e}")
+            return
+
+        # Треки, которые прямо сейчас обрабатывает воркер очереди (например, перезалитые), не трогаем
+        busy_ids = set(EmbeddingJob.objects.filter(
+            track_id__in=track_ids, status=EmbeddingJob.STATUS_RUNNING,
+        ).values_list('track_id', flat=True))
+        updates = [
+            (track_id, embedding)
+            for track_id, embedding in zip(track_ids, embeddings) if track_id not in busy_ids
+        ]
+        bulk_save_track_embeddings(updates)
+        # Как и воркер очереди (complete_embedding_job): перезаливка того же файла возьмет вектор из кеша
+        content_hashes = dict(Track.objects.filter(
+            pk__in=[track_id for track_id, _ in updates],
+        ).exclude(content_hash='').values_list('pk', 'content_hash'))
+        for track_id, embedding in updates:
+            if track_id in content_hashes:
+                store_cached_embedding(content_hashes[track_id], embedding, model_name=provider.model_name)
+        # Ожидающие и проваленные задачи очереди для этих треков больше не нужны
+        EmbeddingJob.objects.filter(track_id__in=[track_id for track_id, _ in updates]).exclude(
+            status=EmbeddingJob.STATUS_RUNNING,
+        ).update(status=EmbeddingJob.STATUS_DONE, last_error='', locked_by='', locked_until=None)
+
+        self.stats['processed'] += len(batch)
+        self.stats['saved'] += len(updates)
+
+    def _record_failure(self, track_id, error):
+        """Отмечает ошибку в задаче очереди трека, чтобы трек попал в выборку --select failed."""
+        logger.warning(f"Backfill failed for Track ID {track_id}: {error}")
+        EmbeddingJob.objects.filter(track_id=track_id).exclude(status=EmbeddingJob.STATUS_RUNNING).update(
+            status=EmbeddingJob.STATUS_FAILED, last_error=str(error)[:2000],
+        )
+        if not EmbeddingJob.objects.filter(track_id=track_id).exists():
+            EmbeddingJob.objects.create(track_id=track_id, status=EmbeddingJob.STATUS_FAILED, last_error=str(error)[:2000])
+        self.stats['processed'] += 1
+        self.stats['failed'] += 1
+
+    def _report(self, total, started):
+        elapsed = time.perf_counter() - started
+        rate = self.stats['processed'] / elapsed if elapsed else 0
+        self.stdout.write(
+            f"  {self.stats['processed']}/{total} processed ({self.stats['saved']} saved, {self.stats['failed']} failed), "
+            f"{rate:.2f} tracks/sec"
+        )
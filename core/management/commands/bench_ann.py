@@ -0,0 +1,206 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import gc
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+
+from core.vector_backends import AnnoyBackend, ExactBackend
+
+
+def rss_mb():
+    """Текущий RSS процесса (MB) из /proc или None, если он недоступен."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def parse_int_list(value):
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise CommandError(f"Expected a comma-separated list of integers, got {value!r}")
+
+
+def load_catalog_vectors(dimension, limit=None):
+    """Эмбеддинги активного пространства (матрица float32 [n, dim])."""
+    from core.embedding_store import active_space, embeddings_in_space
+    rows = embeddings_in_space(active_space()).order_by('track_id').values_list('embedding', flat=True)
+    if limit:
+        rows = rows[:limit]
+    vectors = [np.asarray(v, dtype=np.float32) for v in rows.iterator(chunk_size=2000) if v is not None and len(v) == dimension]
+    return np.stack(vectors) if vectors else np.empty((0, dimension), dtype=np.float32)
+
+
+def synthetic_vectors(count, dimension, seed):
+    """count случайных единичных векторов."""
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def latency_stats(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'mean_ms': round(float(ms.mean()), 3),
+    }
+
+
+def run_queries(backend, queries, k, **params):
+    """Запросы по одному (как в find_nearest_neighbors): найденные слоты и время каждого запроса."""
+    results, timings = [], []
+    for vector in queries:
+        started = time.perf_counter()
+        slots, _ = backend.query_by_vector(vector, k, **params)
+        timings.append(time.perf_counter() - started)
+        results.append(slots)
+    return results, timings
+
+
+def recall_at_k(results, truth, k):
+    hits = sum(len(set(found[:k]) & set(expected[:k])) for found, expected in zip(results, truth))
+    return hits / (k * len(truth)) if truth else 0.0
+
+
+def bench_backend(backend_class, vectors, queries, truth, k, workdir, build_params, query_params_list, metric):
+    """
+    Строит индекс, сохраняет его, открывает заново (mmap, как веб-воркер) и прогоняет запросы
+    для каждого набора параметров поиска.
+    :return: список строк отчета (одна на набор параметров поиска)
+    """
+    gc.collect()
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    backend = backend_class(vectors.shape[1], metric)
+    for slot, vector in enumerate(vectors):
+        backend.add_item(slot, vector)
+    backend.build(**build_params)
+    build_seconds = time.perf_counter() - started
+    rss_built = rss_mb()
+
+    path = os.path.join(workdir, f"bench{backend_class.file_extension}")
+    backend.save(path)
+    size_bytes = os.path.getsize(path)
+    del backend
+    gc.collect()
+
+    loaded = backend_class.load(path, vectors.shape[1], metric)
+    rows = []
+    for query_params in query_params_list:
+        run_queries(loaded, queries[:10], k, **query_params) # Прогрев страниц mmap
+        results, timings = run_queries(loaded, queries, k, **query_params)
+        rss_after = rss_mb()
+        rows.append({
+            **build_params,
+            **query_params,
+            'recall_at_k': round(recall_at_k(results, truth, k), 4),
+            **latency_stats(timings),
+            'build_seconds': round(build_seconds, 3),
+            'index_size_mb': round(size_bytes / 2**20, 2),
+            'build_rss_delta_mb': round(rss_built - rss_before, 1) if rss_before is not None else None,
+            'serving_rss_delta_mb': round(rss_after - rss_before, 1) if rss_before is not None else None,
+        })
+    del loaded
+    os.remove(path)
+    return rows
+
+
+class Command(BaseCommand):
+    help = 'Measures ANN recall@k, query latency, build time, index size and memory against exact search (sweeps num_trees x search_k).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=None, help='Benchmark N random unit vectors instead of the catalog embeddings.')
+        parser.add_argument('--limit', type=int, default=None, help='Use at most this many catalog embeddings.')
+        parser.add_argument('--dim', type=int, default=settings.ANNOY_EMBEDDING_DIM, help='Vector dimension for --synthetic.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed (synthetic vectors and query sampling).')
+        parser.add_argument('--queries', type=int, default=200, help='Number of query vectors sampled from the catalog.')
+        parser.add_argument('-k', type=int, default=10, help='Neighbors per query (recall@k).')
+        parser.add_argument('--trees', default='10,25,50,100', help='Comma-separated num_trees values to sweep.')
+        parser.add_argument('--search-k', default='-1,1000,5000,20000', help='Comma-separated search_k values to sweep (-1 = Annoy default, num_trees * k).')
+        parser.add_argument('--no-exact', action='store_true', help='Skip the exact backend row (ground truth is still computed).')
+        parser.add_argument('--json', action='store_true', help='Print a machine-readable JSON report.')
+        parser.add_argument('--output', default=None, help='Also write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        metric = settings.ANNOY_METRIC
+        k = options['k']
+        trees = parse_int_list(options['trees'])
+        search_ks = parse_int_list(options['search_k'])
+
+        if options['synthetic']:
+            source = f"synthetic:{options['synthetic']}"
+            vectors = synthetic_vectors(options['synthetic'], options['dim'], options['seed'])
+        else:
+            source = 'catalog'
+            vectors = load_catalog_vectors(settings.ANNOY_EMBEDDING_DIM, options['limit'])
+        if len(vectors) <= k:
+            raise CommandError(f"Need more than k={k} vectors to benchmark, got {len(vectors)}.")
+
+        rng = np.random.default_rng(options['seed'])
+        queries = vectors[rng.choice(len(vectors), size=min(options['queries'], len(vectors)), replace=False)]
+
+        # Точный ответ (эталон для recall) - тот же блочный перебор, что и в бэкенде exact
+        started = time.perf_counter()
+        exact = ExactBackend(vectors.shape[1], metric)
+        for slot, vector in enumerate(vectors):
+            exact.add_item(slot, vector)
+        exact.build()
+        truth = [slots for slots, _ in exact.query_batch(queries, k)]
+        truth_seconds = time.perf_counter() - started
+        del exact
+
+        report = {
+            'source': source,
+            'items': int(len(vectors)),
+            'dimension': int(vectors.shape[1]),
+            'metric': metric,
+            'k': k,
+            'queries': int(len(queries)),
+            'ground_truth_seconds': round(truth_seconds, 3),
+            'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'results': [],
+        }
+        with tempfile.TemporaryDirectory(prefix='bench_ann_') as workdir:
+            if not options['no_exact']:
+                for row in bench_backend(ExactBackend, vectors, queries, truth, k, workdir, {}, [{}], metric):
+                    report['results'].append({'backend': 'exact', **row})
+                    self._progress(report['results'][-1], options)
+            for num_trees in trees:
+                rows = bench_backend(
+                    AnnoyBackend, vectors, queries, truth, k, workdir,
+                    {'num_trees': num_trees}, [{'search_k': search_k} for search_k in search_ks], metric,
+                )
+                for row in rows:
+                    report['results'].append({'backend': 'annoy', **row})
+                    self._progress(report['results'][-1], options)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Benchmarked {report['items']} vectors ({source}), {report['queries']} queries, k={k}."
+                + (f" Report written to {options['output']}." if options['output'] else "")
+            ))
+
+    def _progress(self, row, options):
+        if options['json']:
+            return
+        params = f"trees={row.get('num_trees', '-'):>4} search_k={row.get('search_k', '-'):>6}"
+        self.stdout.write(
+            f"{row['backend']:>6} {params}  recall@k={row['recall_at_k']:.4f}  "
+            f"p50={row['p50_ms']:.3f}ms p95={row['p95_ms']:.3f}ms p99={row['p99_ms']:.3f}ms  "
+            f"build={row['build_seconds']:.2f}s size={row['index_size_mb']}MB rss+={row['serving_rss_delta_mb']}MB"
+        )
@@ -1,6 +1,8 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from core.annoy_service import AnnoyService # Импортируем наш сервис
+from core.embedding_store import EmbeddingSpace
+from core.recommendations import materialize_recommendations
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,19 +17,42 @@ class Command(BaseCommand):
             default=settings.ANNOY_NUM_TREES,
             help='Number of trees to build in the Annoy index.'
         )
+        parser.add_argument(
+            '--backend',
+            default=None,
+            help="Vector search backend: auto, exact, annoy, balltree or a class path (default: settings.VECTOR_BACKEND)."
+        )
+        parser.add_argument(
+            '--no-materialize',
+            action='store_true',
+            help='Do not precompute recommendations into the Recommendation table after the build.'
+        )
+        parser.add_argument(
+            '--model-name',
+            default=None,
+            help='Build from embeddings of this model (requires --preprocessing-version; default: the active embedding space).'
+        )
+        parser.add_argument(
+            '--preprocessing-version',
+            default=None,
+            help='Preprocessing version of the embedding space to build from (used with --model-name).'
+        )
 
     def handle(self, *args, **options):
         self.stdout.write("Starting Annoy index build...")
         num_trees = options['num_trees']
+        if bool(options['model_name']) != bool(options['preprocessing_version']):
+            raise CommandError("--model-name and --preprocessing-version must be given together.")
+        space = EmbeddingSpace(options['model_name'], options['preprocessing_version']) if options['model_name'] else None
         try:
             # Создаем экземпляр сервиса специально для построения
             # (не используем глобальный annoy_service, чтобы избежать конфликтов состояний)
             builder_service = AnnoyService()
-            builder_service.build_index_from_db(num_trees=num_trees)
+            builder_service.build_index_from_db(num_trees=num_trees, space=space, backend=options['backend'])
 
             if builder_service.index.get_n_items() > 0:
                 self.stdout.write(self.style.SUCCESS(
-                    f"Successfully built and saved Annoy index with {builder_service.index.get_n_items()} items "
+                    f"Successfully built and saved {builder_service.backend_name} index with {builder_service.index.get_n_items()} items "
                     f"to {builder_service.index_path}"
                 ))
             else:
@@ -35,4 +60,14 @@ class Command(BaseCommand):
 
         except Exception as e:
             logger.error(f"Error building Annoy index: {e}", exc_info=True)
-            self.stderr.write(self.style.ERROR(f"Error building Annoy index: {e}")) 
\ No newline at end of file
+            # Ненулевой код возврата: плановая перестройка в отдельном процессе должна увидеть ошибку
+            raise CommandError(f"Error building Annoy index: {e}")
+
+        # Сборка уже опубликована: ошибка предрасчета рекомендаций не считается ошибкой сборки
+        if not options['no_materialize']:
+            try:
+                written = materialize_recommendations(builder_service)
+                self.stdout.write(f"Materialized {written} recommendations.")
+            except Exception as e:
+                logger.error(f"Error materializing recommendations: {e}", exc_info=True)
+                self.stderr.write(self.style.ERROR(f"Error materializing recommendations: {e}"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.colike import update_colike_similarities
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Updates item-item co-like similarities from LikeDislike (incrementally since the last run, or fully).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Recompute similarities for every liked track instead of only the ones affected by new votes.'
+        )
+
+    def handle(self, *args, **options):
+        job = update_colike_similarities(full=options['full'])
+        self.stdout.write(job.logs)
+        if job.status != 'completed':
+            raise CommandError(f"Co-like job {job.pk} failed, see TrainingJob logs.")
+        self.stdout.write(self.style.SUCCESS(f"Co-like job {job.pk} completed ({job.parameters['mode']})."))
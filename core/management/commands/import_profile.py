@@ -0,0 +1,146 @@
+from django.core.management.base import BaseCommand, CommandError
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Точки входа, для которых строим отчет: имя -> код, который выполняется в чистом процессе
+ENTRY_POINTS = {
+    # То, что платит любая manage.py команда (migrate, createsuperuser, ...), включая autodiscover админки
+    'manage': "import django; django.setup()",
+    # gunicorn/uwsgi воркер: WSGI-приложение + загрузка всех URL и views
+    'wsgi': "from makanhub.wsgi import application; from django.urls import get_resolver; get_resolver().url_patterns",
+    # Воркер очереди эмбеддингов до первого инференса
+    'embedding_worker': "import django; django.setup(); import core.embedding_queue, core.embedding_providers",
+    # Полная загрузка модели CLAP (то, что платит процесс при первом эмбеддинге)
+    'clap_model': "import django; django.setup(); from core.embedding_providers import get_embedding_provider; get_embedding_provider()._ensure_loaded()",
+}
+
+# Тяжелые пакеты, которым не место в процессах, которые ничего не эмбеддят
+HEAVY_PACKAGES = ('torch', 'torchaudio', 'transformers', 'librosa', 'numba', 'llvmlite', 'scipy', 'sklearn')
+
+# Точки входа, которые не должны тянуть тяжелые пакеты (проверяется флагом --check)
+LIGHT_ENTRY_POINTS = ('manage', 'wsgi', 'embedding_worker')
+
+# Код, который дописывается в конец процесса: печатает пиковый RSS
+RSS_PROBE = "; import resource, sys as _s; _s.stdout.write('\\n__MAXRSS__=%d\\n' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+
+def parse_importtime(stderr):
+    """
+    Разбирает вывод `python -X importtime`.
+    :return: список словарей {module, self_us, cumulative_us, depth}
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        self_us, cumulative_us, name = parts
+        # Вложенность импорта обозначается отступом (по 2 пробела на уровень после одного служебного)
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append({
+            'module': name.strip(),
+            'self_us': int(self_us.strip()),
+            'cumulative_us': int(cumulative_us.strip()),
+            'depth': depth,
+        })
+    return modules
+
+
+def profile_entry_point(name, code):
+    """Запускает код точки входа в отдельном интерпретаторе и собирает статистику импортов."""
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'makanhub.settings')
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code + RSS_PROBE],
+        capture_output=True, text=True, env=env,
+    )
+    wall_seconds = time.perf_counter() - started
+
+    max_rss_kb = None
+    for line in proc.stdout.splitlines():
+        if line.startswith('__MAXRSS__='):
+            max_rss_kb = int(line.split('=', 1)[1])
+
+    modules = parse_importtime(proc.stderr)
+    # Последняя строка stderr, не относящаяся к importtime, - текст исключения
+    error_lines = [line for line in proc.stderr.splitlines() if line.strip() and not line.startswith('import time:')]
+    imported = {m['module'] for m in modules}
+    heavy = sorted(pkg for pkg in HEAVY_PACKAGES if pkg in imported)
+    top_level = sorted((m for m in modules if '.' not in m['module']), key=lambda m: m['cumulative_us'], reverse=True)
+
+    return {
+        'entry_point': name,
+        'ok': proc.returncode == 0,
+        'error': error_lines[-1] if proc.returncode != 0 and error_lines else None,
+        'wall_seconds': round(wall_seconds, 3),
+        'import_seconds': round(sum(m['self_us'] for m in modules) / 1e6, 3),
+        'max_rss_mb': round(max_rss_kb / 1024, 1) if max_rss_kb else None,
+        'module_count': len(modules),
+        'heavy_packages': heavy,
+        'top_packages': [
+            {'package': m['module'], 'cumulative_ms': round(m['cumulative_us'] / 1000, 1)} for m in top_level[:15]
+        ],
+    }
+
+
+class Command(BaseCommand):
+    help = 'Reports import time, module count and peak RSS for each process entry point (web, manage.py, workers).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'entry_points',
+            nargs='*',
+            help=f"Entry points to profile (default: all). Available: {', '.join(ENTRY_POINTS)}"
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Print a machine-readable JSON report.'
+        )
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Fail if web/manage entry points import heavy ML packages (torch, transformers, librosa, ...).'
+        )
+
+    def handle(self, *args, **options):
+        names = options['entry_points'] or list(ENTRY_POINTS)
+        unknown = [n for n in names if n not in ENTRY_POINTS]
+        if unknown:
+            raise CommandError(f"Unknown entry points: {', '.join(unknown)}. Available: {', '.join(ENTRY_POINTS)}")
+
+        reports = [profile_entry_point(name, ENTRY_POINTS[name]) for name in names]
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2, ensure_ascii=False))
+        else:
+            for report in reports:
+                self._write_report(report)
+
+        if options['check']:
+            offenders = [r for r in reports if r['entry_point'] in LIGHT_ENTRY_POINTS and (r['heavy_packages'] or not r['ok'])]
+            if offenders:
+                details = '; '.join(
+                    f"{r['entry_point']}: {', '.join(r['heavy_packages']) or r['error']}" for r in offenders
+                )
+                raise CommandError(f"Heavy imports found in light entry points: {details}")
+            self.stdout.write(self.style.SUCCESS("No heavy ML packages imported by web/manage entry points."))
+
+    def _write_report(self, report):
+        style = self.style.SUCCESS if report['ok'] and not report['heavy_packages'] else self.style.WARNING
+        self.stdout.write(style(f"== {report['entry_point']} =="))
+        if not report['ok']:
+            self.stdout.write(self.style.ERROR(f"  failed: {report['error']}"))
+        self.stdout.write(
+            f"  wall: {report['wall_seconds']}s, imports: {report['import_seconds']}s, "
+            f"modules: {report['module_count']}, peak RSS: {report['max_rss_mb']} MB"
+        )
+        self.stdout.write(f"  heavy packages: {', '.join(report['heavy_packages']) or 'none'}")
+        for pkg in report['top_packages']:
+            self.stdout.write(f"    {pkg['cumulative_ms']:>9.1f} ms  {pkg['package']}")
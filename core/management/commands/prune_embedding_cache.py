@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from core.embedding_cache import evict_unreferenced, embedding_cache_stats
+from core.text_search import evict_query_embeddings
+from core.models import TextQueryEmbedding
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Evicts embedding cache entries that are no longer referenced by any track (or belong to an old model), and rare text search queries above the stored limit.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-days',
+            type=int,
+            default=settings.EMBEDDING_CACHE_UNREFERENCED_GRACE_DAYS,
+            help='Keep unreferenced entries that were used within this many days.'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many entries would be evicted.'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Embedding cache before: {embedding_cache_stats()}")
+        count = evict_unreferenced(grace_days=options['grace_days'], dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f"{count} entries would be evicted."))
+            extra_queries = max(TextQueryEmbedding.objects.count() - settings.TEXT_SEARCH_MAX_STORED_QUERIES, 0)
+            self.stdout.write(self.style.WARNING(f"{extra_queries} text query embeddings would be evicted."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Evicted {count} entries. Cache now: {embedding_cache_stats()}"))
+            self.stdout.write(self.style.SUCCESS(f"Evicted {evict_query_embeddings()} text query embeddings."))
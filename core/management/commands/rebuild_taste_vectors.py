@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from core.models import LikeDislike
+from core.taste import rebuild_taste_vector
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Recomputes user taste vectors (My Vibe) from all votes, e.g. after tracks were re-embedded.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            default=None,
+            help='User ID to rebuild (can be repeated; default: every user with votes).'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['user'] or LikeDislike.objects.values_list('user_id', flat=True).distinct().order_by('user_id')
+        rebuilt = 0
+        for user_id in user_ids:
+            rebuild_taste_vector(user_id)
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rebuilt} taste vectors."))
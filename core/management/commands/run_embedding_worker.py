@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from core.embedding_queue import (
+    default_worker_id, recover_expired_jobs, claim_embedding_jobs, process_embedding_job, release_embedding_job,
+    embedding_queue_stats,
+)
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Runs a worker that drains the embedding job queue (CLAP inference for uploaded tracks).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1,
+            help='How many jobs to claim per poll.'
+        )
+        parser.add_argument(
+            '--lease-seconds',
+            type=int,
+            default=settings.EMBEDDING_JOB_LEASE_SECONDS,
+            help='How long a claimed job stays locked to this worker.'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.EMBEDDING_WORKER_POLL_INTERVAL,
+            help='Seconds to sleep when the queue is empty.'
+        )
+        parser.add_argument(
+            '--max-jobs',
+            type=int,
+            default=0,
+            help='Exit after processing this many jobs (0 = unlimited).'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit instead of polling forever.'
+        )
+        parser.add_argument(
+            '--worker-id',
+            default=None,
+            help='Worker identifier stored in job leases (default: hostname:pid).'
+        )
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id'] or default_worker_id()
+        batch_size = max(1, options['batch_size'])
+        max_jobs = options['max_jobs']
+        self._stop = False
+
+        # Завершаемся аккуратно: дорабатываем текущую задачу и выходим
+        def request_stop(signum, frame):
+            self.stdout.write(f"Received signal {signum}, stopping after current job...")
+            self._stop = True
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        self.stdout.write(f"Embedding worker {worker_id} started. Queue: {embedding_queue_stats()}")
+        processed = 0
+        succeeded = 0
+
+        while not self._stop:
+            recover_expired_jobs()
+            jobs = claim_embedding_jobs(worker_id, limit=batch_size, lease_seconds=options['lease_seconds'])
+
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            for job in jobs:
+                if self._stop:
+                    # Остановка посреди пачки: невзятые в работу задачи сразу отдаем другим воркерам
+                    release_embedding_job(job, worker_id)
+                    continue
+                try:
+                    if process_embedding_job(job, worker_id):
+                        succeeded += 1
+                except Exception as e:
+                    # Задачу не трогаем: аренда истечет, и ее подберет recover_expired_jobs
+                    logger.error(f"Unexpected error while processing embedding job {job.pk}: {e}", exc_info=True)
+                processed += 1
+                if max_jobs and processed >= max_jobs:
+                    self._stop = True
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Embedding worker {worker_id} stopped. Processed: {processed}, succeeded: {succeeded}. "
+            f"Queue: {embedding_queue_stats()}"
+        ))
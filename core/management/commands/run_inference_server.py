@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils.module_loading import import_string
+from core.inference_server import InferenceServer, configure_torch_threads
+import logging
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Runs the local CLAP inference server (one shared model, micro-batched requests over a Unix socket).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            default=str(settings.EMBEDDING_SERVER_SOCKET),
+            help='Path of the Unix socket to listen on.'
+        )
+        parser.add_argument(
+            '--max-batch-size',
+            type=int,
+            default=settings.EMBEDDING_SERVER_MAX_BATCH_SIZE,
+            help='Maximum number of audio clips (or texts) per forward pass.'
+        )
+        parser.add_argument(
+            '--max-wait-ms',
+            type=float,
+            default=settings.EMBEDDING_SERVER_MAX_WAIT_MS,
+            help='How long to wait for more requests before running a partial batch.'
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=settings.EMBEDDING_SERVER_TORCH_THREADS,
+            help='Torch intra-op threads (keep below the core count shared with web workers).'
+        )
+        parser.add_argument(
+            '--no-warmup',
+            action='store_true',
+            help='Do not load the model before accepting connections.'
+        )
+
+    def handle(self, *args, **options):
+        # Потоки torch фиксируем до загрузки модели и первого инференса
+        configure_torch_threads(max(1, options['threads']))
+
+        # Сервер всегда считает в процессе, даже если EMBEDDING_PROVIDER указывает на sidecar-клиента
+        provider_class = import_string(settings.EMBEDDING_SERVER_PROVIDER)
+        provider = provider_class()
+        if not options['no_warmup'] and hasattr(provider, '_ensure_loaded'):
+            self.stdout.write(f"Loading model {provider.model_name}...")
+            provider._ensure_loaded()
+
+        server = InferenceServer(
+            provider,
+            socket_path=options['socket'],
+            max_batch_size=options['max_batch_size'],
+            max_wait_ms=options['max_wait_ms'],
+        )
+
+        # shutdown() блокируется до выхода из serve_forever, поэтому вызываем его из отдельного потока
+        def request_stop(signum, frame):
+            self.stdout.write(f"Received signal {signum}, shutting down...")
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Inference server listening on {server.socket_path} "
+            f"(max batch: {options['max_batch_size']}, max wait: {options['max_wait_ms']} ms, threads: {options['threads']})"
+        ))
+        server.serve_forever()
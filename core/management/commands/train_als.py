@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.als import create_training_job, run_pending_training_jobs, run_training_job
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Trains implicit ALS user/track factors from LikeDislike as a TrainingJob and publishes them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--factors', type=int, default=None, help='Number of latent factors (default: settings.ALS_FACTORS).')
+        parser.add_argument('--iterations', type=int, default=None, help='ALS iterations (default: settings.ALS_ITERATIONS).')
+        parser.add_argument('--regularization', type=float, default=None, help='L2 regularization (default: settings.ALS_REGULARIZATION).')
+        parser.add_argument('--alpha', type=float, default=None, help='Confidence scale (default: settings.ALS_ALPHA).')
+        parser.add_argument(
+            '--pending',
+            action='store_true',
+            help='Run the queued (pending) ALS training jobs instead of starting a new one.'
+        )
+
+    def handle(self, *args, **options):
+        if options['pending']:
+            processed = run_pending_training_jobs()
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} pending ALS jobs."))
+            return
+        overrides = {
+            name: options[name] for name in ('factors', 'iterations', 'regularization', 'alpha')
+            if options[name] is not None
+        }
+        job = run_training_job(create_training_job(**overrides))
+        self.stdout.write(job.logs)
+        if job.status != 'completed':
+            raise CommandError(f"ALS job {job.pk} failed, see TrainingJob logs.")
+        self.stdout.write(self.style.SUCCESS(f"ALS job {job.pk} completed."))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from core.text_search import embed_queries, normalize_query
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Precomputes text-search embeddings for common queries (settings.TEXT_SEARCH_WARM_QUERIES and/or a file) so they skip inference.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            default=None,
+            help='Text file with one query per line to embed in addition to settings.TEXT_SEARCH_WARM_QUERIES.'
+        )
+        parser.add_argument(
+            '--no-defaults',
+            action='store_true',
+            help='Do not embed settings.TEXT_SEARCH_WARM_QUERIES.'
+        )
+
+    def handle(self, *args, **options):
+        queries = [] if options['no_defaults'] else list(settings.TEXT_SEARCH_WARM_QUERIES)
+        if options['file']:
+            with open(options['file'], 'r', encoding='utf-8') as f:
+                queries.extend(line for line in f if line.strip())
+        queries = [normalize_query(query) for query in queries]
+        embedded = embed_queries(queries)
+        self.stdout.write(self.style.SUCCESS(
+            f"Embedded {embedded} new queries ({len(set(filter(None, queries))) - embedded} already cached)."
+        ))
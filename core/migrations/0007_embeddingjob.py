@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 16:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_annoyindexstatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Ожидание'), ('running', 'Выполняется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='pending', max_length=20, verbose_name='Статус')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Попыток')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Задача не будет взята воркером раньше этого времени (backoff)', verbose_name='Доступна с')),
+                ('locked_by', models.CharField(blank=True, max_length=255, verbose_name='Воркер')),
+                ('locked_until', models.DateTimeField(blank=True, help_text='После истечения аренды задачу может забрать другой воркер', null=True, verbose_name='Аренда до')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('track', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='embedding_job', to='core.track', verbose_name='Трек')),
+            ],
+            options={
+                'verbose_name': 'Задача эмбеддинга',
+                'verbose_name_plural': 'Очередь эмбеддингов',
+                'indexes': [models.Index(fields=['status', 'available_at'], name='core_embjob_status_avail_idx')],
+            },
+        ),
+    ]
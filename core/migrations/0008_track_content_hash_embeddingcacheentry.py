@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-17 17:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_embeddingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Хеш содержимого аудиофайла (ключ кеша эмбеддингов)', max_length=64, verbose_name='SHA-256 файла'),
+        ),
+        migrations.CreateModel(
+            name='EmbeddingCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='SHA-256 файла')),
+                ('model_name', models.CharField(max_length=255, verbose_name='Модель')),
+                ('preprocessing_version', models.CharField(help_text='Меняется при изменении декодирования/окон аудио', max_length=64, verbose_name='Версия препроцессинга')),
+                ('embedding', models.JSONField(verbose_name='Эмбеддинг')),
+                ('hit_count', models.PositiveIntegerField(default=0, verbose_name='Попаданий')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Последнее использование')),
+            ],
+            options={
+                'verbose_name': 'Кеш эмбеддинга',
+                'verbose_name_plural': 'Кеш эмбеддингов',
+                'unique_together': {('content_hash', 'model_name', 'preprocessing_version')},
+            },
+        ),
+    ]
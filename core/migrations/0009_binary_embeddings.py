@@ -0,0 +1,89 @@
+# Generated by Django 5.2 on 2026-10-17 17:20
+
+import core.embedding_codec
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def _convert(model, source, target, convert):
+    """Переносит векторы из поля source в target пачками (без загрузки всей таблицы в память)."""
+    batch = []
+    rows = model.objects.exclude(**{f'{source}__isnull': True}).only('pk', source).iterator(chunk_size=BATCH_SIZE)
+    for obj in rows:
+        value = getattr(obj, source)
+        if value is None:
+            continue
+        setattr(obj, target, convert(value))
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_update(batch, [target])
+            batch = []
+    if batch:
+        model.objects.bulk_update(batch, [target])
+
+
+def json_to_blob(apps, schema_editor):
+    # Некорректные JSON-векторы (не список) отбрасываем: трек попадет в backfill_embeddings --select missing
+    def convert(value):
+        return value if isinstance(value, list) and value else None
+    for model_name in ('Track', 'EmbeddingCacheEntry'):
+        _convert(apps.get_model('core', model_name), 'embedding', 'embedding_blob', convert)
+    # Запись кеша без вектора бесполезна (а поле станет NOT NULL)
+    apps.get_model('core', 'EmbeddingCacheEntry').objects.filter(embedding_blob__isnull=True).delete()
+
+
+def blob_to_json(apps, schema_editor):
+    def convert(value):
+        return [float(x) for x in value]
+    for model_name in ('Track', 'EmbeddingCacheEntry'):
+        _convert(apps.get_model('core', model_name), 'embedding_blob', 'embedding', convert)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_track_content_hash_embeddingcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='embedding_blob',
+            field=core.embedding_codec.EmbeddingField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='embeddingcacheentry',
+            name='embedding_blob',
+            field=core.embedding_codec.EmbeddingField(blank=True, null=True),
+        ),
+        migrations.RunPython(json_to_blob, blob_to_json),
+        migrations.RemoveField(
+            model_name='track',
+            name='embedding',
+        ),
+        migrations.RemoveField(
+            model_name='embeddingcacheentry',
+            name='embedding',
+        ),
+        migrations.RenameField(
+            model_name='track',
+            old_name='embedding_blob',
+            new_name='embedding',
+        ),
+        migrations.RenameField(
+            model_name='embeddingcacheentry',
+            old_name='embedding_blob',
+            new_name='embedding',
+        ),
+        migrations.AlterField(
+            model_name='track',
+            name='embedding',
+            field=core.embedding_codec.EmbeddingField(blank=True, help_text='Векторное представление трека (CLAP)', null=True, verbose_name='CLAP Эмбеддинг'),
+        ),
+        migrations.AlterField(
+            model_name='embeddingcacheentry',
+            name='embedding',
+            field=core.embedding_codec.EmbeddingField(verbose_name='Эмбеддинг'),
+        ),
+    ]
@@ -0,0 +1,111 @@
+# Generated by Django 5.2 on 2026-10-17 17:40
+
+import core.embedding_codec
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+# Векторы из Track.embedding: модель та же, но часть из них посчитана по всему файлу (до оконного декодирования),
+# поэтому они получают отдельную версию препроцессинга. Индекс продолжает обслуживаться по ним, пока
+# backfill_embeddings не досчитает текущее пространство до порога EMBEDDING_SPACE_SWITCH_COVERAGE.
+LEGACY_MODEL_NAME = 'laion/clap-htsat-unfused'
+LEGACY_PREPROCESSING_VERSION = 'v0:legacy'
+
+
+def copy_track_embeddings(apps, schema_editor):
+    Track = apps.get_model('core', 'Track')
+    TrackEmbedding = apps.get_model('core', 'TrackEmbedding')
+    AnnoyIndexStatus = apps.get_model('core', 'AnnoyIndexStatus')
+
+    batch = []
+    copied = 0
+    for track_id, embedding in Track.objects.exclude(embedding__isnull=True).values_list('pk', 'embedding').iterator(chunk_size=BATCH_SIZE):
+        if embedding is None:
+            continue
+        batch.append(TrackEmbedding(
+            track_id=track_id, model_name=LEGACY_MODEL_NAME,
+            preprocessing_version=LEGACY_PREPROCESSING_VERSION, embedding=embedding,
+        ))
+        if len(batch) >= BATCH_SIZE:
+            TrackEmbedding.objects.bulk_create(batch)
+            copied += len(batch)
+            batch = []
+    if batch:
+        TrackEmbedding.objects.bulk_create(batch)
+        copied += len(batch)
+
+    if copied:
+        AnnoyIndexStatus.objects.update_or_create(
+            singleton_instance_id=1,
+            defaults={'active_model_name': LEGACY_MODEL_NAME, 'active_preprocessing_version': LEGACY_PREPROCESSING_VERSION},
+        )
+
+
+def restore_track_embeddings(apps, schema_editor):
+    Track = apps.get_model('core', 'Track')
+    TrackEmbedding = apps.get_model('core', 'TrackEmbedding')
+    AnnoyIndexStatus = apps.get_model('core', 'AnnoyIndexStatus')
+
+    status = AnnoyIndexStatus.objects.filter(singleton_instance_id=1).first()
+    if status is None or not status.active_model_name:
+        return
+    embeddings = TrackEmbedding.objects.filter(
+        model_name=status.active_model_name, preprocessing_version=status.active_preprocessing_version,
+    )
+    batch = []
+    for track_id, embedding in embeddings.values_list('track_id', 'embedding').iterator(chunk_size=BATCH_SIZE):
+        batch.append(Track(pk=track_id, embedding=embedding))
+        if len(batch) >= BATCH_SIZE:
+            Track.objects.bulk_update(batch, ['embedding'])
+            batch = []
+    if batch:
+        Track.objects.bulk_update(batch, ['embedding'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_binary_embeddings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=255, verbose_name='Модель')),
+                ('preprocessing_version', models.CharField(max_length=64, verbose_name='Версия препроцессинга')),
+                ('embedding', core.embedding_codec.EmbeddingField(verbose_name='Эмбеддинг')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='embeddings', to='core.track', verbose_name='Трек')),
+            ],
+            options={
+                'verbose_name': 'Эмбеддинг трека',
+                'verbose_name_plural': 'Эмбеддинги треков',
+                'indexes': [models.Index(fields=['model_name', 'preprocessing_version', 'track'], name='core_trackemb_space_idx')],
+                'unique_together': {('track', 'model_name', 'preprocessing_version')},
+            },
+        ),
+        migrations.AddField(
+            model_name='annoyindexstatus',
+            name='active_model_name',
+            field=models.CharField(blank=True, max_length=255, verbose_name='Активная модель'),
+        ),
+        migrations.AddField(
+            model_name='annoyindexstatus',
+            name='active_preprocessing_version',
+            field=models.CharField(blank=True, max_length=64, verbose_name='Активная версия препроцессинга'),
+        ),
+        migrations.AlterField(
+            model_name='track',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='Хеш содержимого аудиофайла (ключ кеша эмбеддингов)', max_length=64, verbose_name='SHA-256 файла'),
+        ),
+        migrations.RunPython(copy_track_embeddings, restore_track_embeddings),
+        migrations.RemoveField(
+            model_name='track',
+            name='embedding',
+        ),
+    ]
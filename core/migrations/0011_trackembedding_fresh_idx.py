@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-17 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_trackembedding'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trackembedding',
+            index=models.Index(fields=['model_name', 'preprocessing_version', 'updated_at'], name='core_trackemb_fresh_idx'),
+        ),
+    ]
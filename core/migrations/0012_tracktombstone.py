@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-17 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_trackembedding_fresh_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('track_id', models.BigIntegerField(unique=True, verbose_name='ID трека')),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата удаления')),
+            ],
+            options={
+                'verbose_name': 'Удаленный трек в индексе',
+                'verbose_name_plural': 'Удаленные треки в индексе',
+            },
+        ),
+    ]
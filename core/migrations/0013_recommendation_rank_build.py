@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-17 17:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_tracktombstone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendation',
+            name='build_id',
+            field=models.CharField(blank=True, default='', help_text='Сборка индекса, по которой посчитана рекомендация', max_length=32, verbose_name='Сборка индекса'),
+        ),
+        migrations.AddField(
+            model_name='recommendation',
+            name='rank',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Позиция в списке рекомендаций (0 - самый похожий)', verbose_name='Позиция'),
+        ),
+        migrations.AddIndex(
+            model_name='recommendation',
+            index=models.Index(fields=['source_track', 'rank'], name='core_rec_source_rank_idx'),
+        ),
+    ]
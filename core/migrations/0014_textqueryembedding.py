@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-17 17:46
+
+import core.embedding_codec
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_recommendation_rank_build'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextQueryEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(help_text='Нормализованная строка запроса', max_length=255, verbose_name='Запрос')),
+                ('model_name', models.CharField(max_length=255, verbose_name='Модель')),
+                ('embedding', core.embedding_codec.EmbeddingField(verbose_name='Эмбеддинг')),
+                ('hit_count', models.PositiveIntegerField(db_index=True, default=0, verbose_name='Запросов')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Последнее использование')),
+            ],
+            options={
+                'verbose_name': 'Эмбеддинг текстового запроса',
+                'verbose_name_plural': 'Эмбеддинги текстовых запросов',
+                'unique_together': {('query', 'model_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2 on 2026-10-17 17:48
+
+import core.embedding_codec
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_textqueryembedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTasteVector',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='taste_vector', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('model_name', models.CharField(max_length=255, verbose_name='Модель')),
+                ('preprocessing_version', models.CharField(max_length=64, verbose_name='Версия препроцессинга')),
+                ('like_sum', core.embedding_codec.EmbeddingField(dtype='float32', verbose_name='Сумма лайков')),
+                ('dislike_sum', core.embedding_codec.EmbeddingField(dtype='float32', verbose_name='Сумма дизлайков')),
+                ('like_count', models.PositiveIntegerField(default=0, verbose_name='Лайков учтено')),
+                ('dislike_count', models.PositiveIntegerField(default=0, verbose_name='Дизлайков учтено')),
+                ('version', models.PositiveIntegerField(default=0, help_text='Увеличивается при каждом изменении (ключ кеша)', verbose_name='Версия')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлен')),
+            ],
+            options={
+                'verbose_name': 'Вектор вкуса',
+                'verbose_name_plural': 'Векторы вкуса',
+            },
+        ),
+        migrations.AddField(
+            model_name='likedislike',
+            name='taste_applied',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Учтен во вкусе'),
+        ),
+    ]
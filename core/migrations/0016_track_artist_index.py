@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 17:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_user_taste_vector'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='track',
+            name='artist',
+            field=models.CharField(db_index=True, max_length=200, verbose_name='Исполнитель'),
+        ),
+    ]
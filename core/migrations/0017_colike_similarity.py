@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-17 17:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_track_artist_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoLikeSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(help_text='Косинус между векторами лайков треков', verbose_name='Схожесть')),
+                ('co_likes', models.PositiveIntegerField(default=0, verbose_name='Совместных лайков')),
+                ('rank', models.PositiveSmallIntegerField(default=0, help_text='Позиция в списке (0 - самый похожий)', verbose_name='Позиция')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('similar_track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='colike_similar', to='core.track', verbose_name='Похожий трек')),
+                ('source_track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='colike_sources', to='core.track', verbose_name='Исходный трек')),
+            ],
+            options={
+                'verbose_name': 'Схожесть по лайкам',
+                'verbose_name_plural': 'Схожесть по лайкам',
+                'indexes': [models.Index(fields=['source_track', 'rank'], name='core_colike_source_rank_idx')],
+                'unique_together': {('source_track', 'similar_track')},
+            },
+        ),
+    ]
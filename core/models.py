@@ -1,11 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser, Group, BaseUserManager
-from .utils import generate_clap_embedding # Импортируем нашу функцию
 from django.conf import settings
 import os
 import logging # Добавим логирование
 from django.utils.translation import gettext_lazy as _ # Для сообщений об ошибках
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from .embedding_codec import EmbeddingField
 
 logger = logging.getLogger(__name__)
 
@@ -96,64 +97,65 @@ class Genre(models.Model):
 # Модель трека
 class Track(models.Model):
     title = models.CharField(max_length=200, verbose_name="Название")
-    artist = models.CharField(max_length=200, verbose_name="Исполнитель")
+    artist = models.CharField(max_length=200, db_index=True, verbose_name="Исполнитель") # Индекс: исключение треков исполнителя из рекомендаций
     genre = models.ForeignKey(Genre, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Жанр", related_name="tracks")
     duration = models.PositiveIntegerField(default=0, verbose_name="Длительность (сек)", help_text="Длительность трека в секундах (определяется автоматически)")
     filepath = models.FileField(upload_to='tracks/', verbose_name="Файл трека", help_text="Путь к аудиофайлу")
-    embedding = models.JSONField(null=True, blank=True, verbose_name="CLAP Эмбеддинг", help_text="Векторное представление трека (CLAP)")
-    # embedding = models.BinaryField(null=True, blank=True, verbose_name="Эмбеддинг") # Вариант хранения в БД
+    # Эмбеддинги хранятся в TrackEmbedding (по одному на модель/версию препроцессинга)
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True, editable=False, verbose_name="SHA-256 файла", help_text="Хеш содержимого аудиофайла (ключ кеша эмбеддингов)")
 
     _original_filepath = None # Для отслеживания изменений файла
+    _original_genre_id = None # Для отслеживания смены жанра (разделы индекса по жанрам)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Сохраняем исходный путь к файлу при загрузке объекта из БД
         self._original_filepath = self.filepath.name if self.pk else None
+        self._original_genre_id = self.genre_id if self.pk else None
 
     def save(self, *args, **kwargs):
-        """Переопределяем save для генерации эмбеддинга и установки флага перестроения Annoy."""
+        """Переопределяем save для постановки задачи на эмбеддинг и установки флага перестроения Annoy."""
         # Импортируем AnnoyIndexStatus здесь, внутри метода
         from .models import AnnoyIndexStatus
 
         is_new = self._state.adding
         file_changed = self.filepath.name != self._original_filepath
-        
-        # Вызываем оригинальный save, но только если это НЕ просто обновление эмбеддинга
-        # Это предотвращает рекурсию, когда мы обновляем только embedding ниже
-        update_fields = kwargs.get('update_fields')
-        if not update_fields or 'embedding' not in update_fields or len(update_fields) > 1:
-            super().save(*args, **kwargs)
-        
+
+        # Хеш содержимого считаем до сохранения, потоково (файл не читается в память целиком)
+        if file_changed:
+            from .embedding_cache import compute_content_hash
+            self.content_hash = compute_content_hash(self.filepath) if self.filepath else ''
+            if kwargs.get('update_fields'):
+                kwargs['update_fields'] = list(kwargs['update_fields']) + ['content_hash']
+
+        super().save(*args, **kwargs)
+
         embedding_needed = (is_new or file_changed) and self.filepath
         track_deleted = not self.filepath and self._original_filepath is not None
 
-        # Устанавливаем флаг, если трек добавлен, удален или файл изменен
-        if is_new or file_changed or track_deleted:
-             status, created = AnnoyIndexStatus.objects.get_or_create(singleton_instance_id=1)
-             if not status.needs_rebuild:
-                 status.needs_rebuild = True
-                 status.save(update_fields=['needs_rebuild']) 
-                 logger.info("Annoy index rebuild flag set to True due to Track changes.")
+        # Устанавливаем флаг, если файл изменен или удален (старый вектор в индексе устарел).
+        # Для новых треков флаг выставит воркер эмбеддингов, когда вектор будет готов.
+        if (file_changed and not is_new) or track_deleted:
+            AnnoyIndexStatus.request_rebuild("Track changes")
+            # Предрасчитанные рекомендации посчитаны по старому вектору
+            Recommendation.objects.filter(source_track_id=self.pk).delete()
+        elif not is_new and self.genre_id != self._original_genre_id:
+            # Трек остается в разделе старого жанра до перестройки
+            AnnoyIndexStatus.request_rebuild("Track genre changes")
+        self._original_genre_id = self.genre_id
 
         if embedding_needed:
-            try:
-                full_audio_path = os.path.join(settings.MEDIA_ROOT, self.filepath.name)
-                logger.info(f"Track saved/updated (ID: {self.pk}). Generating embedding for: {full_audio_path}")
-                new_embedding = generate_clap_embedding(full_audio_path)
-                if new_embedding:
-                    Track.objects.filter(pk=self.pk).update(embedding=new_embedding)
-                    logger.info(f"Embedding saved successfully for Track ID: {self.pk}")
-                    self._original_filepath = self.filepath.name
-                else:
-                    logger.warning(f"Embedding generation failed for Track ID: {self.pk}, file: {self.filepath.name}. Clearing embedding.")
-                    # Очищаем эмбеддинг, если генерация не удалась
-                    Track.objects.filter(pk=self.pk).update(embedding=None)
-            except Exception as e:
-                logger.error(f"Error during embedding generation/update for Track ID {self.pk}: {e}", exc_info=True)
-                Track.objects.filter(pk=self.pk).update(embedding=None) # Очищаем при ошибке
+            # Сам эмбеддинг считает фоновый воркер (manage.py run_embedding_worker),
+            # здесь только сбрасываем устаревшие векторы (всех моделей) и ставим задачу в очередь.
+            # Если такой же файл уже эмбеддили, enqueue_embedding сразу возьмет вектор из кеша.
+            from .embedding_queue import enqueue_embedding
+            TrackEmbedding.objects.filter(track_id=self.pk).delete()
+            enqueue_embedding(self)
+            logger.info(f"Track saved/updated (ID: {self.pk}). Embedding job queued for: {self.filepath.name}")
+            self._original_filepath = self.filepath.name
         elif track_deleted: # Если файл удален из существующего трека
             logger.warning(f"Track ID: {self.pk} file removed. Clearing embedding.")
-            Track.objects.filter(pk=self.pk).update(embedding=None)
+            TrackEmbedding.objects.filter(track_id=self.pk).delete()
             self._original_filepath = None
         elif not self.filepath and is_new:
              # Если трек создан без файла (например, через админку без загрузки)
@@ -203,6 +205,8 @@ class Recommendation(models.Model):
     source_track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='source_recommendations', verbose_name="Исходный трек")
     recommended_track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='recommended_for', verbose_name="Рекомендованный трек")
     score = models.FloatField(verbose_name="Оценка схожести", help_text="Метрика схожести от Annoy/CLAP")
+    rank = models.PositiveSmallIntegerField(default=0, verbose_name="Позиция", help_text="Позиция в списке рекомендаций (0 - самый похожий)")
+    build_id = models.CharField(max_length=32, blank=True, default='', verbose_name="Сборка индекса", help_text="Сборка индекса, по которой посчитана рекомендация")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
 
     def __str__(self):
@@ -212,6 +216,30 @@ class Recommendation(models.Model):
         verbose_name = "Рекомендация"
         verbose_name_plural = "Рекомендации"
         unique_together = ('source_track', 'recommended_track') # Гарантируем уникальность пар
+        indexes = [
+            # Страница рекомендаций трека - один запрос по этому индексу (см. core/recommendations.py)
+            models.Index(fields=['source_track', 'rank'], name='core_rec_source_rank_idx'),
+        ]
+
+# Модель item-item схожести по совместным лайкам (см. core/colike.py)
+class CoLikeSimilarity(models.Model):
+    source_track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='colike_sources', verbose_name="Исходный трек")
+    similar_track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='colike_similar', verbose_name="Похожий трек")
+    score = models.FloatField(verbose_name="Схожесть", help_text="Косинус между векторами лайков треков")
+    co_likes = models.PositiveIntegerField(default=0, verbose_name="Совместных лайков")
+    rank = models.PositiveSmallIntegerField(default=0, verbose_name="Позиция", help_text="Позиция в списке (0 - самый похожий)")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    def __str__(self):
+        return f"Co-like {self.source_track_id} -> {self.similar_track_id} ({self.score:.2f})"
+
+    class Meta:
+        verbose_name = "Схожесть по лайкам"
+        verbose_name_plural = "Схожесть по лайкам"
+        unique_together = ('source_track', 'similar_track')
+        indexes = [
+            models.Index(fields=['source_track', 'rank'], name='core_colike_source_rank_idx'),
+        ]
 
 # Модель задачи обучения/обработки (для CLAP)
 class TrainingJob(models.Model):
@@ -273,6 +301,8 @@ class LikeDislike(models.Model):
     track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='votes')
     vote = models.SmallIntegerField(choices=VOTE_CHOICES, verbose_name="Голос")
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Учтен ли вектор трека в векторе вкуса пользователя (у трека мог еще не быть эмбеддинга)
+    taste_applied = models.BooleanField(default=False, editable=False, verbose_name="Учтен во вкусе")
 
     class Meta:
         unique_together = ('user', 'track') # Пользователь может поставить только один голос на трек
@@ -293,6 +323,10 @@ class AnnoyIndexStatus(models.Model):
     singleton_instance_id = models.PositiveIntegerField(default=1, unique=True, editable=False)
     needs_rebuild = models.BooleanField(default=False, verbose_name="Требуется перестроение индекса")
     last_build_time = models.DateTimeField(null=True, blank=True, verbose_name="Время последнего построения")
+    # Пространство эмбеддингов (модель + версия препроцессинга), по которому построен обслуживаемый индекс.
+    # Переключается на новую модель только после того, как ее векторы покроют каталог (см. core/embedding_store.py)
+    active_model_name = models.CharField(max_length=255, blank=True, verbose_name="Активная модель")
+    active_preprocessing_version = models.CharField(max_length=64, blank=True, verbose_name="Активная версия препроцессинга")
 
     def __str__(self):
         return f"Статус индекса Annoy (Перестроение: {self.needs_rebuild})"
@@ -301,5 +335,151 @@ class AnnoyIndexStatus(models.Model):
         verbose_name = "Статус индекса Annoy"
         verbose_name_plural = "Статус индекса Annoy"
 
+    @classmethod
+    def request_rebuild(cls, reason=""):
+        """Выставляет флаг перестроения индекса (если он еще не выставлен)."""
+        status, created = cls.objects.get_or_create(singleton_instance_id=1)
+        if not status.needs_rebuild:
+            status.needs_rebuild = True
+            status.save(update_fields=['needs_rebuild'])
+            logger.info(f"Annoy index rebuild flag set to True{f' ({reason})' if reason else ''}.")
+        return status
+
+# --- Удаленные треки, которые еще могут быть в сборке индекса ---
+class TrackTombstone(models.Model):
+    """
+    ID удаленного трека. Поиск отфильтровывает такие ID без перестройки индекса;
+    запись удаляется, когда трек не попал в новую сборку (см. core/tombstones.py).
+    """
+    track_id = models.BigIntegerField(unique=True, verbose_name="ID трека")
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="Дата удаления")
+
+    def __str__(self):
+        return f"Tombstone of track {self.track_id}"
+
+    class Meta:
+        verbose_name = "Удаленный трек в индексе"
+        verbose_name_plural = "Удаленные треки в индексе"
+
+# --- Очередь задач генерации эмбеддингов ---
+class EmbeddingJob(models.Model):
+    """Задача на генерацию CLAP-эмбеддинга трека. Одна запись на трек, обрабатывается воркерами с арендой (lease)."""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидание'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Готово'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    track = models.OneToOneField(Track, on_delete=models.CASCADE, related_name='embedding_job', verbose_name="Трек")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name="Статус")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Попыток")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    available_at = models.DateTimeField(default=timezone.now, verbose_name="Доступна с", help_text="Задача не будет взята воркером раньше этого времени (backoff)")
+    locked_by = models.CharField(max_length=255, blank=True, verbose_name="Воркер")
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name="Аренда до", help_text="После истечения аренды задачу может забрать другой воркер")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    def __str__(self):
+        return f"Embedding job for track {self.track_id} ({self.status}, attempts: {self.attempts})"
+
+    class Meta:
+        verbose_name = "Задача эмбеддинга"
+        verbose_name_plural = "Очередь эмбеддингов"
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='core_embjob_status_avail_idx'),
+        ]
+
+# --- Эмбеддинги треков ---
+class TrackEmbedding(models.Model):
+    """
+    Эмбеддинг трека в конкретном пространстве (модель + версия препроцессинга).
+    Векторы новой модели можно досчитывать в фоне, пока индекс строится по старой.
+    """
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='embeddings', verbose_name="Трек")
+    model_name = models.CharField(max_length=255, verbose_name="Модель")
+    preprocessing_version = models.CharField(max_length=64, verbose_name="Версия препроцессинга")
+    # float32 blob (см. core/embedding_codec.py); при чтении - np.ndarray без копирования
+    embedding = EmbeddingField(verbose_name="Эмбеддинг")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    def __str__(self):
+        return f"Embedding of track {self.track_id} ({self.model_name}, {self.preprocessing_version})"
+
+    class Meta:
+        verbose_name = "Эмбеддинг трека"
+        verbose_name_plural = "Эмбеддинги треков"
+        unique_together = ('track', 'model_name', 'preprocessing_version')
+        indexes = [
+            models.Index(fields=['model_name', 'preprocessing_version', 'track'], name='core_trackemb_space_idx'),
+            # Дочитывание свежих эмбеддингов в дельту индекса (core/delta_index.py)
+            models.Index(fields=['model_name', 'preprocessing_version', 'updated_at'], name='core_trackemb_fresh_idx'),
+        ]
+
+# --- Кеш эмбеддингов по содержимому файла ---
+class EmbeddingCacheEntry(models.Model):
+    """Эмбеддинг, посчитанный для конкретного содержимого файла. Повторная загрузка того же аудио берет вектор отсюда."""
+    content_hash = models.CharField(max_length=64, verbose_name="SHA-256 файла")
+    model_name = models.CharField(max_length=255, verbose_name="Модель")
+    preprocessing_version = models.CharField(max_length=64, verbose_name="Версия препроцессинга", help_text="Меняется при изменении декодирования/окон аудио")
+    embedding = EmbeddingField(verbose_name="Эмбеддинг")
+    hit_count = models.PositiveIntegerField(default=0, verbose_name="Попаданий")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    last_used_at = models.DateTimeField(default=timezone.now, verbose_name="Последнее использование")
+
+    def __str__(self):
+        return f"{self.content_hash[:12]}… ({self.model_name}, {self.preprocessing_version})"
+
+    class Meta:
+        verbose_name = "Кеш эмбеддинга"
+        verbose_name_plural = "Кеш эмбеддингов"
+        unique_together = ('content_hash', 'model_name', 'preprocessing_version')
+
+class TextQueryEmbedding(models.Model):
+    """Эмбеддинг текстового запроса поиска (CLAP text). Популярные запросы загружаются в память процессов при старте."""
+    query = models.CharField(max_length=255, verbose_name="Запрос", help_text="Нормализованная строка запроса")
+    model_name = models.CharField(max_length=255, verbose_name="Модель")
+    embedding = EmbeddingField(verbose_name="Эмбеддинг")
+    hit_count = models.PositiveIntegerField(default=0, db_index=True, verbose_name="Запросов")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    last_used_at = models.DateTimeField(default=timezone.now, verbose_name="Последнее использование")
+
+    def __str__(self):
+        return f"{self.query} ({self.model_name})"
+
+    class Meta:
+        verbose_name = "Эмбеддинг текстового запроса"
+        verbose_name_plural = "Эмбеддинги текстовых запросов"
+        unique_together = ('query', 'model_name')
+
+class UserTasteVector(models.Model):
+    """
+    Вектор вкуса пользователя: суммы нормализованных эмбеддингов лайкнутых и дизлайкнутых треков и их количество.
+    Голос меняет суммы за O(dim) (см. core/taste.py), пересчет по всем голосам не нужен.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='taste_vector', verbose_name="Пользователь")
+    model_name = models.CharField(max_length=255, verbose_name="Модель")
+    preprocessing_version = models.CharField(max_length=64, verbose_name="Версия препроцессинга")
+    # Суммы храним в float32: float16 накапливал бы ошибку при многократных изменениях
+    like_sum = EmbeddingField(dtype='float32', verbose_name="Сумма лайков")
+    dislike_sum = EmbeddingField(dtype='float32', verbose_name="Сумма дизлайков")
+    like_count = models.PositiveIntegerField(default=0, verbose_name="Лайков учтено")
+    dislike_count = models.PositiveIntegerField(default=0, verbose_name="Дизлайков учтено")
+    version = models.PositiveIntegerField(default=0, verbose_name="Версия", help_text="Увеличивается при каждом изменении (ключ кеша)")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлен")
+
+    def __str__(self):
+        return f"Taste of {self.user_id} ({self.like_count} likes, {self.dislike_count} dislikes)"
+
+    class Meta:
+        verbose_name = "Вектор вкуса"
+        verbose_name_plural = "Векторы вкуса"
+
 # Не забыть добавить 'core.apps.CoreConfig' в INSTALLED_APPS в settings.py
 # И указать AUTH_USER_MODEL = 'core.User'
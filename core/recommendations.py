@@ -0,0 +1,170 @@
+# core/recommendations.py
+import logging
+import math
+from django.conf import settings
+from django.db import transaction
+from .candidate_filter import ExclusionSet, artist_exclusions, filter_candidates, user_vote_exclusions
+from .colike import colike_neighbors, hybrid_rank
+from .diversity import diversify
+from .models import Recommendation, Track
+from .result_cache import VersionedResultCache
+
+logger = logging.getLogger(__name__)
+
+# --- Предрасчитанные рекомендации ---
+# После перестройки индекса соседи каждого трека (по тем же правилам, что и find_nearest_neighbors)
+# записываются в Recommendation пачками. Страницы рекомендаций читают их одним запросом
+# по индексу (source_track, rank) и ищут вживую только для треков, которых в таблице еще нет
+# (например, загруженных после сборки - их находит дельта индекса).
+# Хранятся top_k ближайших без порога расстояния (score - схожесть, по ней восстанавливается расстояние):
+# порог применяется при чтении, поэтому трек, у которого в пределах порога меньше n соседей, тоже читается из таблицы.
+# Строки помечены build_id сборки; строки прошлых сборок удаляются после записи новой.
+
+
+def similarity_from_distance(distance, metric=settings.ANNOY_METRIC):
+    """Оценка схожести для Recommendation.score: косинус для angular (d = sqrt(2 - 2cos)), иначе -d."""
+    if metric == 'angular':
+        return 1.0 - distance * distance / 2.0
+    return -distance
+
+
+def materialize_recommendations(service, top_k=None, batch_size=None):
+    """
+    Записывает top_k ближайших соседей каждого трека текущей сборки service в Recommendation (без порога расстояния).
+    Треки обрабатываются пачками: один пакетный поиск и одна транзакция (удаление строк этих треков + bulk_create).
+    :return: количество записанных строк
+    """
+    top_k = top_k or settings.RECOMMENDATIONS_TOP_K
+    batch_size = batch_size or settings.RECOMMENDATIONS_BATCH_SIZE
+    build_id = service.build_id
+    if not build_id:
+        logger.warning("No index build loaded; skipping recommendation materialization.")
+        return 0
+
+    source_ids = service.item_map.slot_to_track
+    written = 0
+    logger.info(f"Materializing top-{top_k} recommendations for {len(source_ids)} tracks (build {build_id})...")
+    for start in range(0, len(source_ids), batch_size):
+        batch = [int(track_id) for track_id in source_ids[start:start + batch_size]]
+        # Снимок уже свежий (только что построен или загружен): без проверок на каждую пачку
+        neighbors = service.ranked_neighbors(batch, n=top_k, threshold=math.inf, refresh=False, log=False)
+        # Треки, удаленные во время построения, еще есть в сборке: такие строки не пишем
+        existing = set(Track.objects.filter(
+            pk__in={track_id for pairs in neighbors.values() for track_id, _ in pairs} | set(neighbors)
+        ).values_list('pk', flat=True))
+        rows = [
+            Recommendation(
+                source_track_id=source_id, recommended_track_id=neighbor_id, rank=rank,
+                score=similarity_from_distance(distance), build_id=build_id,
+            )
+            for source_id in batch if source_id in existing
+            for rank, (neighbor_id, distance) in enumerate(
+                pair for pair in neighbors.get(source_id, []) if pair[0] in existing
+            )
+        ]
+        with transaction.atomic():
+            Recommendation.objects.filter(source_track_id__in=batch).delete()
+            Recommendation.objects.bulk_create(rows, batch_size=2000)
+        written += len(rows)
+
+    # Треки, которых нет в новой сборке (например, после смены модели), не должны отдавать старые строки
+    stale, _ = Recommendation.objects.exclude(build_id=build_id).delete()
+    logger.info(f"Materialized {written} recommendations; removed {stale} rows from previous builds.")
+    return written
+
+
+# Результаты страниц рекомендаций: LRU процесса + Django cache, ключ включает версию данных индекса
+recommendation_cache = VersionedResultCache(
+    'recs',
+    local_size=settings.RECOMMENDATION_CACHE_LOCAL_SIZE,
+    timeout=settings.RECOMMENDATION_CACHE_TIMEOUT,
+)
+
+
+def _table_neighbors(track_id, n, threshold):
+    """
+    Соседи из предрасчитанной таблицы по правилам find_nearest_neighbors: до n ближе порога,
+    а если таких нет - n ближайших. None, если по таблице ответ не определить.
+    """
+    rows = list(
+        Recommendation.objects.filter(source_track_id=track_id)
+        .order_by('rank')
+        .values_list('recommended_track_id', 'score')[:n]
+    )
+    # distance < threshold <=> score > схожесть на пороге (схожесть убывает с расстоянием)
+    min_score = similarity_from_distance(threshold)
+    within = [neighbor_id for neighbor_id, score in rows if score > min_score]
+    if len(rows) < n and len(within) == len(rows):
+        # Строк меньше n (мало треков в сборке или часть соседей удалена), и все в пределах порога:
+        # ближе порога могут быть треки, которых в таблице нет - живой поиск
+        return None
+    # Строки идут по возрастанию расстояния: первая строка за порогом значит, что ближе порога больше никого нет
+    return within or [neighbor_id for neighbor_id, _ in rows]
+
+
+def _lookup_recommended_ids(track_id, n, threshold, genre_id=None):
+    # Предрасчет сделан без фильтра по жанру и на RECOMMENDATIONS_TOP_K соседей; в остальных случаях - только живой поиск
+    if genre_id is None and n <= settings.RECOMMENDATIONS_TOP_K:
+        recommended_ids = _table_neighbors(track_id, n, threshold)
+        if recommended_ids is not None:
+            return recommended_ids
+    from .annoy_service import annoy_service
+    return annoy_service.find_nearest_neighbors(track_id, n=n, threshold=threshold, genre_id=genre_id)
+
+
+def get_recommended_ids(track_id, n=10, threshold=settings.ANNOY_DISTANCE_THRESHOLD, genre_id=None):
+    """
+    ID рекомендованных треков: из предрасчитанной таблицы (один запрос по индексу),
+    а для треков, которых в ней нет, - живой поиск по индексу.
+    genre_id - только треки этого жанра (живой поиск по разделу индекса жанра).
+    Результат кешируется до смены версии данных индекса (новая сборка, свежие эмбеддинги, удаления).
+    """
+    from .annoy_service import annoy_service
+    version = annoy_service.refresh()
+    recommended_ids = recommendation_cache.get_or_compute(
+        version, (track_id, n, threshold, genre_id), lambda: _lookup_recommended_ids(track_id, n, threshold, genre_id),
+    )
+    return list(recommended_ids) # Копия: закешированный список не должен меняться вызывающим кодом
+
+
+def recommend_for_track(track, n=10, user_id=None, genre_id=None):
+    """
+    Похожие треки для страницы трека: аудио-соседи, смешанные с похожими по лайкам (COLIKE_WEIGHT),
+    с разнообразием по MMR (DIVERSITY_LAMBDA), после фильтрации (см. core/candidate_filter.py): без треков,
+    за которые пользователь уже голосовал (RECOMMENDATION_EXCLUDE_VOTES), и без треков того же исполнителя
+    (RECOMMENDATION_EXCLUDE_SAME_ARTIST). Кандидаты каждого раунда фильтра - только аудио-соседи
+    из get_recommended_ids (и его кеша); похожие по лайкам читаются один раз и подмешиваются после фильтра.
+    :return: FilterResult (ids - до n ID треков, rounds - сколько раундов понадобилось)
+    """
+    from .annoy_service import annoy_service
+    exclusions = ExclusionSet([track.pk])
+    if user_id and settings.RECOMMENDATION_EXCLUDE_VOTES:
+        exclusions = exclusions.union(user_vote_exclusions(user_id, settings.RECOMMENDATION_EXCLUDE_VOTES))
+    if settings.RECOMMENDATION_EXCLUDE_SAME_ARTIST and track.artist:
+        exclusions = exclusions.union(artist_exclusions(track.artist, annoy_service.refresh()))
+
+    def search(threshold):
+        return lambda k: get_recommended_ids(track.pk, n=k, threshold=threshold, genre_id=genre_id)
+
+    # Для MMR нужен пул шире n: из него выбираются разнообразные n треков (core/diversity.py)
+    pool_size = max(n, settings.DIVERSITY_POOL_SIZE) if settings.DIVERSITY_LAMBDA < 1 else n
+    threshold = settings.ANNOY_DISTANCE_THRESHOLD
+    # Первый раунд укладывается в предрасчитанную таблицу (RECOMMENDATIONS_TOP_K строк на трек), если исключений немного
+    initial_k = max(pool_size, min(pool_size + min(len(exclusions), pool_size), settings.RECOMMENDATIONS_TOP_K))
+    result = filter_candidates(search(threshold), pool_size, exclusions, initial_k=initial_k)
+    if not result.ids and result.exhausted:
+        # Как и без фильтра: если в пределах порога не осталось ни одного трека - просто ближайшие
+        threshold = math.inf
+        result = filter_candidates(search(threshold), pool_size, exclusions)
+
+    # Похожие по лайкам (core/colike.py): один запрос и одно вычисление расстояний на страницу
+    neighbors = colike_neighbors(track.pk, genre_id) if settings.COLIKE_WEIGHT > 0 else []
+    excluded = exclusions.mask([track_id for track_id, _ in neighbors])
+    colike = {track_id: score for (track_id, score), drop in zip(neighbors, excluded) if not drop}
+    if colike:
+        distances = annoy_service.distances(track.pk, [*result.ids, *colike])
+        result = result._replace(ids=hybrid_rank(result.ids, colike, distances, pool_size, threshold=threshold))
+    if pool_size > n:
+        # MMR по пулу из таблицы (или живого поиска): векторы кандидатов - из матрицы сборки
+        result = result._replace(ids=diversify(track.pk, result.ids, n, boosts=colike, boost_weight=settings.COLIKE_WEIGHT))
+    return result
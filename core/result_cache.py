@@ -0,0 +1,172 @@
+# core/result_cache.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# --- Двухуровневый кеш результатов поиска ---
+# L1 - ограниченный LRU в памяти процесса, L2 - Django cache (общий для процессов при memcached/redis).
+# В ключ входит версия данных (сборка индекса, дельта, удаленные треки): новая сборка дает новые ключи,
+# а старые записи просто вытесняются из LRU и истекают в Django cache - явного удаления не нужно.
+# Защита от лавины запросов к горячему ключу: внутри процесса ключ считает один поток (остальные ждут его),
+# между процессами - тот, кто первым взял блокировку cache.add; остальные недолго ждут результат в L2.
+
+_MISSING = object()
+STAT_NAMES = ('local_hits', 'shared_hits', 'misses', 'coalesced')
+
+
+class VersionedResultCache:
+    """Кеш результатов с версией данных в ключе (см. описание модуля)."""
+
+    def __init__(self, namespace, local_size, timeout, lock_timeout=2.0, poll_interval=0.02, stats_flush_interval=10.0):
+        self.namespace = namespace
+        self.local_size = local_size # Записей в LRU процесса
+        self.timeout = timeout # Время жизни записей в Django cache (сек)
+        self.lock_timeout = lock_timeout # Сколько ждать чужой расчет (сек) до того, как считать самому
+        self.poll_interval = poll_interval
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {} # key -> threading.Event расчета, который выполняется в этом процессе
+        self._stats = dict.fromkeys(STAT_NAMES, 0)
+        # Счетчики копятся в процессе и периодически добавляются к общим в Django cache
+        # (инкремент на каждый запрос съел бы выигрыш от L1)
+        self.stats_flush_interval = stats_flush_interval
+        self._pending_stats = dict.fromkeys(STAT_NAMES, 0)
+        self._next_stats_flush = time.monotonic() + stats_flush_interval
+
+    def _key(self, version, key_parts):
+        return ':'.join([self.namespace, str(version), *map(str, key_parts)])
+
+    def _stats_key(self, name):
+        return f"{self.namespace}:stats:{name}"
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+            self._pending_stats[name] += 1
+            flush = time.monotonic() >= self._next_stats_flush
+        if flush:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Добавляет накопленные счетчики процесса к общим (Django cache)."""
+        with self._lock:
+            pending, self._pending_stats = self._pending_stats, dict.fromkeys(STAT_NAMES, 0)
+            self._next_stats_flush = time.monotonic() + self.stats_flush_interval
+        for name, delta in pending.items():
+            if not delta:
+                continue
+            key = self._stats_key(name)
+            cache.add(key, 0, timeout=None)
+            try:
+                cache.incr(key, delta)
+            except ValueError:
+                cache.set(key, delta, timeout=None)
+
+    def _local_get(self, key):
+        with self._lock:
+            value = self._local.get(key, _MISSING)
+            if value is not _MISSING:
+                self._local.move_to_end(key)
+            return value
+
+    def _local_set(self, key, value):
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def _wait_shared(self, key):
+        """Ждет, пока другой процесс положит результат в L2 (не дольше lock_timeout)."""
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    def get_or_compute(self, version, key_parts, compute):
+        """
+        Результат из L1/L2 или compute() (результат кладется в оба уровня).
+        :param version: версия данных, от которых зависит результат
+        :param key_parts: остальные части ключа (ID трека, n, порог, ...)
+        """
+        key = self._key(version, key_parts)
+        value = self._local_get(key)
+        if value is not _MISSING:
+            self._count('local_hits')
+            return value
+
+        # Внутри процесса ключ считает один поток
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            event.wait(self.lock_timeout)
+            value = self._local_get(key)
+            if value is not _MISSING:
+                self._count('coalesced')
+                return value
+            # Расчет лидера упал или не уложился в lock_timeout: считаем сами
+
+        try:
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                self._count('shared_hits')
+                self._local_set(key, value)
+                return value
+
+            lock_key = f"{key}:lock"
+            locked = cache.add(lock_key, 1, timeout=max(1, int(self.lock_timeout * 2)))
+            if not locked:
+                value = self._wait_shared(key)
+                if value is not _MISSING:
+                    self._count('shared_hits')
+                    self._local_set(key, value)
+                    return value
+
+            self._count('misses')
+            try:
+                value = compute()
+                cache.set(key, value, timeout=self.timeout)
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+            self._local_set(key, value)
+            return value
+        finally:
+            if leader:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+    def prime(self, version, key_parts, value):
+        """Кладет готовое значение в L1 (прогрев процесса заранее известными результатами)."""
+        self._local_set(self._key(version, key_parts), value)
+
+    def stats(self):
+        """
+        Счетчики и доля попаданий (L1 + L2 + ожидание чужого расчета):
+        process - этого процесса, total - всех процессов (по последним сброшенным счетчикам).
+        """
+        self.flush_stats()
+        with self._lock:
+            process = dict(self._stats)
+            local_size = len(self._local)
+        total = {name: cache.get(self._stats_key(name), 0) for name in STAT_NAMES}
+        for counters in (process, total):
+            hits = counters['local_hits'] + counters['shared_hits'] + counters['coalesced']
+            lookups = hits + counters['misses']
+            counters['hit_rate'] = round(hits / lookups, 3) if lookups else None
+        return {'process': process, 'total': total, 'local_size': local_size}
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
@@ -1,19 +1,31 @@
 # core/signals.py
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, pre_delete
 from django.dispatch import receiver
-from .models import Track, AnnoyIndexStatus
+from .models import Track
+from .tombstones import record_tombstone
+from .taste import remove_track_from_tastes
 import logging
 
 logger = logging.getLogger(__name__)
 
 @receiver(post_delete, sender=Track)
 def track_deleted_handler(sender, instance, **kwargs):
-    """Устанавливает флаг перестроения индекса Annoy при удалении трека."""
+    """
+    Отмечает трек удаленным: поиск сразу перестает его возвращать, а индекс Annoy
+    перестраивается, только когда удаленных треков накопилось много (см. core/tombstones.py).
+    """
     try:
-        status, created = AnnoyIndexStatus.objects.get_or_create(singleton_instance_id=1)
-        if not status.needs_rebuild:
-            status.needs_rebuild = True
-            status.save(update_fields=['needs_rebuild'])
-            logger.info(f"Annoy index rebuild flag set to True due to Track deletion (ID: {instance.pk}).")
+        record_tombstone(instance.pk)
+        logger.info(f"Track ID {instance.pk} deleted; tombstone recorded for the Annoy index.")
     except Exception as e:
-        logger.error(f"Error setting Annoy rebuild flag on track deletion: {e}", exc_info=True) 
\ No newline at end of file
+        logger.error(f"Error recording tombstone on track deletion: {e}", exc_info=True)
+
+@receiver(pre_delete, sender=Track)
+def track_taste_handler(sender, instance, **kwargs):
+    """Вычитает трек из векторов вкуса проголосовавших, пока его голоса и эмбеддинг еще не удалены каскадом."""
+    try:
+        voters = remove_track_from_tastes(instance.pk)
+        if voters:
+            logger.info(f"Track ID {instance.pk} removed from taste vectors of {voters} users.")
+    except Exception as e:
+        logger.error(f"Error updating taste vectors on track deletion: {e}", exc_info=True)
@@ -0,0 +1,204 @@
+# core/taste.py
+import logging
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from .delta_index import normalize
+from .embedding_store import EmbeddingSpace, active_space, embeddings_in_space, get_track_embedding
+from .models import LikeDislike, UserTasteVector
+
+logger = logging.getLogger(__name__)
+
+# --- Векторы вкуса пользователей ---
+# Вкус = среднее нормализованных эмбеддингов лайкнутых треков минус TASTE_DISLIKE_WEIGHT * среднее дизлайкнутых.
+# Хранится не сам вектор, а суммы и количества (UserTasteVector): добавление, смена и отмена голоса
+# меняют суммы за O(dim), остальные голоса не читаются. LikeDislike.taste_applied отмечает голоса, вектор
+# которых вошел в суммы (у нового трека эмбеддинга может еще не быть), - при отмене вычитается ровно то,
+# что было добавлено. Суммы привязаны к пространству эмбеддингов активного индекса: после смены модели
+# вектор один раз пересчитывается по всем голосам (rebuild_taste_vector).
+# Запись эмбеддинга трека в активное пространство (core/embedding_store.py) согласует вкусы его голосовавших
+# (reconcile_track_tastes): голоса, ждавшие эмбеддинга, добавляются в суммы, а при замене вектора (перезаливка)
+# вкусы пересчитываются - в суммах лежит старый вектор, и вычитать новый нельзя.
+
+
+def _zeros():
+    return np.zeros(settings.ANNOY_EMBEDDING_DIM, dtype=np.float32)
+
+
+def _track_vector(track_id, space):
+    """Нормализованный эмбеддинг трека в пространстве space или None."""
+    embedding = get_track_embedding(track_id, space)
+    if embedding is None or len(embedding) != settings.ANNOY_EMBEDDING_DIM:
+        return None
+    return normalize(embedding)
+
+
+def _space_of(taste):
+    return EmbeddingSpace(taste.model_name, taste.preprocessing_version)
+
+
+def rebuild_taste_vector(user_id, space=None):
+    """Пересчитывает суммы вкуса по всем голосам пользователя (первое обращение, смена модели, рассинхронизация)."""
+    space = space or active_space()
+    with transaction.atomic():
+        votes = list(LikeDislike.objects.filter(user_id=user_id).values_list('pk', 'track_id', 'vote'))
+        embeddings = dict(
+            embeddings_in_space(space).filter(track_id__in=[track_id for _, track_id, _ in votes]).values_list('track_id', 'embedding')
+        )
+        like_sum, dislike_sum = _zeros(), _zeros()
+        like_count = dislike_count = 0
+        applied = []
+        for vote_pk, track_id, vote in votes:
+            embedding = embeddings.get(track_id)
+            if embedding is None or len(embedding) != settings.ANNOY_EMBEDDING_DIM:
+                continue
+            if vote == LikeDislike.LIKE:
+                like_sum += normalize(embedding)
+                like_count += 1
+            else:
+                dislike_sum += normalize(embedding)
+                dislike_count += 1
+            applied.append(vote_pk)
+        LikeDislike.objects.filter(user_id=user_id).exclude(pk__in=applied).update(taste_applied=False)
+        LikeDislike.objects.filter(pk__in=applied).update(taste_applied=True)
+
+        taste = UserTasteVector.objects.select_for_update().filter(user_id=user_id).first() or UserTasteVector(user_id=user_id)
+        taste.model_name, taste.preprocessing_version = space.model_name, space.preprocessing_version
+        taste.like_sum, taste.dislike_sum = like_sum, dislike_sum
+        taste.like_count, taste.dislike_count = like_count, dislike_count
+        taste.version += 1
+        taste.save()
+    logger.info(f"Rebuilt taste vector for user {user_id}: {like_count} likes, {dislike_count} dislikes.")
+    return taste
+
+
+def record_vote(user_id, track_id, old_vote, new_vote, old_applied):
+    """
+    Обновляет суммы вкуса после добавления, смены или отмены голоса (голос в LikeDislike уже записан).
+    :param old_vote: прежний голос (None - голоса не было)
+    :param new_vote: новый голос (None - голос отменен)
+    :param old_applied: входил ли прежний голос в суммы (LikeDislike.taste_applied)
+    Ошибка не прерывает голосование: она логируется, а суммы пересчитаются при следующем обращении.
+    """
+    try:
+        with transaction.atomic():
+            space = active_space()
+            taste = UserTasteVector.objects.select_for_update().filter(user_id=user_id).first()
+            if taste is None or _space_of(taste) != space:
+                # Сумм еще нет или они посчитаны в другом пространстве: пересчет по всем голосам (включая этот)
+                rebuild_taste_vector(user_id, space)
+                return
+            vector = _track_vector(track_id, space)
+            if old_applied and old_vote is not None and vector is None:
+                # Вычесть нечего (эмбеддинг трека пересчитывается) - суммы разошлись бы с голосами
+                rebuild_taste_vector(user_id, space)
+                return
+
+            like_sum, dislike_sum = np.array(taste.like_sum, dtype=np.float32), np.array(taste.dislike_sum, dtype=np.float32)
+            if old_applied and old_vote is not None:
+                if old_vote == LikeDislike.LIKE:
+                    like_sum -= vector
+                    taste.like_count = max(taste.like_count - 1, 0)
+                else:
+                    dislike_sum -= vector
+                    taste.dislike_count = max(taste.dislike_count - 1, 0)
+            new_applied = new_vote is not None and vector is not None
+            if new_applied:
+                if new_vote == LikeDislike.LIKE:
+                    like_sum += vector
+                    taste.like_count += 1
+                else:
+                    dislike_sum += vector
+                    taste.dislike_count += 1
+            if new_vote is not None:
+                LikeDislike.objects.filter(user_id=user_id, track_id=track_id).update(taste_applied=new_applied)
+
+            # Пустая сумма обнуляется точно: накопленная ошибка округления не переживает последний голос
+            taste.like_sum = like_sum if taste.like_count else _zeros()
+            taste.dislike_sum = dislike_sum if taste.dislike_count else _zeros()
+            taste.version += 1
+            taste.save()
+    except Exception as e:
+        logger.error(f"Failed to update taste vector of user {user_id} for track {track_id}: {e}", exc_info=True)
+
+
+def remove_track_from_tastes(track_id):
+    """Вычитает удаляемый трек из вкуса всех, кто за него голосовал (до каскадного удаления голосов)."""
+    voters = list(LikeDislike.objects.filter(track_id=track_id, taste_applied=True).values_list('user_id', 'vote'))
+    for user_id, vote in voters:
+        record_vote(user_id, track_id, vote, None, True)
+    return len(voters)
+
+
+def reconcile_track_tastes(track_ids, replaced_ids=()):
+    """
+    Согласует вкусы с эмбеддингами, только что записанными в активное пространство.
+    :param track_ids: треки с новым вектором
+    :param replaced_ids: треки из них, у которых вектор в этом пространстве уже был (его суммы содержат старый)
+    :return: (пересчитано пользователей, добавлено ожидавших голосов)
+    """
+    rebuilt = set(
+        LikeDislike.objects.filter(track_id__in=list(replaced_ids), taste_applied=True).values_list('user_id', flat=True)
+    )
+    for user_id in rebuilt:
+        try:
+            rebuild_taste_vector(user_id)
+        except Exception as e:
+            logger.error(f"Failed to rebuild taste vector of user {user_id}: {e}", exc_info=True)
+    pending = LikeDislike.objects.filter(track_id__in=list(track_ids), taste_applied=False).exclude(user_id__in=rebuilt)
+    applied = 0
+    for user_id, track_id, vote in pending.values_list('user_id', 'track_id', 'vote'):
+        record_vote(user_id, track_id, None, vote, False)
+        applied += 1
+    if rebuilt or applied:
+        logger.info(f"Reconciled tastes for new embeddings: {len(rebuilt)} users rebuilt, {applied} pending votes applied.")
+    return len(rebuilt), applied
+
+
+def get_taste(user_id):
+    """UserTasteVector пользователя в пространстве активного индекса (при необходимости пересчитывается)."""
+    taste = UserTasteVector.objects.filter(user_id=user_id).first()
+    space = active_space()
+    if taste is None or _space_of(taste) != space:
+        taste = rebuild_taste_vector(user_id, space)
+    return taste
+
+
+def taste_vector(taste):
+    """Вектор вкуса: среднее лайков минус TASTE_DISLIKE_WEIGHT * среднее дизлайков; None, если лайков нет."""
+    if not taste.like_count:
+        return None
+    vector = np.asarray(taste.like_sum, dtype=np.float32) / taste.like_count
+    if taste.dislike_count:
+        vector = vector - settings.TASTE_DISLIKE_WEIGHT * np.asarray(taste.dislike_sum, dtype=np.float32) / taste.dislike_count
+    return vector
+
+
+def _search_vibe(user_id, vector, n):
+    from .annoy_service import annoy_service
+    from .candidate_filter import filter_candidates, user_vote_exclusions
+    # Ближайшими к вкусу обычно оказываются сами оцененные треки: фильтр дозапрашивает кандидатов раундами
+    result = filter_candidates(
+        lambda k: [track_id for track_id, _ in annoy_service.find_nearest_to_vector(vector, n=k)],
+        n, user_vote_exclusions(user_id, 'all'),
+    )
+    return result.ids
+
+
+def get_vibe_ids(user_id, n=10):
+    """
+    ID треков "Моего вайба": один поиск по индексу вектором вкуса, без уже оцененных пользователем треков.
+    Результат кешируется до изменения вкуса (версия UserTasteVector) или данных индекса.
+    :return: (список ID, UserTasteVector)
+    """
+    taste = get_taste(user_id)
+    vector = taste_vector(taste)
+    if vector is None:
+        return [], taste
+    from .annoy_service import annoy_service
+    from .recommendations import recommendation_cache
+    version = annoy_service.refresh()
+    vibe_ids = recommendation_cache.get_or_compute(
+        version, ('vibe', user_id, taste.version, n), lambda: _search_vibe(user_id, vector, n),
+    )
+    return list(vibe_ids), taste
@@ -0,0 +1,35 @@
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from .. import annoy_service as annoy_service_module
+from ..annoy_service import AnnoyService
+from ..embedding_store import bulk_save_track_embeddings
+from ..models import Track
+
+User = get_user_model()
+DIM = 16
+
+
+def random_vectors(count, dim=DIM, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+class IndexTestCase(TestCase):
+    """Каталог со случайными эмбеддингами и свой AnnoyService во временном каталоге (вместо общего экземпляра)."""
+    num_tracks = 80
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, True)
+        self.enterContext(override_settings(ANNOY_EMBEDDING_DIM=DIM))
+        self.tracks = [Track.objects.create(title=f"Track {i}", artist=f"Artist {i}") for i in range(self.num_tracks)]
+        bulk_save_track_embeddings(list(zip([track.pk for track in self.tracks], self.track_vectors())))
+        self.service = AnnoyService(dimension=DIM, index_dir=self.index_dir)
+        self.enterContext(mock.patch.object(annoy_service_module, 'annoy_service', self.service))
+        self.service.build_index_from_db(num_trees=5, backend='exact')
+
+    def track_vectors(self):
+        return random_vectors(self.num_tracks)
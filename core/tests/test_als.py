@@ -0,0 +1,86 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from ..als import (
+    FactorService, FactorSnapshot, JOB_NAME, create_training_job, publish_factors, recover_stale_jobs,
+    schedule_training, solve_factors, train_als,
+)
+from ..models import TrainingJob
+from .base import random_vectors
+
+
+@override_settings(ALS_BLAS_THREADS=1)
+class ALSTests(SimpleTestCase):
+
+    def vote_matrix(self):
+        from scipy import sparse
+        # Две группы: пользователи 0-9 лайкают треки 0-9, пользователи 10-19 - треки 10-19 (по 5 случайных)
+        rng = np.random.default_rng(0)
+        rows, cols = [], []
+        for user in range(20):
+            group = (user // 10) * 10
+            for track in rng.choice(10, 5, replace=False):
+                rows.append(user)
+                cols.append(group + track)
+        data = np.full(len(rows), 40.0, dtype=np.float32)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(20, 20))
+
+    def test_blocked_solve_matches_per_row_solve(self):
+        matrix = self.vote_matrix()
+        other = random_vectors(20, 4, seed=3)
+        blocked = solve_factors(matrix, other, 0.1, block_memory_mb=0.0005) # Несколько строк в пачке
+        for row in range(matrix.shape[0]):
+            cols = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+            confidence = np.zeros(20, dtype=np.float64)
+            confidence[cols] = 40.0
+            a = other.T.astype(np.float64) @ ((1 + confidence)[:, None] * other) + 0.1 * np.eye(4)
+            b = other.T.astype(np.float64) @ np.where(confidence > 0, 1 + confidence, 0)
+            np.testing.assert_allclose(blocked[row], np.linalg.solve(a, b), rtol=1e-3, atol=1e-4)
+
+    def test_training_recovers_groups(self):
+        matrix = self.vote_matrix()
+        user_factors, item_factors = train_als(matrix, factors=4, iterations=10, regularization=0.1)
+        self.assertEqual((user_factors.shape, item_factors.shape), ((20, 4), (20, 4)))
+        scores = user_factors @ item_factors.T
+        own = np.array([scores[user, (user // 10) * 10:(user // 10) * 10 + 10].mean() for user in range(20)])
+        other = np.array([scores[user, 10 - (user // 10) * 10:20 - (user // 10) * 10].mean() for user in range(20)])
+        self.assertTrue((own > other).all())
+
+
+
+
+class TrainingJobRecoveryTests(TestCase):
+
+    def test_stale_running_job_is_failed_and_rescheduled(self):
+        job = create_training_job()
+        TrainingJob.objects.filter(pk=job.pk).update(status='running', started_at=timezone.now() - timedelta(hours=5))
+        fresh = create_training_job()
+        TrainingJob.objects.filter(pk=fresh.pk).update(status='running', started_at=timezone.now())
+        self.assertEqual(recover_stale_jobs(timeout_minutes=60), 1)
+        self.assertEqual(TrainingJob.objects.get(pk=job.pk).status, 'failed')
+        self.assertEqual(TrainingJob.objects.get(pk=fresh.pk).status, 'running')
+
+        TrainingJob.objects.filter(pk=fresh.pk).update(started_at=timezone.now() - timedelta(hours=5))
+        with override_settings(ALS_JOB_TIMEOUT_MINUTES=60):
+            schedule_training()
+        self.assertEqual(TrainingJob.objects.get(pk=fresh.pk).status, 'failed')
+        self.assertTrue(TrainingJob.objects.filter(status='pending', parameters__job=JOB_NAME).exists())
+
+
+class FactorReloadTests(SimpleTestCase):
+
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_dir, True)
+
+    def test_failed_load_is_retried(self):
+        manifest = publish_factors(random_vectors(3, 4), random_vectors(5, 4, seed=1), [1, 2, 3], [10, 11, 12, 13, 14], model_dir=self.model_dir)
+        service = FactorService(model_dir=self.model_dir, reload_interval=0)
+        with mock.patch.object(FactorSnapshot, 'load', side_effect=OSError("truncated build")):
+            self.assertIsNone(service.refresh())
+        self.assertEqual(service.refresh(), manifest['build_id']) # Манифест не менялся, но загрузка повторяется
+        self.assertEqual(len(service.top_tracks(2, 3)), 3)
@@ -0,0 +1,165 @@
+import math
+from datetime import timedelta
+from unittest import mock
+from django.conf import settings
+from django.db.models.query import QuerySet
+from django.test import override_settings
+from django.utils import timezone
+from ..annoy_service import AnnoyService, IndexSnapshot
+from ..embedding_store import get_track_embedding, save_track_embedding
+from ..item_map import read_manifest
+from ..models import AnnoyIndexStatus, Genre, Track, TrackEmbedding, TrackTombstone
+from .base import DIM, IndexTestCase, random_vectors
+
+
+class IndexReloadTests(IndexTestCase):
+    num_tracks = 20
+
+    def test_failed_load_is_retried(self):
+        builder = AnnoyService(dimension=DIM, index_dir=self.index_dir)
+        builder.build_index_from_db(num_trees=5, backend='exact')
+        with mock.patch.object(IndexSnapshot, 'load', side_effect=OSError("truncated build")):
+            self.assertFalse(self.service.refresh_if_stale(force=True))
+        self.assertNotEqual(self.service.build_id, builder.build_id)
+        self.assertTrue(self.service.refresh_if_stale(force=True)) # Манифест не менялся, но загрузка повторяется
+        self.assertEqual(self.service.build_id, builder.build_id)
+
+
+class IndexBuildTests(IndexTestCase):
+    num_tracks = 30
+
+    def test_embeddings_written_during_build_go_to_delta(self):
+        late = [track.pk for track in self.tracks[-3:]]
+        # Записаны после начала построения
+        TrackEmbedding.objects.filter(track_id__in=late).update(updated_at=timezone.now() + timedelta(minutes=1))
+        self.service.build_index_from_db(num_trees=5, backend='annoy')
+        self.assertEqual(len(self.service.item_map), self.num_tracks - 3)
+        self.assertTrue(all(self.service.item_map.slot_for_track(track_id) is None for track_id in late))
+        self.service.delta.refresh(force=True)
+        self.assertTrue(all(track_id in self.service.delta for track_id in late))
+
+    def test_rows_beyond_count_do_not_overflow_build_files(self):
+        # Подсчет видит на 5 строк меньше, чем потом отдает чтение (поздний коммит с ранним updated_at)
+        with mock.patch.object(QuerySet, 'count', return_value=self.num_tracks - 5):
+            self.service.build_index_from_db(num_trees=5, backend='annoy')
+        self.assertEqual(len(self.service.item_map), self.num_tracks - 5)
+        self.assertEqual(len(self.service._snapshot.vectors), self.num_tracks - 5)
+        self.assertTrue(AnnoyIndexStatus.objects.get(singleton_instance_id=1).needs_rebuild)
+
+
+class TombstoneTests(IndexTestCase):
+    num_tracks = 30
+
+    def setUp(self):
+        super().setUp()
+        self.service.tombstones.refresh_interval = 0 # Каждый поиск дочитывает надгробия
+
+    def test_deleted_track_disappears_before_rebuild(self):
+        source = self.tracks[0].pk
+        neighbors = self.service.find_nearest_neighbors(source, n=5, threshold=math.inf)
+        deleted = Track.objects.get(pk=neighbors[0])
+        build_id = self.service.build_id
+        deleted.delete()
+        after = self.service.find_nearest_neighbors(source, n=5, threshold=math.inf)
+        self.assertNotIn(neighbors[0], after)
+        self.assertEqual(after[:4], neighbors[1:]) # Остальные сдвигаются, выдача остается полной
+        self.assertEqual(len(after), 5)
+        self.assertEqual(self.service.build_id, build_id) # Без перестройки
+        self.assertTrue(TrackTombstone.objects.filter(track_id=neighbors[0]).exists())
+
+    def test_rebuild_prunes_tombstones(self):
+        deleted_id = self.tracks[1].pk
+        self.tracks[1].delete()
+        self.service.build_index_from_db(num_trees=5, backend='exact')
+        self.assertFalse(TrackTombstone.objects.exists())
+        self.assertIsNone(self.service.item_map.slot_for_track(deleted_id))
+
+
+class BatchNeighborsTests(IndexTestCase):
+
+    def test_batch_matches_single_track_search(self):
+        seeds = [track.pk for track in self.tracks[:5]]
+        for threshold in (settings.ANNOY_DISTANCE_THRESHOLD, 1.4, math.inf):
+            batch = self.service.find_nearest_neighbors_many(seeds, n=8, threshold=threshold)
+            for seed in seeds:
+                single = self.service.find_nearest_neighbors(seed, n=8, threshold=threshold)
+                self.assertEqual(batch.per_seed[seed], single)
+                self.assertNotIn(seed, single)
+
+            ranked = self.service.ranked_neighbors(seeds, n=8, threshold=threshold)
+            for seed in seeds:
+                self.assertEqual([track_id for track_id, _ in ranked[seed]], batch.per_seed[seed])
+                distances = [distance for _, distance in ranked[seed]]
+                self.assertEqual(distances, sorted(distances))
+
+    def test_fused_list_excludes_seeds(self):
+        seeds = [track.pk for track in self.tracks[:5]]
+        fused = self.service.find_nearest_neighbors_many(seeds, n=20, threshold=math.inf).fused
+        self.assertEqual(len(fused), 20)
+        self.assertFalse(set(fused) & set(seeds))
+        self.assertEqual(len(set(fused)), len(fused))
+
+    def test_fused_ranks_shared_neighbors_first(self):
+        # Трек, который в списках нескольких исходных, поднимается выше
+        from ..annoy_service import fuse_rankings
+        self.assertEqual(fuse_rankings([[1, 2, 3], [4, 3, 5]], 3, exclude={1}), [3, 4, 2])
+
+    def test_unknown_seed_is_skipped(self):
+        batch = self.service.find_nearest_neighbors_many([self.tracks[0].pk, 10 ** 9], n=5, threshold=math.inf)
+        self.assertEqual(batch.per_seed[10 ** 9], [])
+        self.assertEqual(len(batch.fused), 5)
+
+
+@override_settings(GENRE_PARTITION_MIN_ITEMS=20) # Крупные жанры - свой индекс Annoy, мелкие - точный перебор
+class GenreFilterTests(IndexTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.genres = [Genre.objects.create(name=name) for name in ('Rock', 'Jazz', 'Folk')]
+        sizes = [40, 25, 5] # Остальные 10 треков без жанра
+        start = 0
+        for genre, size in zip(self.genres, sizes):
+            Track.objects.filter(pk__in=[track.pk for track in self.tracks[start:start + size]]).update(genre=genre)
+            start += size
+        self.service.build_index_from_db(num_trees=10, backend='annoy')
+        self.service.delta.refresh_interval = 0
+        self.genre_of = dict(Track.objects.values_list('pk', 'genre_id'))
+
+    def add_delta_track(self, genre, near):
+        track = Track.objects.create(title="Fresh", artist="Artist", genre=genre)
+        vector = get_track_embedding(near.pk) + 0.01 * random_vectors(1, seed=track.pk)[0]
+        save_track_embedding(track.pk, vector)
+        self.genre_of[track.pk] = genre.pk if genre else None
+        return track
+
+    def test_partitions_in_manifest(self):
+        genres = read_manifest(self.index_dir)['genres']
+        self.assertEqual({genre_id: info['backend'] for genre_id, info in genres.items()},
+                         {str(self.genres[0].pk): 'annoy', str(self.genres[1].pk): 'annoy', str(self.genres[2].pk): 'exact'})
+
+    def test_genre_filter_returns_only_that_genre(self):
+        source = self.tracks[50] # Jazz; ищем по каждому жанру
+        for genre, size in zip(self.genres, (40, 25, 5)):
+            neighbors = self.service.find_nearest_neighbors(source.pk, n=10, threshold=math.inf, genre_id=genre.pk)
+            self.assertEqual(len(neighbors), min(10, size - (genre == self.genres[1])))
+            self.assertTrue(all(self.genre_of[track_id] == genre.pk for track_id in neighbors))
+
+    def test_delta_tracks_are_filtered_by_genre(self):
+        source = self.tracks[0]
+        fresh_rock = self.add_delta_track(self.genres[0], near=source)
+        fresh_untagged = self.add_delta_track(None, near=source)
+        fresh_folk = self.add_delta_track(self.genres[2], near=source)
+        rock = self.service.find_nearest_neighbors(source.pk, n=10, threshold=math.inf, genre_id=self.genres[0].pk)
+        self.assertEqual(rock[0], fresh_rock.pk)
+        self.assertTrue(all(self.genre_of[track_id] == self.genres[0].pk for track_id in rock))
+        folk = self.service.find_nearest_neighbors(source.pk, n=10, threshold=math.inf, genre_id=self.genres[2].pk)
+        self.assertEqual(folk[0], fresh_folk.pk)
+        self.assertEqual(len(folk), 6)
+        self.assertTrue(all(self.genre_of[track_id] == self.genres[2].pk for track_id in folk))
+        self.assertNotIn(fresh_untagged.pk, rock + folk)
+        self.assertIn(fresh_untagged.pk, self.service.find_nearest_neighbors(source.pk, n=3, threshold=math.inf))
+
+    def test_genre_only_in_delta(self):
+        new_genre = Genre.objects.create(name='Ambient')
+        fresh = self.add_delta_track(new_genre, near=self.tracks[0])
+        self.assertEqual(self.service.find_nearest_neighbors(self.tracks[0].pk, n=5, threshold=math.inf, genre_id=new_genre.pk), [fresh.pk])
@@ -0,0 +1,81 @@
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import SimpleTestCase, TestCase
+from ..audio_io import probe_audio, probe_uploaded_file
+from ..embedding_queue import _probe_duration
+from ..models import Track
+
+
+def wav_bytes(header_seconds, data_bytes=1600, sample_rate=8000):
+    """WAV (PCM 16 бит, моно), заголовок которого заявляет header_seconds, а данных - только data_bytes."""
+    size = int(header_seconds * sample_rate) * 2
+    header = b'RIFF' + struct.pack('<I', 36 + size) + b'WAVEfmt '
+    header += struct.pack('<IHHIIHH', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+    return header + b'data' + struct.pack('<I', size) + b'\0' * data_bytes
+
+
+class ProbeAudioTests(SimpleTestCase):
+
+    def setUp(self):
+        # Путь через librosa (декодирование) недоступен: пробинг должен обходиться заголовками
+        self.enterContext(mock.patch.dict(sys.modules, {'librosa': None}))
+
+    def test_duration_comes_from_headers_only(self):
+        # Заголовок заявляет час звука, а в файле 0.1 секунды: сигнал не декодируется
+        info = probe_audio(io.BytesIO(wav_bytes(3600)), allow_decode=False)
+        self.assertEqual(info.duration, 3600.0)
+        self.assertEqual((info.sample_rate, info.channels), (8000, 1))
+
+    def test_file_position_is_restored(self):
+        source = io.BytesIO(wav_bytes(2.5))
+        self.assertEqual(probe_audio(source, allow_decode=False).duration, 2.5)
+        self.assertEqual(source.tell(), 0) # Файл затем сохраняется целиком
+        self.assertEqual(probe_audio(source, allow_decode=False).duration, 2.5)
+
+    def test_unreadable_headers_raise_without_decoding(self):
+        with self.assertRaises(ValueError):
+            probe_audio(io.BytesIO(b'not audio at all' * 100), allow_decode=False)
+
+    def test_uploaded_files(self):
+        in_memory = SimpleUploadedFile('song.wav', wav_bytes(90), content_type='audio/wav')
+        self.assertEqual(probe_uploaded_file(in_memory).duration, 90.0)
+
+        on_disk = TemporaryUploadedFile('mix.wav', 'audio/wav', 0, None)
+        self.addCleanup(on_disk.close)
+        on_disk.write(wav_bytes(3600))
+        on_disk.seek(0)
+        self.assertEqual(probe_uploaded_file(on_disk).duration, 3600.0)
+
+        with self.assertRaises(ValueError):
+            probe_uploaded_file(SimpleUploadedFile('broken.wav', b'garbage' * 100, content_type='audio/wav'))
+
+
+class WorkerDurationProbeTests(TestCase):
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(sys.modules, {'librosa': None}))
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.track = Track.objects.create(title="Long mix", artist="DJ")
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_duration_is_rounded_up_and_stored(self):
+        _probe_duration(self.track, self.write('mix.wav', wav_bytes(1800.2)))
+        self.track.refresh_from_db()
+        self.assertEqual(self.track.duration, 1801)
+
+    def test_unreadable_file_leaves_duration_empty(self):
+        _probe_duration(self.track, self.write('broken.wav', b'garbage' * 100))
+        self.track.refresh_from_db()
+        self.assertFalse(self.track.duration)
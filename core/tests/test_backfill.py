@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock
+import numpy as np
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from .. import embedding_providers
+from ..embedding_providers import EmbeddingProvider
+from ..embedding_store import embeddings_in_space, target_space
+from ..management.commands import backfill_embeddings
+from ..models import Track
+from .base import DIM
+
+
+class FakeProvider(EmbeddingProvider):
+    """Провайдер без модели: waveform - имя файла, вектор - детерминированный по нему."""
+    model_name = 'fake-clap'
+    dimension = DIM
+
+    def __init__(self):
+        self.embedded = []
+
+    def load_audio(self, audio_path):
+        return os.path.basename(audio_path)
+
+    def embed_waveforms(self, waveforms):
+        self.embedded.extend(waveforms)
+        return [np.random.default_rng(int(name.split('.')[0])).normal(size=DIM).astype(np.float32) for name in waveforms]
+
+
+class BackfillResumeTests(TestCase):
+    num_tracks = 6
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root, ANNOY_EMBEDDING_DIM=DIM))
+        self.provider = FakeProvider()
+        self.enterContext(mock.patch.object(embedding_providers, '_provider', self.provider))
+        # Декодирование в потоках того же процесса: дочерние процессы не видят тестовую БД и подмененный провайдер
+        self.enterContext(mock.patch.object(backfill_embeddings, 'ProcessPoolExecutor', ThreadPoolExecutor))
+        self.checkpoint = os.path.join(media_root, 'backfill.json')
+
+        os.makedirs(os.path.join(media_root, 'tracks'))
+        self.tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(self.num_tracks)]
+        for track in self.tracks:
+            filepath = f"tracks/{track.pk}.mp3"
+            with open(os.path.join(media_root, filepath), 'wb') as f:
+                f.write(b'audio')
+            Track.objects.filter(pk=track.pk).update(filepath=filepath) # Без save: хеш и задача очереди не нужны
+
+    def backfill(self, *args):
+        out = StringIO()
+        call_command('backfill_embeddings', '--batch-size=2', '--workers=2', f'--checkpoint={self.checkpoint}', *args, stdout=out)
+        return out.getvalue()
+
+    def embedded_ids(self):
+        return sorted(embeddings_in_space(target_space()).values_list('track_id', flat=True))
+
+    def embedded_files(self):
+        return sorted(int(name.split('.')[0]) for name in self.provider.embedded)
+
+    def test_rerun_skips_tracks_with_embeddings(self):
+        self.backfill()
+        self.assertEqual(self.embedded_ids(), [track.pk for track in self.tracks])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+        self.provider.embedded.clear()
+        output = self.backfill()
+        self.assertIn("No tracks to backfill", output)
+        self.assertEqual(self.provider.embedded, [])
+
+    def test_rerun_after_partial_run_embeds_only_the_rest(self):
+        done = [track.pk for track in self.tracks[:4]]
+        self.backfill(f'--to-id={done[-1]}')
+        self.provider.embedded.clear()
+        self.backfill()
+        self.assertEqual(self.embedded_files(), [track.pk for track in self.tracks[4:]])
+        self.assertEqual(self.embedded_ids(), [track.pk for track in self.tracks])
+
+    def test_resumes_after_checkpoint(self):
+        last_done = self.tracks[2].pk
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'selection': 'all:None:None', 'last_track_id': last_done}, f)
+        output = self.backfill('--select=all')
+        self.assertIn(f"Resuming from checkpoint: tracks after ID {last_done}", output)
+        self.assertEqual(self.embedded_files(), [track.pk for track in self.tracks[3:]])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_checkpoint_of_other_selection_is_ignored(self):
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'selection': 'failed:None:None', 'last_track_id': self.tracks[2].pk}, f)
+        self.backfill('--select=all')
+        self.assertEqual(self.embedded_files(), [track.pk for track in self.tracks])
@@ -0,0 +1,42 @@
+from django.test import SimpleTestCase
+from ..candidate_filter import ExclusionSet, filter_candidates
+
+
+class CandidateFilterTests(SimpleTestCase):
+
+    def make_search(self, ranking):
+        calls = []
+
+        def search(k):
+            calls.append(k)
+            return ranking[:k]
+        return search, calls
+
+    def test_refetches_until_enough_survivors(self):
+        ranking = list(range(1, 201))
+        search, calls = self.make_search(ranking)
+        exclusions = ExclusionSet(range(1, 31)) # Первые 30 кандидатов исключены
+        result = filter_candidates(search, 10, exclusions, initial_k=12, budget_ms=1000)
+        self.assertEqual(result.ids, list(range(31, 41)))
+        self.assertGreater(result.rounds, 1)
+        self.assertEqual(len(calls), result.rounds)
+        self.assertTrue(all(later > earlier for earlier, later in zip(calls, calls[1:])))
+        self.assertFalse(result.exhausted)
+
+    def test_stops_when_candidates_run_out(self):
+        search, _ = self.make_search(list(range(1, 16)))
+        result = filter_candidates(search, 10, ExclusionSet(range(1, 11)), initial_k=12, budget_ms=1000)
+        self.assertEqual(result.ids, list(range(11, 16)))
+        self.assertTrue(result.exhausted)
+
+    def test_single_round_without_exclusions(self):
+        search, calls = self.make_search(list(range(1, 101)))
+        result = filter_candidates(search, 10, ExclusionSet())
+        self.assertEqual((result.ids, result.rounds, calls), (list(range(1, 11)), 1, [10]))
+
+    def test_exclusion_mask(self):
+        exclusions = ExclusionSet([5, 1, 9, 5])
+        self.assertEqual(len(exclusions), 3)
+        self.assertEqual(exclusions.mask([0, 1, 5, 7, 9, 10]).tolist(), [False, True, True, False, True, False])
+        self.assertIn(9, exclusions)
+        self.assertNotIn(10, exclusions)
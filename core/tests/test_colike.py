@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+from django.test import SimpleTestCase, TestCase, override_settings
+from ..colike import hybrid_rank, update_colike_similarities
+from ..models import CoLikeSimilarity, LikeDislike, Track
+from .base import User
+
+
+class CoLikeSimilarityTests(TestCase):
+
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir, True)
+        self.enterContext(override_settings(
+            COLIKE_STATE_PATH=os.path.join(state_dir, 'likes.npz'), COLIKE_MIN_CO_LIKES=1,
+            COLIKE_BATCH_SIZE=3, COLIKE_FULL_RECOMPUTE_RATIO=1.0, # Несколько пачек; без перехода на полный пересчет
+        ))
+        self.users = [User.objects.create_user(username=f"user{i}", email=f"user{i}@example.com") for i in range(6)]
+        self.tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(10)]
+        # Две компании: пользователи 0-2 лайкают треки 0-4, пользователи 3-5 - треки 5-9
+        for i, user in enumerate(self.users):
+            group = 0 if i < 3 else 5
+            for track in self.tracks[group + i % 3:group + i % 3 + 3]:
+                self.like(user, track)
+
+    def like(self, user, track, vote=LikeDislike.LIKE):
+        LikeDislike.objects.update_or_create(user=user, track=track, defaults={'vote': vote})
+
+    def stored(self):
+        return sorted(CoLikeSimilarity.objects.values_list('source_track_id', 'similar_track_id', 'rank', 'co_likes'))
+
+    def assert_incremental_matches_full(self):
+        job = update_colike_similarities()
+        self.assertEqual((job.status, job.parameters['mode']), ('completed', 'incremental'))
+        incremental = self.stored()
+        scores = dict(((s, o), score) for s, o, score in CoLikeSimilarity.objects.values_list('source_track_id', 'similar_track_id', 'score'))
+        update_colike_similarities(full=True)
+        self.assertEqual(incremental, self.stored())
+        for (source, other), score in scores.items():
+            self.assertAlmostEqual(CoLikeSimilarity.objects.get(source_track_id=source, similar_track_id=other).score, score)
+
+    def test_new_like_matches_full_recompute(self):
+        self.assertEqual(update_colike_similarities().parameters['mode'], 'full') # Первый запуск - без состояния
+        self.like(self.users[0], self.tracks[7]) # Мост между компаниями
+        self.assert_incremental_matches_full()
+        self.assertTrue(CoLikeSimilarity.objects.filter(source_track=self.tracks[7], similar_track=self.tracks[0]).exists())
+
+    def test_removed_and_changed_votes_match_full_recompute(self):
+        update_colike_similarities()
+        LikeDislike.objects.filter(user=self.users[1]).first().delete()
+        self.like(self.users[4], self.tracks[6], LikeDislike.DISLIKE)
+        self.assert_incremental_matches_full()
+
+
+class HybridRankTests(SimpleTestCase):
+
+    def test_colike_boost_reorders_audio_neighbors(self):
+        distances = {1: 0.2, 2: 0.3, 3: 0.4}
+        self.assertEqual(hybrid_rank([1, 2, 3], {3: 1.0}, distances, 3, weight=0.5), [3, 1, 2])
+        self.assertEqual(hybrid_rank([1, 2, 3], {}, distances, 2, weight=0.5), [1, 2])
+
+    def test_extra_colike_candidates_respect_threshold(self):
+        distances = {1: 0.2, 2: 0.3, 4: 0.5, 5: 1.5}
+        ranked = hybrid_rank([1, 2], {4: 0.9, 5: 1.0}, distances, 4, threshold=0.8, weight=0.5)
+        self.assertIn(4, ranked)
+        self.assertNotIn(5, ranked)
@@ -0,0 +1,74 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from ..delta_index import DeltaIndex
+from ..embedding_store import bulk_save_track_embeddings, get_track_embedding, save_track_embedding, target_space
+from ..models import AnnoyIndexStatus, Track, TrackEmbedding
+from .base import DIM, random_vectors
+
+
+@override_settings(ANNOY_EMBEDDING_DIM=DIM)
+class DeltaIndexTests(TestCase):
+
+    def setUp(self):
+        self.space = target_space()
+        self.since = timezone.now()
+
+    def add_tracks(self, count, seed=0):
+        tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(count)]
+        for track, vector in zip(tracks, random_vectors(count, seed=seed)):
+            save_track_embedding(track.pk, vector)
+        return tracks
+
+    def test_reads_only_embeddings_after_cursor(self):
+        old = self.add_tracks(2, seed=1)
+        TrackEmbedding.objects.update(updated_at=self.since - timedelta(minutes=1))
+        delta = DeltaIndex(DIM, max_items=10, refresh_interval=0)
+        delta.reset(self.space, self.since)
+        new = self.add_tracks(3, seed=2)
+        self.assertEqual(delta.refresh(), 3)
+        self.assertEqual({track.pk for track in new}, set(delta._state.rows))
+        self.assertNotIn(old[0].pk, delta)
+        # Повтор без новых записей: курсор не сдвигается назад, набор не меняется
+        delta.refresh(force=True)
+        self.assertEqual(len(delta), 3)
+
+    def test_pages_forward_past_max_items(self):
+        delta = DeltaIndex(DIM, max_items=3, refresh_interval=60)
+        delta.reset(self.space, self.since)
+        tracks = self.add_tracks(8)
+        for _ in range(5):
+            delta.refresh()
+        self.assertEqual(len(delta), 8)
+        self.assertTrue(all(track.pk in delta for track in tracks))
+        self.assertTrue(AnnoyIndexStatus.objects.get(singleton_instance_id=1).needs_rebuild)
+
+    def test_search_returns_nearest_first(self):
+        delta = DeltaIndex(DIM, max_items=10, refresh_interval=0)
+        delta.reset(self.space, self.since)
+        tracks = self.add_tracks(5)
+        delta.refresh()
+        query = get_track_embedding(tracks[2].pk, self.space)
+        self.assertEqual(delta.search(query, 1)[0][0], tracks[2].pk)
+        self.assertAlmostEqual(delta.search(query, 1)[0][1], 0.0, places=3)
+
+
+    def test_pages_through_batch_with_shared_timestamp(self):
+        delta = DeltaIndex(DIM, max_items=3, refresh_interval=60)
+        delta.reset(self.space, self.since)
+        tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(8)]
+        bulk_save_track_embeddings(list(zip([track.pk for track in tracks], random_vectors(8))))
+        TrackEmbedding.objects.update(updated_at=timezone.now()) # Вся пачка с одним updated_at
+        read = [delta.refresh() for _ in range(4)]
+        self.assertEqual(read, [3, 3, 2, 0])
+        self.assertTrue(all(track.pk in delta for track in tracks))
+
+    def test_unchanged_refresh_keeps_state(self):
+        delta = DeltaIndex(DIM, max_items=10, refresh_interval=0)
+        delta.reset(self.space, self.since)
+        self.add_tracks(3)
+        delta.refresh()
+        state, version = delta._state, delta.version
+        self.assertEqual(delta.refresh(force=True), 0)
+        self.assertIs(delta._state, state)
+        self.assertEqual(delta.version, version)
@@ -0,0 +1,23 @@
+import numpy as np
+from django.test import SimpleTestCase
+from ..diversity import mmr_select
+
+
+class MMRTests(SimpleTestCase):
+
+    def setUp(self):
+        # 0 и 1 - почти дубликаты, 2 - другой трек
+        vectors = np.array([[1.0, 0.0], [0.99, 0.141], [0.0, 1.0]], dtype=np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.relevance = np.array([0.95, 0.9, 0.6], dtype=np.float32)
+
+    def test_pure_relevance_keeps_order(self):
+        self.assertEqual(mmr_select(self.relevance, self.vectors, 3, 1.0), [0, 1, 2])
+
+    def test_near_duplicate_is_pushed_down(self):
+        self.assertEqual(mmr_select(self.relevance, self.vectors, 3, 0.5), [0, 2, 1])
+
+    def test_selects_at_most_pool(self):
+        self.assertEqual(len(mmr_select(self.relevance, self.vectors, 10, 0.7)), 3)
+        self.assertEqual(mmr_select(self.relevance[:0], self.vectors[:0], 5, 0.7), [])
+
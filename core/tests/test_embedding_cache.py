@@ -0,0 +1,69 @@
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from ..embedding_cache import embedding_cache_stats, get_cached_embedding, store_cached_embedding
+from ..embedding_queue import claim_embedding_jobs, process_embedding_job
+from ..embedding_store import get_track_embedding, target_space
+from ..models import EmbeddingCacheEntry, EmbeddingJob, Track
+from .base import DIM, random_vectors
+
+
+@override_settings(ANNOY_EMBEDDING_DIM=DIM)
+class ContentHashCacheTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.vector = random_vectors(1)[0]
+        self.generate = self.enterContext(mock.patch('core.utils.generate_clap_embedding', return_value=self.vector.tolist()))
+
+    def upload(self, name, content=b'same audio bytes'):
+        return Track.objects.create(
+            title=name, artist="Artist", duration=180, filepath=SimpleUploadedFile(f"{name}.mp3", content),
+        )
+
+    def run_worker(self):
+        for job in claim_embedding_jobs('worker-1', limit=10):
+            process_embedding_job(job, 'worker-1')
+
+    def test_identical_file_reuses_embedding_without_inference(self):
+        original = self.upload('original')
+        self.run_worker()
+        self.assertEqual(self.generate.call_count, 1)
+
+        duplicate = self.upload('duplicate')
+        self.assertEqual(duplicate.content_hash, original.content_hash)
+        self.assertEqual(EmbeddingJob.objects.get(track=duplicate).status, EmbeddingJob.STATUS_DONE)
+        np.testing.assert_allclose(get_track_embedding(duplicate.pk, target_space()), self.vector, rtol=1e-6)
+        self.run_worker()
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertEqual(EmbeddingCacheEntry.objects.get().hit_count, 1)
+        self.assertEqual(embedding_cache_stats()['hits'], 1)
+
+    def test_other_content_is_embedded(self):
+        self.upload('first', b'first file')
+        self.upload('second', b'second file')
+        self.run_worker()
+        self.assertEqual(self.generate.call_count, 2)
+        self.assertEqual(EmbeddingCacheEntry.objects.count(), 2)
+
+    def test_worker_uses_entry_cached_while_job_waited(self):
+        waiting = self.upload('waiting')
+        store_cached_embedding(waiting.content_hash, self.vector * 2)
+        self.run_worker()
+        self.generate.assert_not_called()
+        np.testing.assert_allclose(get_track_embedding(waiting.pk, target_space()), self.vector * 2, rtol=1e-6)
+
+    def test_entry_of_other_model_is_not_used(self):
+        track = self.upload('track')
+        store_cached_embedding(track.content_hash, self.vector, model_name='other-model')
+        self.assertIsNone(get_cached_embedding(track.content_hash))
+        self.run_worker()
+        self.generate.assert_called_once()
@@ -0,0 +1,35 @@
+import numpy as np
+from django.test import SimpleTestCase
+from ..embedding_codec import decode_embedding, encode_embedding
+from .base import random_vectors
+
+
+class EmbeddingCodecTests(SimpleTestCase):
+
+    def test_float32_round_trip_is_exact(self):
+        vector = random_vectors(1, 512)[0]
+        decoded = decode_embedding(encode_embedding(vector, 'float32'))
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, vector)
+
+    def test_float16_round_trip_within_half_precision(self):
+        vector = random_vectors(1, 512)[0]
+        blob = encode_embedding(vector, 'float16')
+        decoded = decode_embedding(blob)
+        self.assertEqual(decoded.dtype, np.float16)
+        self.assertEqual(len(blob), 8 + 512 * 2)
+        np.testing.assert_allclose(decoded.astype(np.float32), vector, rtol=1e-3, atol=1e-3)
+
+    def test_bad_header_is_rejected(self):
+        blob = bytearray(encode_embedding(np.ones(4), 'float32'))
+        for offset, value in ((0, ord('X')), (2, 99), (3, 7)): # magic, версия формата, тип
+            corrupted = bytearray(blob)
+            corrupted[offset] = value
+            with self.assertRaises(ValueError):
+                decode_embedding(bytes(corrupted))
+
+    def test_unsupported_dtype_and_shape(self):
+        with self.assertRaises(ValueError):
+            encode_embedding(np.ones(4), 'float64')
+        with self.assertRaises(ValueError):
+            encode_embedding(np.ones((2, 2)), 'float32')
@@ -0,0 +1,55 @@
+from datetime import timedelta
+import numpy as np
+from django.test import TestCase
+from django.utils import timezone
+from ..embedding_queue import claim_embedding_jobs, complete_embedding_job, recover_expired_jobs
+from ..embedding_store import get_track_embedding, target_space
+from ..models import EmbeddingJob, Track, TrackEmbedding
+from .base import DIM
+
+
+class EmbeddingQueueTests(TestCase):
+
+    def setUp(self):
+        self.tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(2)]
+        self.jobs = [EmbeddingJob.objects.create(track=track) for track in self.tracks]
+
+    def test_claim_gives_each_job_to_one_worker(self):
+        first = claim_embedding_jobs('worker-1', limit=1)
+        second = claim_embedding_jobs('worker-2', limit=5)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first[0].pk, second[0].pk)
+        self.assertEqual(claim_embedding_jobs('worker-3', limit=5), [])
+        job = EmbeddingJob.objects.get(pk=first[0].pk)
+        self.assertEqual((job.status, job.locked_by, job.attempts), (EmbeddingJob.STATUS_RUNNING, 'worker-1', 1))
+
+    def test_not_available_before_backoff(self):
+        EmbeddingJob.objects.update(available_at=timezone.now() + timedelta(minutes=5))
+        self.assertEqual(claim_embedding_jobs('worker-1', limit=5), [])
+
+    def test_expired_lease_is_requeued_and_reclaimed(self):
+        job = claim_embedding_jobs('worker-1', limit=1)[0]
+        EmbeddingJob.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(recover_expired_jobs(max_attempts=3), (1, 0))
+        reclaimed = claim_embedding_jobs('worker-2', limit=2)
+        self.assertIn(job.pk, [other.pk for other in reclaimed])
+        self.assertEqual(EmbeddingJob.objects.get(pk=job.pk).attempts, 2)
+
+    def test_expired_lease_without_attempts_left_fails(self):
+        job = claim_embedding_jobs('worker-1', limit=1)[0]
+        EmbeddingJob.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(recover_expired_jobs(max_attempts=1), (0, 1))
+        self.assertEqual(EmbeddingJob.objects.get(pk=job.pk).status, EmbeddingJob.STATUS_FAILED)
+
+    def test_result_of_lost_lease_is_discarded(self):
+        job = claim_embedding_jobs('worker-1', limit=1)[0]
+        EmbeddingJob.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        recover_expired_jobs()
+        new_job = next(other for other in claim_embedding_jobs('worker-2', limit=2) if other.pk == job.pk)
+
+        self.assertFalse(complete_embedding_job(job, 'worker-1', np.ones(DIM)))
+        self.assertFalse(TrackEmbedding.objects.filter(track_id=job.track_id).exists())
+        self.assertTrue(complete_embedding_job(new_job, 'worker-2', np.full(DIM, 2.0)))
+        np.testing.assert_array_equal(get_track_embedding(job.track_id, target_space()), np.full(DIM, 2.0))
+        self.assertEqual(EmbeddingJob.objects.get(pk=job.pk).status, EmbeddingJob.STATUS_DONE)
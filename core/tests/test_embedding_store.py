@@ -0,0 +1,71 @@
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+from django.test import TestCase, override_settings
+from .. import jobs
+from ..annoy_service import AnnoyService
+from ..embedding_store import (
+    EmbeddingSpace, active_space, activate_space, embeddings_in_space, get_track_embedding, pending_space_switch,
+    save_track_embedding, target_space,
+)
+from ..models import AnnoyIndexStatus, Track
+from .base import DIM, random_vectors
+
+
+@override_settings(ANNOY_EMBEDDING_DIM=DIM, EMBEDDING_SPACE_SWITCH_COVERAGE=0.9)
+class EmbeddingSpaceSwitchTests(TestCase):
+    """Целевое пространство (новая версия препроцессинга) досчитывается, пока индекс обслуживает старое."""
+
+    def setUp(self):
+        self.target = target_space()
+        self.old = EmbeddingSpace(self.target.model_name, 'v0:old')
+        self.status = AnnoyIndexStatus.objects.create(singleton_instance_id=1)
+        activate_space(self.status, self.old)
+        self.tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(10)]
+        Track.objects.update(filepath='tracks/track.mp3') # Без сохранения файла и постановки в очередь
+        for track, vector in zip(self.tracks, random_vectors(10)):
+            save_track_embedding(track.pk, vector, space=self.old)
+
+    def test_upload_during_switch_writes_both_spaces(self):
+        vector = random_vectors(1, seed=5)[0]
+        save_track_embedding(self.tracks[0].pk, vector)
+        np.testing.assert_array_equal(get_track_embedding(self.tracks[0].pk, self.target), vector)
+        np.testing.assert_array_equal(get_track_embedding(self.tracks[0].pk, self.old), vector)
+
+    def test_no_mirror_across_models(self):
+        other_model = EmbeddingSpace('other-model', self.old.preprocessing_version)
+        activate_space(self.status, other_model)
+        save_track_embedding(self.tracks[0].pk, random_vectors(1, seed=5)[0])
+        self.assertIsNotNone(get_track_embedding(self.tracks[0].pk, self.target))
+        self.assertFalse(embeddings_in_space(other_model).exists())
+
+    @override_settings(EMBEDDING_MIRROR_TO_ACTIVE_SPACE=False)
+    def test_mirror_can_be_disabled(self):
+        vector = random_vectors(1, seed=5)[0]
+        save_track_embedding(self.tracks[0].pk, vector)
+        self.assertFalse(np.array_equal(get_track_embedding(self.tracks[0].pk, self.old), vector))
+
+    def test_active_space_flips_only_on_promotion(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, True)
+        self.enterContext(override_settings(ANNOY_INDEX_DIR=index_dir, ANNOY_BUILD_IN_SUBPROCESS=False))
+        self.enterContext(mock.patch.object(jobs, 'AnnoyService', lambda: AnnoyService(dimension=DIM, index_dir=index_dir)))
+
+        for track, vector in zip(self.tracks[:5], random_vectors(5, seed=1)):
+            save_track_embedding(track.pk, vector)
+        self.assertIsNone(pending_space_switch()) # Покрытие 50% < 90%
+        jobs.rebuild_annoy_if_needed()
+        self.assertEqual(active_space(), self.old)
+
+        for track, vector in zip(self.tracks[5:], random_vectors(5, seed=2)):
+            save_track_embedding(track.pk, vector)
+        self.assertEqual(pending_space_switch(), self.target)
+        self.assertEqual(active_space(), self.old) # Порог покрытия пройден, но индекс еще не построен
+        with mock.patch.object(AnnoyService, 'build_index_from_db', side_effect=OSError("disk full")):
+            jobs.rebuild_annoy_if_needed()
+        self.assertEqual(active_space(), self.old) # Сборка не удалась - не переключаемся
+
+        jobs.rebuild_annoy_if_needed()
+        self.assertEqual(active_space(), self.target)
+        self.assertIsNone(pending_space_switch())
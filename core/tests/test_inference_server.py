@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.test import SimpleTestCase
+from ..inference_server import MicroBatcher
+
+
+class MicroBatcherTests(SimpleTestCase):
+
+    def make_batcher(self, batch_fn=None, max_batch_size=8, max_wait_ms=200):
+        self.batches = []
+
+        def record(items):
+            self.batches.append(list(items))
+            return [item * 10 for item in items]
+
+        batcher = MicroBatcher(batch_fn or record, max_batch_size, max_wait_ms, name='test-batcher')
+        self.addCleanup(batcher.stop)
+        return batcher
+
+    def test_concurrent_requests_share_one_batch(self):
+        batcher = self.make_batcher()
+        # Клиенты из разных потоков ставят запросы, пока обработчик еще не запущен
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            futures = list(pool.map(batcher.submit, range(5)))
+        batcher.start()
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 10, 20, 30, 40])
+        self.assertEqual(len(self.batches), 1)
+        self.assertCountEqual(self.batches[0], range(5))
+        self.assertEqual((batcher.batches, batcher.items), (1, 5))
+
+    def test_requests_arriving_within_wait_are_merged(self):
+        batcher = self.make_batcher(max_wait_ms=500).start()
+        first = batcher.submit(1)
+        futures = []
+        second = threading.Timer(0.05, lambda: futures.append(batcher.submit(2)))
+        second.start()
+        second.join()
+        self.assertEqual(first.result(timeout=5), 10)
+        self.assertEqual(futures[0].result(timeout=5), 20)
+        self.assertEqual(self.batches, [[1, 2]])
+
+    def test_batch_size_is_capped(self):
+        batcher = self.make_batcher(max_batch_size=3)
+        futures = [batcher.submit(i) for i in range(7)]
+        batcher.start()
+        self.assertEqual([future.result(timeout=5) for future in futures], [i * 10 for i in range(7)])
+        self.assertEqual([len(batch) for batch in self.batches], [3, 3, 1])
+
+    def test_failed_batch_fails_every_request(self):
+        def fail(items):
+            raise RuntimeError("model crashed")
+
+        batcher = self.make_batcher(batch_fn=fail)
+        futures = [batcher.submit(i) for i in range(3)]
+        batcher.start()
+        for future in futures:
+            with self.assertRaisesRegex(RuntimeError, "model crashed"):
+                future.result(timeout=5)
+        self.assertEqual(batcher.batches, 0)
+
+    def test_cancelled_request_is_skipped(self):
+        batcher = self.make_batcher()
+        cancelled, kept = batcher.submit(1), batcher.submit(2)
+        cancelled.cancel()
+        batcher.start()
+        self.assertEqual(kept.result(timeout=5), 20)
+        self.assertEqual(self.batches, [[2]])
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from django.test import SimpleTestCase
+from ..annoy_service import IndexSnapshot
+from ..item_map import ItemMap, build_paths, new_build_id, read_manifest, write_manifest
+from ..vector_backends import ExactBackend
+from .base import DIM, random_vectors
+
+
+class ItemMapTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, True)
+        self.track_ids = [42, 7, 1000, 3, 18] # track_ids[slot] = ID трека, не по порядку
+
+    def test_save_and_load_round_trip(self):
+        build_id = new_build_id()
+        path = os.path.join(self.index_dir, 'map.imap')
+        ItemMap.from_track_ids(self.track_ids, build_id=build_id).save(path)
+        loaded = ItemMap.load(path)
+        self.assertIsInstance(loaded.slot_to_track, np.memmap)
+        self.assertEqual(loaded.build_id, build_id)
+        self.assertEqual(len(loaded), len(self.track_ids))
+        self.assertEqual(loaded.track_ids(range(len(self.track_ids))), self.track_ids)
+        self.assertFalse(os.path.exists(f"{path}.tmp"))
+
+    def test_slot_track_lookup(self):
+        item_map = ItemMap.from_track_ids(self.track_ids)
+        for slot, track_id in enumerate(self.track_ids):
+            self.assertEqual(item_map.get(slot), track_id)
+            self.assertEqual(item_map.slot_for_track(track_id), slot)
+        self.assertEqual(item_map.slots_for_tracks([3, 42, 18]).tolist(), [3, 0, 4])
+
+    def test_missing_ids(self):
+        item_map = ItemMap.from_track_ids(self.track_ids)
+        self.assertIsNone(item_map.get(len(self.track_ids)))
+        self.assertEqual(item_map.get(-1, 'none'), 'none')
+        for track_id in (1, 8, 5000): # Меньше, между и больше всех ID карты
+            self.assertIsNone(item_map.slot_for_track(track_id))
+        self.assertEqual(item_map.slots_for_tracks([7, 8, 5000]).tolist(), [1, -1, -1])
+        self.assertEqual(ItemMap.empty().slots_for_tracks([1, 2]).tolist(), [-1, -1])
+        self.assertIsNone(ItemMap.empty().slot_for_track(1))
+
+    def test_empty_map_round_trip(self):
+        path = os.path.join(self.index_dir, 'empty.imap')
+        ItemMap.empty().save(path)
+        self.assertEqual(len(ItemMap.load(path)), 0)
+
+    def test_bad_header_is_rejected(self):
+        path = os.path.join(self.index_dir, 'bad.imap')
+        with open(path, 'wb') as f:
+            f.write(b'NOPE' + b'\0' * 60)
+        with self.assertRaises(ValueError):
+            ItemMap.load(path)
+
+    def save_build(self, build_id, track_ids, map_build_id=None):
+        """Файлы сборки точного бэкенда: индекс по случайным векторам и карта с build_id сборки (или map_build_id)."""
+        index = ExactBackend(DIM, 'angular')
+        for slot, vector in enumerate(random_vectors(len(track_ids))):
+            index.add_item(slot, vector)
+        index.build()
+        index_path, map_path = build_paths(self.index_dir, build_id, ExactBackend.file_extension)
+        index.save(index_path)
+        ItemMap.from_track_ids(track_ids, build_id=map_build_id or build_id).save(map_path)
+
+    def test_loads_with_versioned_build(self):
+        build_id = new_build_id()
+        self.save_build(build_id, self.track_ids)
+        write_manifest(self.index_dir, {'build_id': build_id, 'backend': 'exact'})
+        manifest = read_manifest(self.index_dir)
+        snapshot = IndexSnapshot.load(self.index_dir, manifest['build_id'], DIM, 'angular', backend_name='exact')
+        self.assertEqual(snapshot.build_id, build_id)
+        self.assertEqual(snapshot.item_map.build_id, build_id)
+        self.assertEqual(snapshot.item_map.slot_for_track(1000), 2)
+        self.assertEqual(snapshot.index.get_n_items(), len(self.track_ids))
+
+    def test_map_from_other_build_is_rejected(self):
+        build_id = new_build_id()
+        self.save_build(build_id, self.track_ids, map_build_id=new_build_id())
+        with self.assertRaises(ValueError):
+            IndexSnapshot.load(self.index_dir, build_id, DIM, 'angular', backend_name='exact')
@@ -0,0 +1,73 @@
+import math
+from unittest import mock
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from ..models import Recommendation
+from .base import DIM, IndexTestCase, random_vectors
+
+
+class RecommendationTablePathTests(IndexTestCase):
+
+    def test_similar_tracks_use_materialized_pool(self):
+        from ..recommendations import materialize_recommendations, recommend_for_track
+        materialize_recommendations(self.service)
+        with mock.patch.object(self.service, 'find_nearest_neighbors', side_effect=AssertionError("live search")), \
+                CaptureQueriesContext(connection) as queries:
+            result = recommend_for_track(self.tracks[0], n=10)
+        self.assertEqual(len(result.ids), 10)
+        self.assertTrue(any('core_recommendation' in query['sql'] for query in queries.captured_queries))
+        self.assertNotIn(self.tracks[0].pk, result.ids)
+
+
+class SparseNeighborhoodTests(IndexTestCase):
+    """У первого трека только три соседа в пределах ANNOY_DISTANCE_THRESHOLD (по умолчанию), остальные далеко."""
+
+    def track_vectors(self):
+        vectors = random_vectors(self.num_tracks)
+        base = np.zeros(DIM, dtype=np.float32)
+        base[0] = 1.0
+        vectors[0] = base
+        for i in range(1, 4):
+            vectors[i] = base + 0.1 * random_vectors(1, seed=i)[0]
+        vectors[4:, 0] = -np.abs(vectors[4:, 0]) - 1.0 # Остальные - в другой полусфере
+        return vectors
+
+    def setUp(self):
+        super().setUp()
+        from ..recommendations import materialize_recommendations
+        materialize_recommendations(self.service)
+
+    def lookup(self, n, threshold=None):
+        from ..recommendations import _lookup_recommended_ids
+        threshold = settings.ANNOY_DISTANCE_THRESHOLD if threshold is None else threshold
+        with mock.patch.object(self.service, 'find_nearest_neighbors', side_effect=AssertionError("live search")):
+            return _lookup_recommended_ids(self.tracks[0].pk, n, threshold)
+
+    def test_table_keeps_neighbors_beyond_threshold(self):
+        self.assertEqual(Recommendation.objects.filter(source_track=self.tracks[0]).count(), settings.RECOMMENDATIONS_TOP_K)
+
+    def test_fewer_neighbors_than_n_within_threshold(self):
+        expected = self.service.find_nearest_neighbors(self.tracks[0].pk, n=10)
+        self.assertEqual(sorted(expected), [track.pk for track in self.tracks[1:4]])
+        self.assertEqual(self.lookup(10), expected)
+
+    def test_other_thresholds_from_table(self):
+        self.assertEqual(self.lookup(10, threshold=math.inf), self.service.find_nearest_neighbors(self.tracks[0].pk, n=10, threshold=math.inf))
+        # В пределах порога никого: как и живой поиск, n ближайших
+        self.assertEqual(self.lookup(5, threshold=0.0), self.service.find_nearest_neighbors(self.tracks[0].pk, n=5, threshold=0.0))
+
+    def test_short_list_inside_threshold_falls_back_to_live_search(self):
+        from ..recommendations import _lookup_recommended_ids
+        Recommendation.objects.filter(source_track=self.tracks[0], rank__gte=2).delete()
+        with mock.patch.object(self.service, 'find_nearest_neighbors', return_value=['live']) as live:
+            self.assertEqual(_lookup_recommended_ids(self.tracks[0].pk, 10, settings.ANNOY_DISTANCE_THRESHOLD), ['live'])
+        live.assert_called_once()
+
+    def test_similar_tracks_page_served_from_table(self):
+        from ..recommendations import recommend_for_track
+        with mock.patch.object(self.service, 'find_nearest_neighbors', side_effect=AssertionError("live search")):
+            result = recommend_for_track(self.tracks[0], n=10)
+        self.assertEqual(sorted(result.ids), [track.pk for track in self.tracks[1:4]])
+        self.assertTrue(result.exhausted)
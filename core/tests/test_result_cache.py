@@ -0,0 +1,109 @@
+import threading
+import time
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from ..result_cache import VersionedResultCache
+
+
+class CountingCompute:
+    """compute() для кеша: считает вызовы и может работать заданное время."""
+
+    def __init__(self, value='result', delay=0.0):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return self.value
+
+
+class VersionedResultCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def make_cache(self, **kwargs):
+        return VersionedResultCache('test', local_size=kwargs.pop('local_size', 10), timeout=60, **kwargs)
+
+    def test_same_version_hits_and_new_version_misses(self):
+        results = self.make_cache()
+        compute = CountingCompute()
+        self.assertEqual(results.get_or_compute('v1', (1, 10), compute), 'result')
+        self.assertEqual(results.get_or_compute('v1', (1, 10), compute), 'result')
+        self.assertEqual(compute.calls, 1)
+        results.get_or_compute('v2', (1, 10), compute) # Новая сборка - новый ключ
+        self.assertEqual(compute.calls, 2)
+        results.get_or_compute('v2', (2, 10), compute)
+        self.assertEqual(compute.calls, 3)
+        stats = results.stats()['process']
+        self.assertEqual((stats['local_hits'], stats['misses']), (1, 3))
+
+    def test_concurrent_calls_compute_once(self):
+        results = self.make_cache()
+        compute = CountingCompute(delay=0.2)
+        barrier = threading.Barrier(8)
+        values = []
+
+        def worker():
+            barrier.wait()
+            values.append(results.get_or_compute('v1', ('hot',), compute))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(values, ['result'] * 8)
+        self.assertEqual(results.stats()['process']['coalesced'], 7)
+
+    def test_shared_tier_serves_other_process(self):
+        # Два экземпляра с одним namespace - как два веб-процесса с общим Django cache
+        first, second = self.make_cache(), self.make_cache()
+        compute = CountingCompute()
+        first.get_or_compute('v1', (1,), compute)
+        self.assertEqual(second.get_or_compute('v1', (1,), compute), 'result')
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(second.stats()['process']['shared_hits'], 1)
+        second.get_or_compute('v1', (1,), compute) # Теперь уже из L1 второго процесса
+        self.assertEqual(second.stats()['process']['local_hits'], 1)
+
+    def test_waits_for_other_process_holding_the_lock(self):
+        results = self.make_cache(lock_timeout=2.0, poll_interval=0.01)
+        key = results._key('v1', (1,))
+        cache.add(f"{key}:lock", 1) # Ключ считает другой процесс
+        timer = threading.Timer(0.1, lambda: cache.set(key, 'from other process'))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        compute = CountingCompute()
+        self.assertEqual(results.get_or_compute('v1', (1,), compute), 'from other process')
+        self.assertEqual(compute.calls, 0)
+
+    def test_computes_itself_when_other_process_times_out(self):
+        results = self.make_cache(lock_timeout=0.05, poll_interval=0.01)
+        cache.add(f"{results._key('v1', (1,))}:lock", 1)
+        compute = CountingCompute()
+        self.assertEqual(results.get_or_compute('v1', (1,), compute), 'result')
+        self.assertEqual(compute.calls, 1)
+
+    def test_failed_compute_is_not_cached(self):
+        results = self.make_cache()
+
+        def fail():
+            raise RuntimeError("search failed")
+        with self.assertRaises(RuntimeError):
+            results.get_or_compute('v1', (1,), fail)
+        compute = CountingCompute()
+        self.assertEqual(results.get_or_compute('v1', (1,), compute), 'result')
+        self.assertEqual(compute.calls, 1)
+
+    def test_local_tier_is_bounded(self):
+        results = self.make_cache(local_size=2)
+        for track_id in range(5):
+            results.get_or_compute('v1', (track_id,), CountingCompute(track_id))
+        self.assertEqual(results.stats()['local_size'], 2)
@@ -0,0 +1,57 @@
+import numpy as np
+from django.test import TestCase, override_settings
+from ..embedding_store import bulk_save_track_embeddings, save_track_embedding
+from ..models import LikeDislike, Track, UserTasteVector
+from ..taste import rebuild_taste_vector, record_vote
+from .base import DIM, User, random_vectors
+
+
+@override_settings(ANNOY_EMBEDDING_DIM=DIM)
+class TasteVectorTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='listener', email='listener@example.com', password='secret')
+        self.tracks = [Track.objects.create(title=f"Track {i}", artist="Artist") for i in range(6)]
+        bulk_save_track_embeddings(list(zip([track.pk for track in self.tracks[:5]], random_vectors(5))))
+
+    def vote(self, track, new_vote):
+        existing = LikeDislike.objects.filter(user=self.user, track=track).first()
+        old_vote, old_applied = (existing.vote, existing.taste_applied) if existing else (None, False)
+        if new_vote is None:
+            existing.delete()
+        else:
+            LikeDislike.objects.update_or_create(user=self.user, track=track, defaults={'vote': new_vote})
+        record_vote(self.user.pk, track.pk, old_vote, new_vote, old_applied)
+
+    def assert_matches_rebuild(self):
+        incremental = UserTasteVector.objects.get(user=self.user)
+        state = (np.array(incremental.like_sum), np.array(incremental.dislike_sum), incremental.like_count, incremental.dislike_count)
+        rebuilt = rebuild_taste_vector(self.user.pk)
+        np.testing.assert_allclose(state[0], np.array(rebuilt.like_sum), atol=1e-5)
+        np.testing.assert_allclose(state[1], np.array(rebuilt.dislike_sum), atol=1e-5)
+        self.assertEqual(state[2:], (rebuilt.like_count, rebuilt.dislike_count))
+
+    def test_incremental_updates_match_rebuild(self):
+        like, dislike = LikeDislike.LIKE, LikeDislike.DISLIKE
+        for track, vote in [(0, like), (1, like), (2, dislike), (1, dislike), (3, like), (0, None), (4, dislike), (2, like)]:
+            self.vote(self.tracks[track], vote)
+            self.assert_matches_rebuild()
+
+    def test_vote_before_embedding_is_applied_when_it_arrives(self):
+        self.vote(self.tracks[0], LikeDislike.LIKE)
+        self.vote(self.tracks[5], LikeDislike.LIKE) # Эмбеддинга еще нет
+        self.assertEqual(UserTasteVector.objects.get(user=self.user).like_count, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            save_track_embedding(self.tracks[5].pk, random_vectors(1, seed=7)[0])
+        self.assertEqual(UserTasteVector.objects.get(user=self.user).like_count, 2)
+        self.assert_matches_rebuild()
+
+    def test_replaced_embedding_is_reconciled(self):
+        self.vote(self.tracks[0], LikeDislike.LIKE)
+        self.vote(self.tracks[1], LikeDislike.LIKE)
+        with self.captureOnCommitCallbacks(execute=True):
+            save_track_embedding(self.tracks[0].pk, random_vectors(1, seed=9)[0]) # Перезаливка
+        self.assert_matches_rebuild()
+        self.vote(self.tracks[0], None)
+        self.assert_matches_rebuild()
+
@@ -0,0 +1,126 @@
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from ..embedding_store import EmbeddingSpace
+from ..models import TextQueryEmbedding
+from ..text_search import (
+    TextSearchRateLimited, TextSearchUnavailable, _model_name, evict_query_embeddings, get_query_embedding,
+    normalize_query, query_embedding_cache,
+)
+from .base import DIM, IndexTestCase, User, random_vectors
+
+
+class NormalizeQueryTests(TestCase):
+
+    def test_case_whitespace_and_unicode(self):
+        self.assertEqual(normalize_query("  Dark   Ambient\twith\nPIANO "), "dark ambient with piano")
+        self.assertEqual(normalize_query("Ｌｏｆｉ ﬁre"), "lofi fire") # NFKC: полноширинные буквы, лигатура
+        self.assertEqual(normalize_query("STRASSE"), normalize_query("straße"))
+        self.assertEqual(normalize_query(None), "")
+        self.assertEqual(normalize_query("   "), "")
+
+    @override_settings(TEXT_SEARCH_MAX_QUERY_LENGTH=10)
+    def test_truncated_to_max_length(self):
+        self.assertEqual(normalize_query("jazz  piano   trio at night"), "jazz piano")
+
+
+def inference_response(model_name, seed=0):
+    return {'model_name': model_name, 'embeddings': [random_vectors(1, seed=seed)[0].tolist()]}
+
+
+@override_settings(TEXT_SEARCH_WARM_SIZE=0, TEXT_SEARCH_INFERENCE_RATE_LIMIT=2)
+class QueryEmbeddingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        query_embedding_cache.clear_local()
+        self.addCleanup(query_embedding_cache.clear_local)
+        self.model_name = _model_name()
+        self.client_class = self.enterContext(mock.patch('core.inference_server.InferenceClient'))
+        self.request = self.client_class.return_value.request
+        self.request.return_value = inference_response(self.model_name)
+
+    def test_db_hit_skips_inference(self):
+        stored = random_vectors(1, seed=3)[0]
+        TextQueryEmbedding.objects.create(query='dark ambient', model_name=self.model_name, embedding=stored)
+        embedding, source, _ = get_query_embedding('dark ambient', self.model_name, user_id=1)
+        self.assertEqual(source, 'db')
+        np.testing.assert_array_equal(embedding, stored)
+        self.request.assert_not_called()
+        self.assertEqual(get_query_embedding('dark ambient', self.model_name, user_id=1)[1], 'memory')
+
+    def test_miss_is_embedded_remotely_and_stored(self):
+        embedding, source, _ = get_query_embedding('sad piano', self.model_name, user_id=1)
+        self.assertEqual(source, 'inference')
+        self.request.assert_called_once_with({'op': 'embed_texts', 'texts': ['sad piano']})
+        stored = TextQueryEmbedding.objects.get(query='sad piano', model_name=self.model_name)
+        np.testing.assert_array_equal(stored.embedding, embedding)
+
+    def test_rate_limit_applies_to_inference_only(self):
+        TextQueryEmbedding.objects.create(query='cached', model_name=self.model_name, embedding=random_vectors(1)[0])
+        get_query_embedding('first', self.model_name, user_id=1)
+        get_query_embedding('second', self.model_name, user_id=1)
+        with self.assertRaises(TextSearchRateLimited):
+            get_query_embedding('third', self.model_name, user_id=1)
+        self.assertEqual(get_query_embedding('cached', self.model_name, user_id=1)[1], 'db') # Из таблицы - без лимита
+        self.assertEqual(get_query_embedding('third', self.model_name, user_id=2)[1], 'inference') # Лимит у каждого свой
+        self.assertEqual(self.request.call_count, 3)
+
+    def test_server_down_or_other_model(self):
+        self.request.side_effect = OSError("connection refused")
+        with self.assertRaises(TextSearchUnavailable):
+            get_query_embedding('offline', self.model_name, user_id=1)
+        self.request.side_effect = None
+        self.request.return_value = inference_response('other-model')
+        with self.assertRaises(TextSearchUnavailable):
+            get_query_embedding('other model', self.model_name, user_id=1)
+        self.assertFalse(TextQueryEmbedding.objects.exists())
+
+
+class EvictionTests(TestCase):
+
+    def test_keeps_most_used_and_recent(self):
+        now = timezone.now()
+        for query, hits, age in [('a', 50, 10), ('b', 5, 1), ('c', 5, 5), ('d', 0, 0), ('e', 20, 30)]:
+            TextQueryEmbedding.objects.create(
+                query=query, model_name='m', embedding=random_vectors(1)[0], hit_count=hits,
+                last_used_at=now - timedelta(days=age),
+            )
+        self.assertEqual(evict_query_embeddings(max_entries=3), 2)
+        self.assertEqual(set(TextQueryEmbedding.objects.values_list('query', flat=True)), {'a', 'e', 'b'})
+        self.assertEqual(evict_query_embeddings(max_entries=3), 0)
+
+
+@override_settings(TEXT_SEARCH_WARM_SIZE=0)
+class TextSearchViewTests(IndexTestCase):
+    num_tracks = 20
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        query_embedding_cache.clear_local()
+        self.addCleanup(query_embedding_cache.clear_local)
+        self.model_name = _model_name()
+        self.user = User.objects.create_user(username='listener', email='listener@example.com')
+        TextQueryEmbedding.objects.create(query='dark ambient', model_name=self.model_name, embedding=random_vectors(1, seed=9)[0])
+        self.url = reverse('text_search')
+
+    def test_login_required(self):
+        self.assertEqual(self.client.get(self.url, {'q': 'dark ambient'}).status_code, 302)
+
+    def test_search_from_stored_query(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url, {'q': 'Dark  Ambient', 'n': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['embedding_source'], 'db')
+
+    def test_index_of_other_model_is_unavailable(self):
+        self.client.force_login(self.user)
+        self.service._space = EmbeddingSpace('other-model', 'v1')
+        self.assertEqual(self.client.get(self.url, {'q': 'dark ambient'}).status_code, 503)
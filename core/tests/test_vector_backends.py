@@ -0,0 +1,88 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from django.test import SimpleTestCase
+from ..vector_backends import AnnoyBackend, BallTreeBackend, ExactBackend
+from .base import DIM, random_vectors
+
+
+def build_backend(backend_class, vectors, metric='angular', path=None, **params):
+    backend = backend_class(DIM, metric)
+    built_on_disk = backend.build_on_disk(path, max_items=len(vectors)) if path else False
+    for slot, vector in enumerate(vectors):
+        backend.add_item(slot, vector)
+    backend.build(**params)
+    if path and not built_on_disk:
+        backend.save(path)
+    return backend
+
+
+class VectorBackendParityTests(SimpleTestCase):
+    """Один и тот же набор векторов: точные бэкенды совпадают, у Annoy recall не ниже порога."""
+
+    def setUp(self):
+        self.vectors = random_vectors(300, seed=11)
+        self.queries = random_vectors(20, seed=12)
+        self.exact = build_backend(ExactBackend, self.vectors)
+        self.expected = self.exact.query_batch(self.queries, 10)
+
+    def test_exact_matches_brute_force(self):
+        normalized = self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        for query, (slots, distances) in zip(self.queries, self.expected):
+            cosine = normalized @ (query / np.linalg.norm(query))
+            self.assertEqual(slots, np.argsort(-cosine, kind='stable')[:10].tolist())
+            np.testing.assert_allclose(distances, np.sqrt(2 - 2 * cosine[slots]), atol=1e-5)
+
+    @unittest.skipUnless(importlib.util.find_spec('sklearn'), "scikit-learn is not installed")
+    def test_balltree_matches_exact(self):
+        balltree = build_backend(BallTreeBackend, self.vectors)
+        for (slots, distances), (expected_slots, expected_distances) in zip(balltree.query_batch(self.queries, 10), self.expected):
+            self.assertEqual(slots, expected_slots)
+            np.testing.assert_allclose(distances, expected_distances, atol=1e-4)
+
+    def test_annoy_recall(self):
+        annoy = build_backend(AnnoyBackend, self.vectors, num_trees=20, n_jobs=1)
+        found = 0
+        for query, (expected_slots, expected_distances) in zip(self.queries, self.expected):
+            slots, distances = annoy.query_by_vector(query, 10, search_k=2000)
+            found += len(set(slots) & set(expected_slots))
+            # Расстояния в той же шкале, что и у точного поиска
+            common = {slot: distance for slot, distance in zip(expected_slots, expected_distances)}
+            for slot, distance in zip(slots, distances):
+                if slot in common:
+                    self.assertAlmostEqual(distance, common[slot], places=4)
+        self.assertGreaterEqual(found / (10 * len(self.queries)), 0.9)
+
+    def test_exact_on_disk_build_matches_in_memory(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, True)
+        path = os.path.join(index_dir, 'build.npy')
+        on_disk = build_backend(ExactBackend, self.vectors, path=path)
+        self.assertIsInstance(on_disk.vector_matrix(), np.memmap)
+        self.assertEqual(on_disk.query_batch(self.queries, 10), self.expected)
+        loaded = ExactBackend.load(path, DIM, 'angular')
+        self.assertEqual(loaded.get_n_items(), len(self.vectors))
+        self.assertEqual(loaded.query_batch(self.queries, 10), self.expected)
+
+    def test_exact_on_disk_build_with_fewer_items_than_reserved(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, True)
+        path = os.path.join(index_dir, 'build.npy')
+        backend = ExactBackend(DIM, 'angular')
+        backend.build_on_disk(path, max_items=len(self.vectors) + 5) # Часть эмбеддингов оказалась невалидной
+        for slot, vector in enumerate(self.vectors):
+            backend.add_item(slot, vector)
+        backend.build()
+        self.assertEqual(backend.get_n_items(), len(self.vectors))
+        self.assertEqual(ExactBackend.load(path, DIM, 'angular').get_n_items(), len(self.vectors))
+        self.assertEqual(backend.query_batch(self.queries, 10), self.expected)
+
+    def test_euclidean_metric(self):
+        exact = build_backend(ExactBackend, self.vectors, metric='euclidean')
+        slots, distances = exact.query_by_vector(self.queries[0], 5)
+        brute = np.linalg.norm(self.vectors - self.queries[0], axis=1)
+        self.assertEqual(slots, np.argsort(brute, kind='stable')[:5].tolist())
+        np.testing.assert_allclose(distances, np.sort(brute)[:5], rtol=1e-4)
@@ -0,0 +1,289 @@
+# core/text_search.py
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+from collections import Counter, deque, namedtuple
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+from .embedding_codec import as_float32
+from .models import TextQueryEmbedding
+from .result_cache import VersionedResultCache
+
+logger = logging.getLogger(__name__)
+
+# --- Поиск треков по текстовому описанию ---
+# CLAP кладет текст и аудио в одно пространство: эмбеддинг запроса ("dark ambient with piano")
+# ищется по индексу аудио так же, как эмбеддинг трека.
+# Дорогая часть - инференс текстовой модели, поэтому эмбеддинг кешируется по нормализованной строке запроса:
+#   LRU процесса + Django cache -> таблица TextQueryEmbedding (переживает перезапуски) -> инференс.
+# При первом поиске процесс одним запросом к БД загружает в LRU TEXT_SEARCH_WARM_SIZE самых частых запросов;
+# список TEXT_SEARCH_WARM_QUERIES заранее эмбеддит команда warm_text_queries.
+# Время получения эмбеддинга записывается отдельно по источникам: memory и db - попадания, inference - промах.
+#
+# Веб-процесс модель не загружает: промах считает сервер инференса (manage.py run_inference_server), без fallback
+# в процесс. Промахи ограничены TEXT_SEARCH_INFERENCE_RATE_LIMIT на пользователя в минуту, а таблица запросов -
+# TEXT_SEARCH_MAX_STORED_QUERIES строками (evict_query_embeddings, самые редкие удаляются первыми).
+# Текстовый вектор сравним только с аудио той же модели: если индекс обслуживает пространство другой модели
+# (идет переход на новую), поиск по тексту недоступен.
+
+SOURCES = ('memory', 'db', 'inference')
+HIT_FLUSH_INTERVAL = 60 # Как часто (сек) счетчики запросов процесса записываются в TextQueryEmbedding.hit_count
+
+TextSearchResult = namedtuple('TextSearchResult', ['query', 'source', 'embed_seconds', 'neighbors'])
+
+
+class TextSearchUnavailable(Exception):
+    """Поиск по тексту сейчас невозможен (нет сервера инференса, другая модель индекса)."""
+
+
+class TextSearchRateLimited(TextSearchUnavailable):
+    """Пользователь исчерпал лимит инференса запросов."""
+
+# Ключ: версия = модель, части ключа = (хеш нормализованного запроса,) - см. _cache_key
+query_embedding_cache = VersionedResultCache(
+    'textq',
+    local_size=settings.TEXT_SEARCH_CACHE_LOCAL_SIZE,
+    timeout=settings.TEXT_SEARCH_CACHE_TIMEOUT,
+)
+
+
+class LatencyRecorder:
+    """Последние замеры времени по категориям (окно window замеров) и перцентили по ним."""
+
+    def __init__(self, categories, window=1000):
+        self._samples = {category: deque(maxlen=window) for category in categories}
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, category, seconds):
+        with self._lock:
+            self._samples[category].append(seconds)
+            self._counts[category] += 1
+
+    def stats(self):
+        """{категория: {'count', 'p50_ms', 'p95_ms'}} для этого процесса."""
+        with self._lock:
+            samples = {category: list(values) for category, values in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for category, values in samples.items():
+            ms = np.asarray(values) * 1000
+            result[category] = {
+                'count': counts.get(category, 0),
+                'p50_ms': round(float(np.percentile(ms, 50)), 3) if len(ms) else None,
+                'p95_ms': round(float(np.percentile(ms, 95)), 3) if len(ms) else None,
+            }
+        return result
+
+
+embedding_latency = LatencyRecorder(SOURCES)
+
+_warm_lock = threading.Lock()
+_warmed_models = set()
+_hits_lock = threading.Lock()
+_pending_hits = Counter() # (model_name, query) -> запросов с последней записи в БД
+_next_hit_flush = time.monotonic() + HIT_FLUSH_INTERVAL
+
+
+def normalize_query(text):
+    """Ключ кеша: NFKC, без учета регистра, пробелы схлопнуты, не длиннее TEXT_SEARCH_MAX_QUERY_LENGTH."""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return ' '.join(text.split())[:settings.TEXT_SEARCH_MAX_QUERY_LENGTH].strip()
+
+
+def _cache_key(query):
+    # Хеш вместо самой строки: пробелы и юникод в ключах недопустимы для memcached
+    return (hashlib.sha1(query.encode('utf-8')).hexdigest(),)
+
+
+def _model_name():
+    from .embedding_providers import get_embedding_provider
+    return get_embedding_provider().model_name
+
+
+def embed_queries(queries, model_name=None):
+    """
+    Эмбеддит нормализованные запросы, которых еще нет в TextQueryEmbedding, пачками по TEXT_SEARCH_EMBED_BATCH_SIZE,
+    и сохраняет их в таблицу.
+    :return: количество посчитанных запросов
+    """
+    from .embedding_providers import get_embedding_provider
+    model_name = model_name or _model_name()
+    queries = list(dict.fromkeys(query for query in queries if query))
+    existing = set(TextQueryEmbedding.objects.filter(model_name=model_name, query__in=queries).values_list('query', flat=True))
+    missing = [query for query in queries if query not in existing]
+    batch_size = settings.TEXT_SEARCH_EMBED_BATCH_SIZE
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        embeddings = get_embedding_provider().embed_texts(batch)
+        TextQueryEmbedding.objects.bulk_create(
+            [TextQueryEmbedding(query=query, model_name=model_name, embedding=as_float32(embedding))
+             for query, embedding in zip(batch, embeddings)],
+            ignore_conflicts=True, # Тот же запрос мог сохранить другой процесс
+        )
+    return len(missing)
+
+
+def warm_query_cache(model_name=None):
+    """
+    Загружает в LRU процесса TEXT_SEARCH_WARM_SIZE самых частых запросов (один запрос к БД, без инференса).
+    :return: количество загруженных эмбеддингов
+    """
+    model_name = model_name or _model_name()
+    rows = (
+        TextQueryEmbedding.objects.filter(model_name=model_name)
+        .order_by('-hit_count')
+        .values_list('query', 'embedding')[:settings.TEXT_SEARCH_WARM_SIZE]
+    )
+    loaded = 0
+    for query, embedding in rows:
+        query_embedding_cache.prime(model_name, _cache_key(query), as_float32(embedding))
+        loaded += 1
+    logger.info(f"Warmed text query cache with {loaded} queries ({model_name}).")
+    return loaded
+
+
+def _ensure_warm(model_name):
+    if model_name in _warmed_models:
+        return
+    with _warm_lock:
+        if model_name in _warmed_models:
+            return
+        try:
+            warm_query_cache(model_name)
+        except Exception as e:
+            logger.error(f"Failed to warm text query cache: {e}", exc_info=True)
+        _warmed_models.add(model_name) # Не повторяем при ошибке: кеш заполнится по мере запросов
+
+
+def _count_hit(model_name, query):
+    """Копит счетчик запроса в процессе и раз в HIT_FLUSH_INTERVAL записывает накопленное в БД."""
+    global _next_hit_flush
+    with _hits_lock:
+        _pending_hits[(model_name, query)] += 1
+        if time.monotonic() < _next_hit_flush:
+            return
+        pending = dict(_pending_hits)
+        _pending_hits.clear()
+        _next_hit_flush = time.monotonic() + HIT_FLUSH_INTERVAL
+    flush_query_hits(pending)
+
+
+def flush_query_hits(pending=None):
+    """Добавляет счетчики запросов к TextQueryEmbedding.hit_count (по ним выбирается прогреваемый набор)."""
+    if pending is None:
+        with _hits_lock:
+            pending = dict(_pending_hits)
+            _pending_hits.clear()
+    now = timezone.now()
+    for (model_name, query), count in pending.items():
+        TextQueryEmbedding.objects.filter(query=query, model_name=model_name).update(
+            hit_count=F('hit_count') + count, last_used_at=now,
+        )
+
+
+def evict_query_embeddings(max_entries=None):
+    """
+    Оставляет в TextQueryEmbedding не больше max_entries запросов: самые частые и недавние.
+    :return: количество удаленных строк
+    """
+    max_entries = settings.TEXT_SEARCH_MAX_STORED_QUERIES if max_entries is None else max_entries
+    flush_query_hits() # Счетчики процесса, чтобы не удалить только что популярные запросы
+    stale_ids = list(
+        TextQueryEmbedding.objects.order_by('-hit_count', '-last_used_at', '-pk').values_list('pk', flat=True)[max_entries:]
+    )
+    deleted = 0
+    for start in range(0, len(stale_ids), 1000):
+        deleted += TextQueryEmbedding.objects.filter(pk__in=stale_ids[start:start + 1000]).delete()[0]
+    if deleted:
+        logger.info(f"Evicted {deleted} text query embeddings (limit {max_entries}).")
+    return deleted
+
+
+def _check_inference_rate(user_id):
+    """Фиксированное окно в минуту на пользователя (счетчик в Django cache, общий для процессов при memcached/redis)."""
+    limit = settings.TEXT_SEARCH_INFERENCE_RATE_LIMIT
+    if not limit:
+        return
+    key = f"textq:rate:{user_id}:{int(time.time() // 60)}"
+    cache.add(key, 0, timeout=120)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=120)
+        count = 1
+    if count > limit:
+        raise TextSearchRateLimited(f"Text inference rate limit exceeded for user {user_id}")
+
+
+def _embed_remote(query, model_name):
+    """Инференс запроса на сервере инференса (веб-процесс модель не загружает)."""
+    from .inference_server import InferenceClient, InferenceServerError
+    try:
+        response = InferenceClient().request({'op': 'embed_texts', 'texts': [query]})
+    except (OSError, ValueError, InferenceServerError) as e:
+        raise TextSearchUnavailable(f"Inference server unavailable: {e}") from e
+    if response.get('model_name', model_name) != model_name:
+        raise TextSearchUnavailable(f"Inference server runs {response['model_name']}, queries need {model_name}")
+    return as_float32(response['embeddings'][0])
+
+
+def _load_or_embed(query, model_name, source, user_id):
+    """Промах памяти: эмбеддинг из таблицы, иначе инференс (с записью в таблицу). Источник пишется в source[0]."""
+    embedding = (
+        TextQueryEmbedding.objects.filter(query=query, model_name=model_name)
+        .values_list('embedding', flat=True).first()
+    )
+    if embedding is not None:
+        source[0] = 'db'
+        return as_float32(embedding)
+    source[0] = 'inference'
+    _check_inference_rate(user_id)
+    embedding = _embed_remote(query, model_name)
+    TextQueryEmbedding.objects.get_or_create(query=query, model_name=model_name, defaults={'embedding': embedding})
+    return embedding
+
+
+def get_query_embedding(query, model_name=None, user_id=None):
+    """
+    Эмбеддинг нормализованного запроса (память -> БД -> инференс на сервере инференса).
+    :return: (вектор float32, источник: 'memory' / 'db' / 'inference', время в секундах)
+    :raises TextSearchUnavailable: промах, а сервер инференса недоступен или лимит пользователя исчерпан
+    """
+    model_name = model_name or _model_name()
+    _ensure_warm(model_name)
+    started = time.perf_counter()
+    source = ['memory']
+    embedding = query_embedding_cache.get_or_compute(
+        model_name, _cache_key(query), lambda: _load_or_embed(query, model_name, source, user_id),
+    )
+    elapsed = time.perf_counter() - started
+    embedding_latency.record(source[0], elapsed)
+    _count_hit(model_name, query)
+    return embedding, source[0], elapsed
+
+
+def search_tracks_by_text(text, n=20, genre_id=None, user_id=None):
+    """
+    Треки, ближайшие к текстовому описанию.
+    :return: TextSearchResult(query, source, embed_seconds, neighbors=[(ID трека, расстояние), ...]) или None для пустого запроса
+    :raises TextSearchUnavailable: индекс в пространстве другой модели, нет сервера инференса или исчерпан лимит
+    """
+    query = normalize_query(text)
+    if not query:
+        return None
+    from .annoy_service import annoy_service
+    annoy_service.refresh_if_stale()
+    model_name = _model_name()
+    index_model_name = annoy_service.space.model_name
+    if index_model_name != model_name:
+        raise TextSearchUnavailable(f"Index serves {index_model_name} embeddings, text queries are embedded with {model_name}")
+    embedding, source, embed_seconds = get_query_embedding(query, model_name, user_id)
+    neighbors = annoy_service.find_nearest_to_vector(embedding, n=n, genre_id=genre_id)
+    logger.info(f"Text search {query!r}: {len(neighbors)} tracks (embedding from {source} in {embed_seconds * 1000:.1f} ms)")
+    return TextSearchResult(query, source, embed_seconds, neighbors)
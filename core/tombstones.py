@@ -0,0 +1,106 @@
+# core/tombstones.py
+import logging
+import threading
+import time
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Надгробия удаленных треков ---
+# Удаленный трек остается в сборке Annoy до перестройки. Его ID записывается в TrackTombstone,
+# каждый веб-процесс держит эти ID в памяти как отсортированный массив int64 и отфильтровывает их
+# из результатов поиска (с запасом кандидатов, чтобы вернуть полные n рекомендаций).
+# Когда надгробий становится больше ANNOY_TOMBSTONE_REBUILD_RATIO от размера индекса,
+# запрашивается перестройка; после нее надгробия треков, не попавших в сборку, удаляются.
+
+
+def record_tombstone(track_id):
+    """Отмечает трек удаленным и запрашивает перестройку индекса, если удаленных стало слишком много."""
+    from .models import TrackTombstone, AnnoyIndexStatus
+    TrackTombstone.objects.get_or_create(track_id=track_id)
+    count = TrackTombstone.objects.count()
+    if count >= rebuild_threshold():
+        AnnoyIndexStatus.request_rebuild(f"{count} deleted tracks in the index")
+
+
+def rebuild_threshold():
+    """Число надгробий, при котором индекс пора перестроить (доля от размера текущей сборки)."""
+    from .item_map import read_manifest
+    try:
+        manifest = read_manifest(settings.ANNOY_INDEX_DIR) or {}
+    except Exception:
+        manifest = {}
+    return max(1, int(settings.ANNOY_TOMBSTONE_REBUILD_RATIO * (manifest.get('items') or 0)))
+
+
+def prune_tombstones(item_map, before):
+    """
+    Удаляет надгробия треков, которых нет в новой сборке (item_map) и которые удалены до начала ее построения.
+    :return: количество удаленных записей
+    """
+    from .models import TrackTombstone
+    stale = [
+        pk for pk, track_id in TrackTombstone.objects.filter(deleted_at__lt=before).values_list('pk', 'track_id')
+        if item_map.slot_for_track(track_id) is None
+    ]
+    if stale:
+        TrackTombstone.objects.filter(pk__in=stale).delete()
+        logger.info(f"Pruned {len(stale)} tombstones compacted by the new index build.")
+    return len(stale)
+
+
+class TombstoneSet:
+    """ID удаленных треков в памяти процесса; дочитывается из БД инкрементально."""
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = settings.ANNOY_DELTA_REFRESH_INTERVAL if refresh_interval is None else refresh_interval
+        self._track_ids = np.empty(0, dtype=np.int64) # Отсортирован; заменяется целиком
+        self._lock = threading.Lock()
+        self._cursor = 0 # pk последней прочитанной записи
+        self._reload = False # Перечитать набор целиком при следующем обновлении
+        self._next_refresh = 0.0
+
+    def __len__(self):
+        return int(self._track_ids.shape[0])
+
+    @property
+    def version(self):
+        """pk последнего прочитанного надгробия (одинаков во всех процессах, дочитавших те же записи)."""
+        return self._cursor
+
+    def __contains__(self, track_id):
+        track_ids = self._track_ids
+        pos = int(np.searchsorted(track_ids, track_id))
+        return pos < len(track_ids) and track_ids[pos] == track_id
+
+    def reset(self):
+        """Перечитывает набор при следующем обновлении (после смены сборки часть надгробий удалена)."""
+        with self._lock:
+            self._cursor = 0
+            self._next_refresh = 0.0
+            self._reload = True
+
+    def refresh(self, force=False):
+        """Дочитывает новые надгробия (не чаще refresh_interval)."""
+        now = time.monotonic()
+        if not force and now < self._next_refresh:
+            return 0
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            self._next_refresh = now + self.refresh_interval
+            from .models import TrackTombstone
+            rows = list(TrackTombstone.objects.filter(pk__gt=self._cursor).order_by('pk').values_list('pk', 'track_id'))
+            current = np.empty(0, dtype=np.int64) if self._reload else self._track_ids
+            self._reload = False
+            if rows:
+                self._cursor = rows[-1][0]
+                current = np.union1d(current, np.fromiter((track_id for _, track_id in rows), dtype=np.int64, count=len(rows)))
+            self._track_ids = current
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Failed to refresh tombstones: {e}", exc_info=True)
+            return 0
+        finally:
+            self._lock.release()
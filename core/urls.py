@@ -6,6 +6,7 @@ urlpatterns = [
     path('new_track/', views.new_track_view, name='new_track'),
     path('track/<int:track_id>/', views.track_detail_view, name='track_detail'), # Страница трека
     path('track/<int:track_id>/recommendations/', views.track_recommendations_view, name='track_recommendations'),
+    path('search/text/', views.text_search_view, name='text_search'), # Поиск треков по текстовому описанию (JSON)
 
     # Аутентификация
     path('register/', views.register_view, name='register'),
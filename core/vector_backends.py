@@ -0,0 +1,335 @@
+# core/vector_backends.py
+import logging
+import os
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .embedding_codec import as_float32
+
+logger = logging.getLogger(__name__)
+
+# --- Бэкенды поиска ближайших соседей ---
+# Сборка индекса (core/annoy_service.py) работает с бэкендом через общий интерфейс:
+# добавить векторы по слотам, построить, сохранить/открыть файл, искать по слоту, по вектору и пачкой.
+# Расстояния всех бэкендов совпадают с Annoy для той же метрики (angular: sqrt(2 * (1 - cos))),
+# поэтому порог ANNOY_DISTANCE_THRESHOLD и слияние с дельтой не зависят от бэкенда.
+#
+# Встроенные бэкенды:
+#   exact    - точный перебор по матрице float32 (mmap), блочное матричное умножение; для небольших каталогов
+#   annoy    - приближенный поиск Annoy (деревья случайных проекций)
+#   balltree - BallTree из scikit-learn (точный, логарифмический поиск при малой внутренней размерности)
+# Выбор задается settings.VECTOR_BACKEND; 'auto' выбирает exact или annoy по размеру каталога.
+
+BACKENDS = {
+    'exact': 'core.vector_backends.ExactBackend',
+    'annoy': 'core.vector_backends.AnnoyBackend',
+    'balltree': 'core.vector_backends.BallTreeBackend',
+}
+
+
+def get_backend_class(name):
+    """Класс бэкенда по короткому имени (см. BACKENDS) или по пути к классу."""
+    return import_string(BACKENDS.get(name, name))
+
+
+def select_backend(n_items, name=None):
+    """
+    Выбирает бэкенд для каталога из n_items векторов.
+    :return: (имя бэкенда, класс)
+    """
+    name = name or settings.VECTOR_BACKEND
+    if name == 'auto':
+        name = 'exact' if n_items <= settings.VECTOR_BACKEND_EXACT_MAX_ITEMS else 'annoy'
+    return name, get_backend_class(name)
+
+
+def prepare_vectors(vectors, metric):
+    """Матрица float32 [n, dim]; для angular строки нормализуются (косинус = скалярное произведение)."""
+    vectors = np.atleast_2d(as_float32(vectors))
+    if metric == 'angular':
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1.0)
+    return vectors
+
+
+class VectorBackend:
+    """
+    Интерфейс бэкенда. Слоты - номера векторов 0..n-1 (их сопоставление с треками хранит ItemMap).
+    Методы поиска возвращают (список слотов, список расстояний) по возрастанию расстояния.
+    """
+    file_extension = None # Расширение файла индекса сборки
+
+    def __init__(self, dimension, metric):
+        self.dimension = dimension
+        self.metric = metric
+
+    def build_on_disk(self, path, max_items=None):
+        """
+        Просит бэкенд строить индекс сразу в файле path (вызывается до add_item).
+        :param max_items: верхняя граница числа векторов (если известна заранее)
+        :return: True, если файл будет записан при build() и save() не нужен; False - индекс строится в памяти.
+        """
+        return False
+
+    def add_item(self, slot, vector):
+        raise NotImplementedError
+
+    def build(self, **params):
+        """Строит индекс после добавления всех векторов (параметры, которые бэкенд не знает, игнорируются)."""
+        raise NotImplementedError
+
+    def save(self, path):
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls, path, dimension, metric):
+        raise NotImplementedError
+
+    def get_n_items(self):
+        raise NotImplementedError
+
+    def get_item_vector(self, slot):
+        raise NotImplementedError
+
+    def vector_matrix(self):
+        """
+        Матрица векторов [n, dim] в порядке слотов, если бэкенд ее хранит (после build или load).
+        None - сборка пишет векторы отдельным файлом (см. core/vector_matrix.py).
+        """
+        return None
+
+    def query_by_item(self, slot, k, **params):
+        return self.query_by_vector(self.get_item_vector(slot), k, **params)
+
+    def query_by_vector(self, vector, k, **params):
+        raise NotImplementedError
+
+    def query_batch(self, vectors, k, executor=None, **params):
+        """
+        Поиск для нескольких векторов; по умолчанию по одному.
+        :param executor: пул потоков (concurrent.futures), в котором выполнять запросы параллельно
+        """
+        if executor is not None and len(vectors) > 1:
+            return list(executor.map(lambda vector: self.query_by_vector(vector, k, **params), vectors))
+        return [self.query_by_vector(vector, k, **params) for vector in vectors]
+
+
+class AnnoyBackend(VectorBackend):
+    file_extension = '.ann'
+
+    def __init__(self, dimension, metric, index=None):
+        super().__init__(dimension, metric)
+        from annoy import AnnoyIndex
+        self.index = index or AnnoyIndex(dimension, metric)
+
+    def build_on_disk(self, path, max_items=None):
+        # Векторы и деревья пишутся в файл (mmap), а не в память процесса
+        self.index.on_disk_build(path)
+        return True
+
+    def add_item(self, slot, vector):
+        self.index.add_item(slot, as_float32(vector))
+
+    def build(self, num_trees=None, n_jobs=None, **params):
+        # Деревья строятся параллельно в n_jobs потоках (-1 = все ядра)
+        n_jobs = settings.ANNOY_BUILD_JOBS if n_jobs is None else n_jobs
+        self.index.build(num_trees or settings.ANNOY_NUM_TREES, n_jobs=n_jobs)
+
+    def save(self, path):
+        self.index.save(path)
+
+    @classmethod
+    def load(cls, path, dimension, metric):
+        backend = cls(dimension, metric)
+        backend.index.load(path) # mmap, страницы общие для всех процессов
+        return backend
+
+    def get_n_items(self):
+        return self.index.get_n_items()
+
+    def get_item_vector(self, slot):
+        return as_float32(self.index.get_item_vector(slot))
+
+    def query_by_item(self, slot, k, search_k=None, **params):
+        search_k = settings.ANNOY_SEARCH_K if search_k is None else search_k
+        return self.index.get_nns_by_item(slot, k, include_distances=True, search_k=search_k)
+
+    def query_by_vector(self, vector, k, search_k=None, **params):
+        search_k = settings.ANNOY_SEARCH_K if search_k is None else search_k
+        return self.index.get_nns_by_vector(as_float32(vector), k, include_distances=True, search_k=search_k)
+
+
+class ExactBackend(VectorBackend):
+    """
+    Точный поиск: матрица векторов (.npy, открывается через mmap) перемножается с запросами блоками
+    по BLOCK_ROWS строк, top-k сливается между блоками. Память на запрос не зависит от размера каталога.
+    Для angular строки хранятся нормализованными, и косинус - это просто скалярное произведение.
+    При сборке в файл (build_on_disk) векторы пишутся сразу в .npy через memmap (core/vector_matrix.py):
+    матрица каталога не собирается в памяти процесса. Без файла - растущий буфер float32.
+    """
+    file_extension = '.npy'
+    BLOCK_ROWS = 32768
+    METRICS = ('angular', 'euclidean')
+
+    def __init__(self, dimension, metric, matrix=None):
+        super().__init__(dimension, metric)
+        if metric not in self.METRICS:
+            raise ValueError(f"Exact backend supports metrics {self.METRICS}, got {metric!r}")
+        self._writer = None # VectorMatrixWriter при сборке в файл
+        self._buffer = np.empty((0, dimension), dtype=np.float32) # Буфер сборки в памяти
+        self._count = 0 # Сколько векторов добавлено
+        self._set_matrix(np.empty((0, dimension), dtype=np.float32) if matrix is None else matrix)
+
+    def _set_matrix(self, matrix):
+        self.matrix = matrix
+        # Квадраты норм строк для euclidean (для angular строки нормализованы)
+        self._sq_norms = np.einsum('ij,ij->i', matrix, matrix) if self.metric == 'euclidean' else None
+
+    def build_on_disk(self, path, max_items=None):
+        if max_items is None:
+            return False # Размер файла нужно задать заранее
+        from .vector_matrix import VectorMatrixWriter
+        self._writer = VectorMatrixWriter(path, max_items, self.dimension, self.metric)
+        return True
+
+    def add_item(self, slot, vector):
+        if slot != self._count:
+            raise ValueError(f"Exact backend expects consecutive slots, got {slot} after {self._count}")
+        if self._writer is not None:
+            self._writer.add_item(slot, vector) # Строка нормализуется при записи
+        else:
+            if slot == len(self._buffer):
+                grown = np.empty((max(2 * len(self._buffer), 1024), self.dimension), dtype=np.float32)
+                grown[:slot] = self._buffer
+                self._buffer = grown
+            self._buffer[slot] = as_float32(vector)
+        self._count += 1
+
+    def build(self, **params):
+        if self._writer is not None:
+            path = self._writer.path
+            self._writer.close()
+            self._writer = None
+            matrix = np.load(path, mmap_mode='r')
+            if self._count < matrix.shape[0]:
+                # Файл размечен на max_items строк, а добавлено меньше (невалидные эмбеддинги):
+                # переписываем только заполненные строки, чтобы число векторов совпало с картой сборки
+                with open(f"{path}.tmp", 'wb') as f:
+                    np.save(f, matrix[:self._count])
+                del matrix
+                os.replace(f"{path}.tmp", path)
+                matrix = np.load(path, mmap_mode='r')
+            self._set_matrix(matrix)
+        elif self._count:
+            self._set_matrix(np.ascontiguousarray(prepare_vectors(self._buffer[:self._count], self.metric)))
+        self._buffer = np.empty((0, self.dimension), dtype=np.float32)
+
+    def save(self, path):
+        with open(path, 'wb') as f: # np.save к имени без .npy дописал бы расширение
+            np.save(f, self.matrix)
+
+    @classmethod
+    def load(cls, path, dimension, metric):
+        return cls(dimension, metric, matrix=np.load(path, mmap_mode='r'))
+
+    def get_n_items(self):
+        return int(self.matrix.shape[0])
+
+    def get_item_vector(self, slot):
+        return np.asarray(self.matrix[slot], dtype=np.float32)
+
+    def vector_matrix(self):
+        return self.matrix
+
+    def _search(self, queries, k):
+        """Блочный top-k для матрицы запросов: (слоты [b, k], расстояния [b, k])."""
+        queries = prepare_vectors(queries, self.metric)
+        n = self.get_n_items()
+        k = min(k, n)
+        if not k:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        # score: больше = ближе (cos для angular, 2*q.x - |x|^2 для euclidean)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_slots = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, n, self.BLOCK_ROWS):
+            block = self.matrix[start:start + self.BLOCK_ROWS]
+            scores = queries @ block.T
+            if self.metric == 'euclidean':
+                scores = 2 * scores - self._sq_norms[start:start + len(block)]
+            slots = np.broadcast_to(np.arange(start, start + len(block), dtype=np.int64), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            slots = np.concatenate([best_slots, slots], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                slots = np.take_along_axis(slots, top, axis=1)
+            best_scores, best_slots = scores, slots
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_slots = np.take_along_axis(best_slots, order, axis=1)
+        if self.metric == 'angular':
+            distances = np.sqrt(np.maximum(2.0 - 2.0 * best_scores, 0.0))
+        else:
+            sq_queries = np.einsum('ij,ij->i', queries, queries)[:, None]
+            distances = np.sqrt(np.maximum(sq_queries - best_scores, 0.0))
+        return best_slots, distances
+
+    def query_by_vector(self, vector, k, **params):
+        slots, distances = self._search(vector, k)
+        return slots[0].tolist(), distances[0].tolist()
+
+    def query_batch(self, vectors, k, executor=None, **params):
+        # Пачка запросов - одно матричное умножение на блок, пул потоков не нужен
+        slots, distances = self._search(vectors, k)
+        return list(zip(slots.tolist(), distances.tolist()))
+
+
+class BallTreeBackend(VectorBackend):
+    """
+    sklearn.neighbors.BallTree (scikit-learn импортируется только при использовании бэкенда).
+    Для angular векторы нормализуются: евклидово расстояние между ними равно угловому расстоянию Annoy.
+    """
+    file_extension = '.balltree'
+
+    def __init__(self, dimension, metric, tree=None):
+        super().__init__(dimension, metric)
+        if metric not in ExactBackend.METRICS:
+            raise ValueError(f"BallTree backend supports metrics {ExactBackend.METRICS}, got {metric!r}")
+        self.tree = tree
+        self._vectors = []
+
+    def add_item(self, slot, vector):
+        if slot != len(self._vectors):
+            raise ValueError(f"BallTree backend expects consecutive slots, got {slot} after {len(self._vectors)}")
+        self._vectors.append(as_float32(vector))
+
+    def build(self, leaf_size=40, **params):
+        from sklearn.neighbors import BallTree
+        matrix = prepare_vectors(np.stack(self._vectors), self.metric) if self._vectors else np.empty((0, self.dimension), dtype=np.float32)
+        self.tree = BallTree(matrix, leaf_size=leaf_size)
+        self._vectors = []
+
+    def save(self, path):
+        import joblib
+        joblib.dump(self.tree, path)
+
+    @classmethod
+    def load(cls, path, dimension, metric):
+        import joblib
+        return cls(dimension, metric, tree=joblib.load(path, mmap_mode='r'))
+
+    def get_n_items(self):
+        return 0 if self.tree is None else int(self.tree.data.shape[0])
+
+    def get_item_vector(self, slot):
+        return np.asarray(self.tree.data[slot], dtype=np.float32)
+
+    def query_batch(self, vectors, k, executor=None, **params):
+        k = min(k, self.get_n_items())
+        if not k:
+            return [([], []) for _ in range(len(vectors))]
+        distances, slots = self.tree.query(prepare_vectors(vectors, self.metric), k=k)
+        return list(zip(slots.tolist(), distances.tolist()))
+
+    def query_by_vector(self, vector, k, **params):
+        return self.query_batch([vector], k, **params)[0]
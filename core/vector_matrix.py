@@ -0,0 +1,60 @@
+# core/vector_matrix.py
+import logging
+import os
+import numpy as np
+from .vector_backends import prepare_vectors
+
+logger = logging.getLogger(__name__)
+
+# --- Матрица векторов сборки ---
+# Векторы треков сборки в порядке слотов (float32 [n, dim], для angular строки нормализованы), открытые через mmap:
+# страницы общие для всех процессов, векторы пачки кандидатов выбираются одной индексацией (см. core/diversity.py).
+# Бэкенд exact хранит такую матрицу сам (индекс - это она); для остальных сборка пишет <build_id>.vec.npy.
+# Файл создается до чтения эмбеддингов на число строк из БД и заполняется по мере добавления векторов:
+# целиком матрица в памяти процесса сборки не держится. Строки после последнего слота (эмбеддинги,
+# оказавшиеся невалидными) не используются.
+
+FILE_SUFFIX = '.vec.npy'
+
+
+def vectors_path(index_dir, build_id):
+    return os.path.join(index_dir, f"{build_id}{FILE_SUFFIX}")
+
+
+class VectorMatrixWriter:
+    """Пишет векторы по слотам прямо в файл .npy (np.memmap)."""
+
+    def __init__(self, path, max_items, dimension, metric):
+        self.path = path
+        self.metric = metric
+        self.count = 0
+        self._matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(max(max_items, 1), dimension))
+
+    def add_item(self, slot, vector):
+        self._matrix[slot] = prepare_vectors(vector, self.metric)[0]
+        self.count = max(self.count, slot + 1)
+
+    def close(self):
+        self._matrix.flush()
+        self._matrix = None
+
+    def discard(self):
+        self._matrix = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_vector_matrix(index_dir, build_id, n_items):
+    """Матрица векторов сборки (mmap, первые n_items строк) или None, если файла нет (сборки до его появления)."""
+    path = vectors_path(index_dir, build_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        matrix = np.load(path, mmap_mode='r')
+    except Exception as e:
+        logger.warning(f"Could not open vector matrix {path}: {e}")
+        return None
+    if matrix.shape[0] < n_items:
+        logger.warning(f"Vector matrix {path} has {matrix.shape[0]} rows, build has {n_items} items. Ignoring it.")
+        return None
+    return matrix[:n_items]
@@ -2,21 +2,25 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from .forms import TrackForm, UserRegistrationForm, LoginForm # Добавлены UserRegistrationForm, LoginForm
 from .models import Track, LikeDislike, User, Genre, Album # Добавили User, Genre, Album и LikeDislike
-from .annoy_service import annoy_service # Импортируем глобальный экземпляр сервиса
+from .recommendations import recommend_for_track # Предрасчитанные рекомендации (или живой поиск) с фильтрацией кандидатов
+from .text_search import TextSearchRateLimited, TextSearchUnavailable, search_tracks_by_text # Поиск по текстовому описанию (эмбеддинг CLAP text)
+from .taste import get_vibe_ids, record_vote # Векторы вкуса пользователей (Мой вайб)
+from .als import factor_service # Латентные факторы ALS (Мой вайб)
+from .candidate_filter import ExclusionSet, user_vote_exclusions
+from django.conf import settings
 from django.http import Http404, JsonResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.core.paginator import Paginator # Для пагинации
-import librosa # Используем librosa для длительности
+from .audio_io import probe_uploaded_file # Метаданные аудио по заголовку файла
 import math # Для округления
 import logging
 import os # Добавим os для работы с временным файлом
-from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.contrib.auth import login, logout # Нужны для login/logout
-from django.urls import reverse_lazy # Для редиректа после регистрации
+from django.urls import reverse, reverse_lazy # Для редиректа после регистрации и ссылок в JSON
 from django.contrib.auth.views import LoginView, LogoutView # Используем встроенные LoginView/LogoutView
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.db import transaction
 from django.db.models import Count, Q, Value, Case, When, Avg # Добавили Value, Case, When, Avg
 from django.db.models.functions import Coalesce # Добавили Coalesce
-import random # Для выбора случайного трека
 from django.core.cache import cache
 from django.utils import timezone
 import json
@@ -141,38 +145,18 @@ def new_track_view(request):
                 audio_file = request.FILES.get('filepath')
 
                 if audio_file:
-                    # Определяем длительность с помощью librosa
+                    # Длительность читаем из заголовка файла (без декодирования аудио)
                     duration_seconds = 0
-                    audio_path_for_librosa = None
                     try:
-                        # Librosa лучше работает с путем к файлу, чем с file-like object
-                        # Если файл временный, используем его путь
-                        if isinstance(audio_file, TemporaryUploadedFile):
-                            audio_path_for_librosa = audio_file.temporary_file_path()
-                        else:
-                            # Для файлов в памяти может потребоваться сохранить во временный файл
-                            # Это усложнение, пока предполагаем TemporaryUploadedFile
-                            # Если это не так, librosa может не сработать напрямую
-                            # logger.warning("Uploaded file is not temporary, duration detection might fail.")
-                            # Пробуем передать сам объект, вдруг сработает
-                            audio_path_for_librosa = audio_file
-
-                        if audio_path_for_librosa:
-                             duration_seconds = math.ceil(librosa.get_duration(path=audio_path_for_librosa))
-                             logger.info(f"Determined duration for {audio_file.name} using librosa: {duration_seconds}s")
-                        else:
-                             logger.warning(f"Could not get a valid path or object for librosa duration detection: {audio_file.name}")
-                             messages.warning(request, f'Не удалось получить путь к файлу {audio_file.name} для определения длительности.')
-
+                        info = probe_uploaded_file(audio_file)
+                        duration_seconds = math.ceil(info.duration)
+                        logger.info(f"Determined duration for {audio_file.name}: {duration_seconds}s ({info.codec}, {info.sample_rate} Hz, {info.channels} ch)")
+                    except ValueError as e:
+                        # Заголовки не прочитаны: длительность определит воркер эмбеддингов
+                        logger.warning(f"Duration of {audio_file.name} left to the embedding worker: {e}")
                     except Exception as e:
-                        logger.error(f"Librosa error getting duration for {audio_file.name}: {e}", exc_info=True)
-                        messages.warning(request, f'Не удалось определить длительность файла {audio_file.name} с помощью librosa.')
-                    finally:
-                       # Указатель файла мог быть изменен librosa (если передавали объект)
-                       # Вернем на всякий случай, хотя при передаче пути это не нужно
-                       try:
-                           audio_file.seek(0)
-                       except: pass
+                        logger.error(f"Error getting duration for {audio_file.name}: {e}", exc_info=True)
+                        messages.warning(request, f'Не удалось определить длительность файла {audio_file.name}.')
 
                     track.duration = duration_seconds
                 else:
@@ -181,7 +165,7 @@ def new_track_view(request):
                 track.save()
                 form.save_m2m()
 
-                messages.success(request, f'Трек "{track.title}" (длительность: {track.duration} сек.) успешно загружен! Эмбеддинг будет сгенерирован.')
+                messages.success(request, f'Трек "{track.title}" (длительность: {track.duration} сек.) успешно загружен! Эмбеддинг поставлен в очередь и будет сгенерирован в фоне.')
                 return redirect('new_track')
             except Exception as e:
                  logger.error(f"Ошибка при сохранении трека: {e}", exc_info=True)
@@ -199,18 +183,69 @@ def track_recommendations_view(request, track_id):
     except Track.DoesNotExist:
         raise Http404("Трек не найден")
 
-    recommended_ids = annoy_service.find_nearest_neighbors(track_id, n=10) # Ищем 10 соседей
+    # ?genre=<id> - похожие треки только этого жанра (поиск по разделу индекса жанра)
+    genre_id = request.GET.get('genre')
+    genre_id = int(genre_id) if genre_id and genre_id.isdigit() else None
+    # 10 соседей без треков того же исполнителя и (для вошедшего пользователя) без дизлайкнутых
+    user_id = request.user.pk if request.user.is_authenticated else None
+    recommended_ids = recommend_for_track(source_track, n=10, user_id=user_id, genre_id=genre_id).ids
 
-    recommended_tracks = list(Track.objects.filter(pk__in=recommended_ids))
+    recommended_tracks = list(Track.objects.filter(pk__in=recommended_ids).select_related('genre'))
     # Сохраняем порядок, возвращенный Annoy (от ближайшего к дальнему)
     recommended_tracks.sort(key=lambda t: recommended_ids.index(t.pk))
 
     context = {
         'source_track': source_track,
         'recommendations': recommended_tracks,
+        'genres': Genre.objects.order_by('name'),
+        'selected_genre_id': genre_id,
     }
     return render(request, 'core/recommendations.html', context)
 
+@login_required # Промах кеша запросов стоит инференса: только для пользователей, с лимитом на каждого
+def text_search_view(request):
+    """
+    Поиск треков по текстовому описанию: ?q=dark ambient with piano[&n=20][&genre=<id>].
+    Возвращает JSON с треками по возрастанию расстояния и источником эмбеддинга запроса (memory / db / inference).
+    """
+    text = request.GET.get('q', '')
+    n = request.GET.get('n', '')
+    n = min(int(n), settings.TEXT_SEARCH_MAX_RESULTS) if n.isdigit() and int(n) > 0 else 20
+    genre_id = request.GET.get('genre')
+    genre_id = int(genre_id) if genre_id and genre_id.isdigit() else None
+    try:
+        result = search_tracks_by_text(text, n=n, genre_id=genre_id, user_id=request.user.pk)
+    except TextSearchRateLimited:
+        return JsonResponse({'error': 'Слишком много новых запросов, попробуйте через минуту'}, status=429)
+    except TextSearchUnavailable as e:
+        logger.warning(f"Text search unavailable for {text!r}: {e}")
+        return JsonResponse({'error': 'Поиск временно недоступен'}, status=503)
+    except Exception as e:
+        logger.error(f"Text search failed for {text!r}: {e}", exc_info=True)
+        return JsonResponse({'error': 'Поиск временно недоступен'}, status=503)
+    if result is None:
+        return HttpResponseBadRequest("Пустой запрос")
+
+    distances = dict(result.neighbors)
+    tracks = Track.objects.filter(pk__in=distances).select_related('genre')
+    tracks = sorted(tracks, key=lambda t: distances[t.pk]) # От ближайшего к дальнему
+    return JsonResponse({
+        'query': result.query,
+        'embedding_source': result.source,
+        'embedding_ms': round(result.embed_seconds * 1000, 3),
+        'results': [
+            {
+                'id': track.pk,
+                'title': track.title,
+                'artist': track.artist,
+                'genre': track.genre.name if track.genre else None,
+                'distance': round(distances[track.pk], 4),
+                'url': reverse('track_detail', args=[track.pk]),
+            }
+            for track in tracks
+        ],
+    }, json_dumps_params={'ensure_ascii': False})
+
 def track_detail_view(request, track_id):
     try:
         # Используем annotate для подсчета лайков/дизлайков прямо в запросе к треку
@@ -310,27 +345,33 @@ def vote_track_view(request, track_id):
     vote_value = LikeDislike.LIKE if vote_type == 'like' else LikeDislike.DISLIKE
     user = request.user
 
-    try:
-        # Пытаемся найти существующий голос
-        like_dislike = LikeDislike.objects.get(user=user, track=track)
-
-        # Если голос совпадает с текущим -> удаляем голос (отмена лайка/дизлайка)
-        if like_dislike.vote == vote_value:
-            like_dislike.delete()
-            user_vote = None
-            messages.info(request, f"Ваш голос для трека '{track.title}' отменен.")
-        else:
-            # Если голос другой -> обновляем его
-            like_dislike.vote = vote_value
-            like_dislike.save()
+    with transaction.atomic():
+        try:
+            # Пытаемся найти существующий голос
+            like_dislike = LikeDislike.objects.get(user=user, track=track)
+            old_vote, old_applied = like_dislike.vote, like_dislike.taste_applied
+
+            # Если голос совпадает с текущим -> удаляем голос (отмена лайка/дизлайка)
+            if like_dislike.vote == vote_value:
+                like_dislike.delete()
+                user_vote = None
+                messages.info(request, f"Ваш голос для трека '{track.title}' отменен.")
+            else:
+                # Если голос другой -> обновляем его
+                like_dislike.vote = vote_value
+                like_dislike.save(update_fields=['vote'])
+                user_vote = vote_value
+                messages.success(request, f"Ваш голос для трека '{track.title}' изменен.")
+
+        except LikeDislike.DoesNotExist:
+            # Если голоса нет -> создаем новый
+            LikeDislike.objects.create(user=user, track=track, vote=vote_value)
+            old_vote, old_applied = None, False
             user_vote = vote_value
-            messages.success(request, f"Ваш голос для трека '{track.title}' изменен.")
+            messages.success(request, f"Ваш голос для трека '{track.title}' учтен.")
 
-    except LikeDislike.DoesNotExist:
-        # Если голоса нет -> создаем новый
-        LikeDislike.objects.create(user=user, track=track, vote=vote_value)
-        user_vote = vote_value
-        messages.success(request, f"Ваш голос для трека '{track.title}' учтен.")
+        # Вектор вкуса меняется на один эмбеддинг (O(dim)), без пересчета по всем голосам
+        record_vote(user.pk, track.pk, old_vote, user_vote, old_applied)
 
     # Считаем общее количество лайков и дизлайков для трека
     likes_count = track.votes.filter(vote=LikeDislike.LIKE).count()
@@ -346,35 +387,26 @@ def vote_track_view(request, track_id):
 @login_required
 def my_vibe_view(request):
     user = request.user
-    liked_tracks_ids = LikeDislike.objects.filter(user=user, vote=LikeDislike.LIKE).values_list('track_id', flat=True)
-
-    source_track = None
     recommendations = []
 
-    if liked_tracks_ids:
-        # Выбираем случайный ID лайкнутого трека
-        random_liked_track_id = random.choice(list(liked_tracks_ids))
-        try:
-            # Получаем сам трек (с аннотациями счетчиков для шаблона)
-            source_track = Track.objects.select_related('genre').annotate(
-                likes_count=Coalesce(Count('votes', filter=Q(votes__vote=LikeDislike.LIKE)), Value(0)),
-                dislikes_count=Coalesce(Count('votes', filter=Q(votes__vote=LikeDislike.DISLIKE)), Value(0))
-            ).get(pk=random_liked_track_id)
-
-            # Получаем рекомендации для этого трека
-            recommended_ids = annoy_service.find_nearest_neighbors(random_liked_track_id, n=10)
-            if recommended_ids:
-                recommended_tracks_list = list(Track.objects.filter(pk__in=recommended_ids))
-                recommended_tracks_list.sort(key=lambda t: recommended_ids.index(t.pk))
-                # Дополнительно аннотируем счетчиками и голосом пользователя для отображения
-                recommendations = Track.objects.filter(pk__in=recommended_ids).annotate(
-                    likes_count=Coalesce(Count('votes', filter=Q(votes__vote=LikeDislike.LIKE)), Value(0)),
-                    dislikes_count=Coalesce(Count('votes', filter=Q(votes__vote=LikeDislike.DISLIKE)), Value(0))
-                ).order_by(Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(recommended_ids)]))
-
-        except Track.DoesNotExist:
-            # Маловероятно, но возможно, если трек удалили после лайка
-            pass
+    # Один поиск по индексу вектором вкуса (лайки минус дизлайки), результат кешируется до нового голоса
+    recommended_ids, taste = get_vibe_ids(user.pk, n=10)
+    if recommended_ids:
+        # Аннотируем счетчиками для отображения, порядок - от ближайшего к вкусу
+        recommendations = Track.objects.filter(pk__in=recommended_ids).select_related('genre').annotate(
+            likes_count=Coalesce(Count('votes', filter=Q(votes__vote=LikeDislike.LIKE)), Value(0)),
+            dislikes_count=Coalesce(Count('votes', filter=Q(votes__vote=LikeDislike.DISLIKE)), Value(0))
+        ).order_by(Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(recommended_ids)]))
+
+    # Треки по факторам ALS (нравятся слушателям с похожими оценками), без оцененных и уже показанных выше
+    factor_ids = factor_service.recommend(
+        user.pk, n=10, exclusions=user_vote_exclusions(user.pk, 'all').union(ExclusionSet(recommended_ids)),
+    )
+    factor_recommendations = []
+    if factor_ids:
+        factor_recommendations = Track.objects.filter(pk__in=factor_ids).select_related('genre').order_by(
+            Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(factor_ids)])
+        )
 
     # Получаем голоса пользователя для рекомендованных треков
     user_votes = {}
@@ -383,8 +415,9 @@ def my_vibe_view(request):
         user_votes = {item['track_id']: item['vote'] for item in user_votes_query}
 
     context = {
-        'source_track': source_track, # Трек, на основе которого сгенерирован вайб (или None)
+        'taste': taste, # Вектор вкуса: сколько лайков и дизлайков учтено
         'recommendations': recommendations, # Список рекомендованных треков
+        'factor_recommendations': factor_recommendations, # Треки по факторам ALS
         'user_votes': user_votes, # Голоса пользователя для рекомендованных треков
     }
     return render(request, 'core/my_vibe.html', context)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -131,13 +132,126 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media' # Папка 'media' будет создана в корне проекта
 
 # Настройки для Annoy
-ANNOY_INDEX_PATH = BASE_DIR / 'annoy_index.ann'
-ANNOY_ITEM_MAP_PATH = BASE_DIR / 'annoy_item_map.json' # Путь к файлу с картой ID
+ANNOY_INDEX_DIR = BASE_DIR / 'annoy_index' # Сборки индекса (<build_id>.ann + <build_id>.imap) и манифест current.json
+ANNOY_RELOAD_CHECK_INTERVAL = 2 # Как часто (сек) веб-воркер проверяет, не опубликована ли новая сборка индекса
+ANNOY_DELTA_REFRESH_INTERVAL = 2 # Как часто (сек) веб-воркер дочитывает свежие эмбеддинги в дельту индекса
+ANNOY_DELTA_MAX_ITEMS = 5000 # Размер дельты, при превышении которого запрашивается перестройка индекса
+ANNOY_TOMBSTONE_REBUILD_RATIO = 0.05 # Доля удаленных треков в индексе, при которой запрашивается перестройка
 ANNOY_EMBEDDING_DIM = 512 # Уточнить реальную размерность CLAP эмбеддинга!
 ANNOY_METRIC = 'angular' # Косинусное расстояние
 ANNOY_NUM_TREES = 50 # Количество деревьев в индексе Annoy
+ANNOY_BUILD_JOBS = -1 # Потоки для построения деревьев Annoy (-1 = все ядра)
+ANNOY_BUILD_IN_SUBPROCESS = True # Плановая перестройка в отдельном процессе (build_annoy_index), а не в процессе веб-сервера
+ANNOY_BUILD_MEMORY_LIMIT_MB = 4096 # Ограничение памяти (RLIMIT_DATA) процесса перестройки; None = без ограничения
+ANNOY_BUILD_TIMEOUT = 3600 # Максимальное время (сек) перестройки в отдельном процессе
+ANNOY_SEARCH_K = -1 # Сколько узлов просматривать при поиске (-1 = num_trees * k); подбирается командой bench_ann
+ANNOY_QUERY_THREADS = 4 # Потоки для пакетного поиска соседей (find_nearest_neighbors_many); 1 = без пула
 ANNOY_DISTANCE_THRESHOLD = 0.8 # Максимальное угловое расстояние для "похожих" треков (меньше = строже)
 
+# Бэкенд поиска ближайших соседей (core/vector_backends.py): 'auto', 'exact', 'annoy', 'balltree' или путь к классу
+VECTOR_BACKEND = 'auto'
+VECTOR_BACKEND_EXACT_MAX_ITEMS = 50000 # При 'auto': до этого размера каталога - точный поиск (exact), больше - Annoy
+GENRE_PARTITION_MIN_ITEMS = 2000 # Жанры от этого размера получают собственный индекс в разделе сборки, меньшие ищутся точно
+
+# Предрасчитанные рекомендации (core/recommendations.py), пересчитываются после каждой перестройки индекса
+RECOMMENDATIONS_TOP_K = 60 # Сколько соседей хранить для каждого трека: пул MMR (DIVERSITY_POOL_SIZE) + запас на исключения и удаленные треки
+RECOMMENDATIONS_BATCH_SIZE = 512 # Треков на один пакетный поиск и одну транзакцию записи
+RECOMMENDATION_CACHE_LOCAL_SIZE = 4096 # Записей в LRU-кеше рекомендаций каждого процесса
+RECOMMENDATION_CACHE_TIMEOUT = 3600 # Время жизни записей кеша рекомендаций в Django cache (сек)
+TASTE_DISLIKE_WEIGHT = 0.5 # Вес среднего дизлайкнутых треков в векторе вкуса (Мой вайб, core/taste.py)
+
+# Фильтрация кандидатов рекомендаций (core/candidate_filter.py)
+RECOMMENDATION_EXCLUDE_VOTES = 'dislikes' # "Похожие треки": скрывать треки с голосом пользователя ('all', 'dislikes' или None)
+RECOMMENDATION_EXCLUDE_SAME_ARTIST = True # "Похожие треки": скрывать треки того же исполнителя
+CANDIDATE_FILTER_BUDGET_MS = 50 # Бюджет времени на дополнительные раунды поиска кандидатов
+CANDIDATE_FILTER_MAX_CANDIDATES = 1000 # Максимальное k одного раунда
+
+# Item-item коллаборативная фильтрация по лайкам (core/colike.py)
+COLIKE_TOP_K = 50 # Сколько похожих по лайкам треков хранить для каждого трека
+COLIKE_MIN_CO_LIKES = 2 # Минимум пользователей, лайкнувших оба трека (меньше - шум)
+COLIKE_BATCH_SIZE = 2000 # Треков на одно разреженное произведение и одну транзакцию записи
+COLIKE_FULL_RECOMPUTE_RATIO = 0.5 # Доля затронутых треков, начиная с которой дешевле полный пересчет
+COLIKE_STATE_PATH = BASE_DIR / 'colike_likes.npz' # Матрица лайков последнего запуска (для инкрементного обновления)
+COLIKE_JOB_INTERVAL_MINUTES = 30 # Как часто планировщик обновляет схожесть
+COLIKE_WEIGHT = 0.3 # Вес схожести по лайкам в гибридной оценке "Похожих треков" (0 - только аудио)
+
+# Разнообразие "Похожих треков", MMR (core/diversity.py)
+DIVERSITY_LAMBDA = 0.7 # Баланс релевантности и разнообразия (1 - без переранжирования)
+DIVERSITY_POOL_SIZE = 40 # Из скольких кандидатов выбираются разнообразные треки
+
+# Латентные факторы пользователей и треков, implicit ALS (core/als.py)
+ALS_FACTORS = 64 # Размерность факторов
+ALS_ITERATIONS = 15 # Число пар шагов (пользователи, треки)
+ALS_REGULARIZATION = 0.1 # L2-регуляризация
+ALS_ALPHA = 40.0 # Уверенность голоса: c = 1 + ALS_ALPHA * вес
+ALS_DISLIKE_CONFIDENCE = 1.0 # Вес дизлайка (предпочтение 0) относительно лайка
+ALS_BLOCK_MEMORY_MB = 256 # Память под пачку строк одного шага (произведения векторов факторов)
+ALS_BLAS_THREADS = max(1, (os.cpu_count() or 2) // 2) # Потоков BLAS при обучении (None - все ядра; половина - чтобы не отнимать их у веб-воркеров)
+ALS_TRAIN_IN_SUBPROCESS = True # Плановое обучение в отдельном процессе (train_als --pending), а не в процессе веб-сервера
+ALS_TRAIN_MEMORY_LIMIT_MB = 4096 # Ограничение памяти (RLIMIT_DATA) процесса обучения; None = без ограничения
+ALS_JOB_TIMEOUT_MINUTES = 180 # Задача дольше этого считается зависшей (failed); процесс обучения убивается по этому же таймауту
+ALS_MODEL_DIR = BASE_DIR / 'als_model' # Сборки факторов (.npy + .imap) и манифест current.json
+ALS_TRAIN_INTERVAL_HOURS = 24 # Как часто планировщик ставит переобучение в очередь
+
+# Поиск треков по текстовому описанию (core/text_search.py): текстовый эмбеддинг CLAP ищется по индексу аудио
+TEXT_SEARCH_MAX_QUERY_LENGTH = 200 # Длина нормализованного запроса (ключ кеша эмбеддингов запросов)
+TEXT_SEARCH_MAX_RESULTS = 50 # Максимум треков в ответе /search/text/
+TEXT_SEARCH_CACHE_LOCAL_SIZE = 2048 # Эмбеддингов запросов в LRU каждого процесса
+TEXT_SEARCH_CACHE_TIMEOUT = 86400 # Время жизни эмбеддингов запросов в Django cache (сек)
+TEXT_SEARCH_WARM_SIZE = 500 # Сколько самых частых запросов загружать в LRU процесса при первом поиске
+TEXT_SEARCH_EMBED_BATCH_SIZE = 32 # Запросов на один вызов текстовой модели (команда warm_text_queries)
+TEXT_SEARCH_INFERENCE_RATE_LIMIT = 20 # Новых (не закешированных) запросов на пользователя в минуту; None - без лимита
+TEXT_SEARCH_MAX_STORED_QUERIES = 50000 # Сколько запросов хранить в TextQueryEmbedding (редкие удаляются раз в сутки)
+TEXT_SEARCH_WARM_QUERIES = [ # Типовые запросы, которые warm_text_queries эмбеддит заранее
+    'calm piano', 'dark ambient with piano', 'energetic rock', 'upbeat pop', 'sad acoustic guitar',
+    'chill lo-fi beats', 'deep house', 'heavy metal', 'jazz saxophone', 'classical strings',
+    'hip hop with heavy bass', 'relaxing ambient', 'electronic dance music', 'female vocals', 'instrumental',
+]
+
 # URL для редиректа после входа/выхода (если не указано в view)
 LOGIN_REDIRECT_URL = 'home' # Имя URL-паттерна
 LOGOUT_REDIRECT_URL = 'home' # Имя URL-паттерна
+
+# Настройки очереди эмбеддингов (manage.py run_embedding_worker)
+EMBEDDING_JOB_LEASE_SECONDS = 600 # Сколько секунд задача закреплена за воркером (после истечения ее заберет другой)
+EMBEDDING_JOB_MAX_ATTEMPTS = 3 # Максимум попыток на задачу, после чего она помечается как failed
+EMBEDDING_JOB_RETRY_BACKOFF_SECONDS = 30 # Базовая задержка перед повтором (удваивается с каждой попыткой)
+EMBEDDING_WORKER_POLL_INTERVAL = 5 # Пауза воркера (сек), когда очередь пуста
+
+# Провайдер эмбеддингов (модель загружается лениво, только в процессах, которые реально считают эмбеддинги)
+EMBEDDING_PROVIDER = 'core.embedding_providers.ClapEmbeddingProvider'
+
+# Локальный сервер инференса CLAP (manage.py run_inference_server): одна копия модели на машину,
+# запросы склеиваются в батчи. Чтобы воркеры ходили в него, укажите
+# EMBEDDING_PROVIDER = 'core.embedding_providers.SidecarEmbeddingProvider'
+EMBEDDING_SERVER_PROVIDER = 'core.embedding_providers.ClapEmbeddingProvider' # Чем считает сам сервер
+EMBEDDING_SERVER_SOCKET = BASE_DIR / 'clap_inference.sock' # Unix-сокет сервера
+EMBEDDING_SERVER_MAX_BATCH_SIZE = 16 # Максимум аудио/текстов в одном forward pass
+EMBEDDING_SERVER_MAX_WAIT_MS = 20 # Сколько ждать добора батча после первого запроса
+EMBEDDING_SERVER_TORCH_THREADS = 2 # Потоки torch (intra-op), чтобы не отнимать все ядра у веб-воркеров
+EMBEDDING_CLIENT_CONNECT_TIMEOUT = 1 # Таймаут подключения клиента к сокету (сек)
+EMBEDDING_CLIENT_TIMEOUT = 120 # Таймаут ожидания ответа (сек)
+EMBEDDING_CLIENT_FALLBACK = True # При недоступности сервера считать эмбеддинг в процессе
+EMBEDDING_CLIENT_RETRY_AFTER_SECONDS = 30 # После ошибки подключения не обращаться к серверу столько секунд
+
+# Пакетный пересчет эмбеддингов (manage.py backfill_embeddings)
+EMBEDDING_BACKFILL_BATCH_SIZE = 16 # Клипов в одном forward pass
+EMBEDDING_BACKFILL_DECODE_WORKERS = max(1, (os.cpu_count() or 2) - 1) # Процессов для декодирования аудио
+EMBEDDING_BACKFILL_CHECKPOINT_PATH = BASE_DIR / 'backfill_embeddings.checkpoint.json' # Прогресс для возобновления
+
+# Окна аудио, которые декодируются для эмбеддинга (файл целиком не читается)
+EMBEDDING_AUDIO_WINDOW_SECONDS = 10 # Длина окна; CLAP (htsat-unfused) все равно обрезает вход до 10 сек
+EMBEDDING_AUDIO_NUM_WINDOWS = 1 # Окна равномерно распределены по треку; несколько окон склеиваются в один клип
+
+# Кеш эмбеддингов по SHA-256 содержимого файла (повторные загрузки того же аудио не считаются заново)
+EMBEDDING_CACHE_UNREFERENCED_GRACE_DAYS = 30 # Сколько хранить записи, на которые не ссылается ни один трек
+
+# Формат хранения эмбеддингов в БД (core/embedding_codec.py): 'float32' или 'float16' (вдвое меньше, с потерей точности)
+EMBEDDING_STORAGE_DTYPE = 'float32'
+
+# Смена модели/препроцессинга: индекс переключается на новое пространство эмбеддингов,
+# когда его векторы есть у этой доли треков (досчитываются manage.py backfill_embeddings)
+EMBEDDING_SPACE_SWITCH_COVERAGE = 0.98
+# До переключения векторы новых загрузок пишутся и в активное пространство, если модель та же
+# (например, legacy-векторы после миграции 0010): иначе новые треки не рекомендуются до конца досчета
+EMBEDDING_MIRROR_TO_ACTIVE_SPACE = True